@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+
+"""Measure how fast a `SeshetBot` on the asyncio engine handles lines from
+a fake local IRC server.
+
+The server welcomes the bot, answers its JOIN with a NAMES list, then
+sends channel messages from many users as fast as it can. Every
+`ping_every` lines it sends a PING and times the PONG, which the bot only
+sends after handling every line before it, so the round trip is the
+latency of a line under load. Then it sends one message and PING at a
+time to time the round trip on an idle connection. The bot logs to files
+in a temporary directory, as it does without a database.
+
+Usage: python benchmarks/bench_engine.py [lines] [ping_every]
+"""
+
+import asyncio
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from configparser import ConfigParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from seshet import config
+
+
+class FakeServer(object):
+    """Serves one client on its own event loop in a thread."""
+
+    def __init__(self, n_lines, ping_every, n_users=500):
+        self.n_lines = n_lines
+        self.ping_every = ping_every
+        self.n_users = n_users
+        self.port = None
+        self.rtts = []
+        self.idle_rtts = []
+        self.started = None
+        self.finished = None
+        self._ready = threading.Event()
+        self._pings = {}
+
+    def start(self):
+        threading.Thread(target=asyncio.run, args=(self._serve(),),
+                         daemon=True).start()
+        self._ready.wait()
+
+    async def _serve(self):
+        self._done = asyncio.get_running_loop().create_future()
+        server = await asyncio.start_server(self._client, '127.0.0.1', 0)
+        self.port = server.sockets[0].getsockname()[1]
+        self._ready.set()
+        async with server:
+            await self._done
+
+    async def _client(self, reader, writer):
+        nick = None
+        while True:
+            line = (await reader.readline()).decode().rstrip('\r\n')
+            cmd, _, rest = line.partition(' ')
+            if cmd == 'NICK':
+                nick = rest
+                writer.write(b':fake 001 %s :Welcome\r\n' % nick.encode())
+            elif cmd == 'JOIN':
+                break
+
+        names = ' '.join('user%d' % i for i in range(self.n_users))
+        writer.write((':%s!bench@localhost JOIN %s\r\n'
+                      ':fake 353 %s = #bench :%s %s\r\n'
+                      ':fake 366 %s #bench :End of /NAMES list.\r\n'
+                      % (nick, '#bench', nick, nick, names, nick)).encode())
+        await writer.drain()
+
+        pongs = asyncio.ensure_future(self._read_pongs(reader))
+        self.started = time.perf_counter()
+        batch = []
+        for i in range(self.n_lines):
+            u = i % self.n_users
+            batch.append(b':user%d!~u%d@host/%d PRIVMSG #bench :message '
+                         b'number %d with some more text\r\n' % (u, u, u, i))
+            if (i + 1) % self.ping_every == 0:
+                self._pings[i] = time.perf_counter()
+                batch.append(b'PING :%d\r\n' % i)
+                writer.write(b''.join(batch))
+                batch = []
+                await writer.drain()
+        self._pings['end'] = time.perf_counter()
+        batch.append(b'PING :end\r\n')
+        writer.write(b''.join(batch))
+        await writer.drain()
+
+        await pongs
+        self.finished = time.perf_counter()
+
+        for i in range(200):
+            sent = time.perf_counter()
+            writer.write(b':user0!~u0@host/0 PRIVMSG #bench :hello\r\n'
+                         b'PING :idle\r\n')
+            while not (await reader.readline()).startswith(b'PONG'):
+                pass
+            self.idle_rtts.append(time.perf_counter() - sent)
+        writer.close()
+        self._done.set_result(None)
+
+    async def _read_pongs(self, reader):
+        while True:
+            line = await reader.readline()
+            if not line:
+                return
+            if not line.startswith(b'PONG'):
+                continue
+            seq = line.split()[-1].lstrip(b':').decode()
+            key = 'end' if seq == 'end' else int(seq)
+            sent = self._pings.pop(key, None)
+            if sent is not None:
+                self.rtts.append(time.perf_counter() - sent)
+            if key == 'end':
+                return
+
+
+def build(port, log_dir):
+    conf = ConfigParser(interpolation=None)
+    conf.read_string(config.testing_config)
+    conf['connection']['server'] = '127.0.0.1'
+    conf['connection']['port'] = str(port)
+    conf['connection']['channels'] = '#bench'
+    conf['client']['nickname'] = 'bench'
+    conf['logging']['file'] = os.path.join(log_dir, '{target}_{date}.log')
+    conf['debug']['verbosity'] = 'warning'
+    conf['debug']['file'] = os.path.join(log_dir, 'debug.log')
+    return config.build_bot(conf)
+
+
+def main():
+    n_lines = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    ping_every = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+
+    log_dir = tempfile.mkdtemp()
+    try:
+        server = FakeServer(n_lines, ping_every)
+        server.start()
+        bot = build(server.port, log_dir)
+        bot.connect()
+        bot.start()
+    finally:
+        shutil.rmtree(log_dir)
+
+    elapsed = server.finished - server.started
+    print("{} lines in {:.2f}s: {:,.0f} lines/s".format(
+        n_lines, elapsed, n_lines / elapsed))
+    for label, rtts in (('under load', server.rtts),
+                        ('idle', server.idle_rtts)):
+        rtts = sorted(rtts)
+        print("PING round trip {} (ms): median {:.2f}, p95 {:.2f}, "
+              "max {:.2f}".format(label, rtts[len(rtts) // 2] * 1e3,
+                                  rtts[int(len(rtts) * 0.95)] * 1e3,
+                                  rtts[-1] * 1e3))
+    print("bot connection:", dict(bot.conn.stats()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+
+"""Compare `seshet.utils.IRCstr` against the `UserString`-based IRCstr it
+replaced, on the operations the bot performs on nicks and channel names.
+
+Usage: python benchmarks/bench_ircstr.py [number]
+"""
+
+import os
+import sys
+import timeit
+from collections import UserString
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from seshet.utils import IRCstr, upper_to_lower, lower_to_upper
+
+
+class OldIRCstr(UserString):
+    """The previous implementation, kept here for comparison."""
+
+    def casefold(self):
+        return self.lower()
+
+    def lower(self):
+        return self.data.translate(upper_to_lower)
+
+    def upper(self):
+        return self.data.translate(lower_to_upper)
+
+    def __hash__(self):
+        return hash(self.lower())
+
+    def __eq__(self, other):
+        if isinstance(other, OldIRCstr):
+            return self.lower() == other.lower()
+        elif isinstance(other, str):
+            return self.lower() == other.translate(upper_to_lower)
+        else:
+            return False
+
+
+NICKS = ['Nick%d[away]' % i for i in range(1000)]
+
+CASES = [
+    ('construct', 'for n in nicks: cls(n)'),
+    ('hash', 'for s in objs: hash(s)'),
+    ('eq (same type)', 'for a, b in pairs: a == b'),
+    ('eq (str)', 'for a, n in zip(objs, lower): a == n'),
+    ('set membership', 'for s in objs: s in members'),
+    ('dict lookup', 'for s in objs: table[s]'),
+]
+
+
+def bench(cls, stmt, number):
+    setup = {
+        'cls': cls,
+        'nicks': NICKS,
+        'objs': [cls(n) for n in NICKS],
+        'pairs': [(cls(n), cls(n.upper())) for n in NICKS],
+        'lower': [n.lower() for n in NICKS],
+        'members': set(cls(n) for n in NICKS),
+        'table': dict((cls(n), n) for n in NICKS),
+    }
+    best = min(timeit.repeat(stmt, globals=setup, number=number, repeat=5))
+    # microseconds per operation
+    return best / (number * len(NICKS)) * 1e6
+
+
+def main():
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+
+    print("{:<16} {:>12} {:>12} {:>8}".format('operation', 'old (us)',
+                                              'new (us)', 'speedup'))
+    for name, stmt in CASES:
+        old = bench(OldIRCstr, stmt, number)
+        new = bench(IRCstr, stmt, number)
+        print("{:<16} {:>12.3f} {:>12.3f} {:>7.1f}x".format(name, old, new,
+                                                             old / new))
+
+
+if __name__ == '__main__':
+    main()
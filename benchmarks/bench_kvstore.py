@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+
+"""Compare the per-operation latency of the `seshet.kvbackends` backends
+through `KVNamespace`, for a few mixes of gets, sets and deletes.
+
+Runs in a temporary directory, with the namespace cache disabled so every
+operation reaches the backend.
+
+Usage: python benchmarks/bench_kvstore.py [operations] [keys]
+"""
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from pydal import DAL
+
+from seshet.kvbackends import (PydalBackend, SQLiteBackend, DbmBackend,
+                               MemoryBackend)
+from seshet.utils import KVStore
+
+
+BACKENDS = [
+    ('pydal', lambda d: PydalBackend(DAL('sqlite://pydal.db', folder=d))),
+    ('sqlite', lambda d: SQLiteBackend(os.path.join(d, 'kv.sqlite'))),
+    ('dbm', lambda d: DbmBackend(os.path.join(d, 'kv.dbm'))),
+    ('memory', lambda d: MemoryBackend()),
+]
+
+# (name, share of gets, share of sets); the rest are deletes
+MIXES = [
+    ('read-heavy', 0.90, 0.09),
+    ('balanced', 0.50, 0.45),
+    ('write-heavy', 0.10, 0.85),
+]
+
+
+def make_ops(n, n_keys, get_share, set_share):
+    rnd = random.Random(1)
+    ops = []
+    for i in range(n):
+        k = 'key%d' % rnd.randrange(n_keys)
+        r = rnd.random()
+        if r < get_share:
+            ops.append(('get', k, None))
+        elif r < get_share + set_share:
+            ops.append(('set', k, {'count': i, 'nick': 'Someone'}))
+        else:
+            ops.append(('del', k, None))
+    return ops
+
+
+def run(ns, ops):
+    start = time.perf_counter()
+    for op, k, v in ops:
+        if op == 'get':
+            ns[k]
+        elif op == 'set':
+            ns[k] = v
+        else:
+            del ns[k]
+    # microseconds per operation
+    return (time.perf_counter() - start) / len(ops) * 1e6
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    n_keys = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+
+    print("{:<8} ".format('backend') +
+          ' '.join("{:>12}".format(m[0]) for m in MIXES) + "   (us/op)")
+    for name, factory in BACKENDS:
+        d = tempfile.mkdtemp()
+        try:
+            backend = factory(d)
+            ns = KVStore(backend).namespace('bench')
+            ns.set_many(('key%d' % i, i) for i in range(n_keys))
+            results = []
+            for _, get_share, set_share in MIXES:
+                results.append(run(ns, make_ops(n, n_keys, get_share,
+                                                set_share)))
+            backend.close()
+        except Exception as e:
+            print("{:<8} failed: {!r}".format(name, e))
+            continue
+        finally:
+            shutil.rmtree(d)
+        print("{:<8} ".format(name) +
+              ' '.join("{:>12.1f}".format(r) for r in results))
+
+
+if __name__ == '__main__':
+    main()
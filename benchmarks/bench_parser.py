@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+
+"""Compare `seshet.parser` against the way lines were parsed before it:
+split from a bytearray buffer, decoded one by one, parsed with
+`ircutils3.protocol.parse_line()` and built into ircutils3 events.
+
+The traffic is a corpus of raw lines, fed in reads of `chunk` bytes as a
+socket would return them. By default it's a generated one shaped like a
+busy network: mostly channel messages, some with IRCv3 tags, formatting
+or CTCP, among joins, parts, quits, nick and mode changes and numerics.
+A recorded session can be used instead with --corpus, one line per line.
+
+Both paths do what the bot does with a line before its handlers run:
+look at the command and target, and for messages, the source and text
+with CTCP and formatting removed. `seshet.parser` is also timed touching
+every attribute, to show the cost of what it leaves lazy.
+
+Usage: python benchmarks/bench_parser.py [lines] [chunk] [--corpus FILE]
+"""
+
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from ircutils3 import ctcp, events, format, protocol, responses
+
+from seshet.bot import _formatting
+from seshet.parser import Parser
+
+
+def generate(n_lines, n_users=2000, n_channels=50, seed=1):
+    """Return `n_lines` lines of made-up server traffic as bytes."""
+
+    rnd = random.Random(seed)
+    users = ['user%d!~u%d@host-%d.example.net' % (i, i, i % 300)
+             for i in range(n_users)]
+    channels = ['#chan%d' % i for i in range(n_channels)]
+    words = ("the a bot seshet irc python message hello world what is "
+             "this about anyone here ok thanks lol yes no maybe").split()
+
+    def text():
+        return ' '.join(rnd.choice(words) for _ in range(rnd.randint(2, 20)))
+
+    lines = []
+    for i in range(n_lines):
+        user = rnd.choice(users)
+        chan = rnd.choice(channels)
+        r = rnd.random()
+        if r < 0.70:
+            line = ':%s PRIVMSG %s :%s' % (user, chan, text())
+            if r < 0.15:
+                line = ('@time=2020-01-01T00:00:%02d.000Z;msgid=m%d '
+                        % (i % 60, i)) + line
+        elif r < 0.74:
+            line = ':%s PRIVMSG %s :\x02%s\x02 \x0304%s' % (user, chan,
+                                                          text(), text())
+        elif r < 0.77:
+            line = ':%s PRIVMSG %s :\x01ACTION %s\x01' % (user, chan, text())
+        elif r < 0.80:
+            line = ':%s NOTICE %s :%s' % (user, chan, text())
+        elif r < 0.85:
+            line = ':%s JOIN %s' % (user, chan)
+        elif r < 0.89:
+            line = ':%s PART %s :%s' % (user, chan, text())
+        elif r < 0.92:
+            line = ':%s QUIT :Quit: %s' % (user, text())
+        elif r < 0.94:
+            line = ':%s NICK :%s_' % (user, user.split('!')[0])
+        elif r < 0.96:
+            line = ':%s MODE %s +o %s' % (user, chan, rnd.choice(users)
+                                          .split('!')[0])
+        elif r < 0.98:
+            line = ':irc.example.net 353 Seshet = %s :%s' % (
+                chan, ' '.join(u.split('!')[0] for u in rnd.sample(users, 40)))
+        else:
+            line = 'PING :irc.example.net'
+        lines.append(line.encode('utf-8') + b'\r\n')
+    return b''.join(lines)
+
+
+def chunks(data, size):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+def old_path(reads):
+    """The line handling of the engine and `SimpleClient` it replaces."""
+
+    buf = bytearray()
+    n = 0
+    for data in reads:
+        buf += data
+        end = buf.rfind(b'\n')
+        if end < 0:
+            continue
+        lines = bytes(buf[:end]).split(b'\n')
+        del buf[:end + 1]
+        for raw in lines:
+            if raw.endswith(b'\r'):
+                raw = raw[:-1]
+            if not raw:
+                continue
+            prefix, command, params = protocol.parse_line(
+                raw.decode('utf-8', errors='ignore'))
+            if command.isdigit():
+                command = responses.from_digit(command)
+            if command in ("PRIVMSG", "NOTICE"):
+                e = events.MessageEvent(prefix, command, params)
+                message, requests = ctcp.extract(e.params[-1])
+                message = format.filter(message)
+                e.message = message
+                e.command, e.target, e.source
+                for command, params in requests:
+                    c = events.CTCPEvent()
+                    c.command = "CTCP_%s" % command
+                    c.params = params
+                    c.source = e.source
+                    c.target = e.target
+            else:
+                e = events.StandardEvent(prefix, command, params)
+                e.command, e.target
+            n += 1
+    return n
+
+
+def new_path(reads):
+    """What `SeshetBot._dispatch_message()` needs from each line."""
+
+    parser = Parser()
+    n = 0
+    for data in reads:
+        for msg in parser.feed(data):
+            if msg.command in ("PRIVMSG", "NOTICE"):
+                text = msg.message
+                requests = ()
+                if ctcp.X_DELIM in text:
+                    text, requests = ctcp.extract(text)
+                if _formatting.search(text):
+                    text = format.filter(text)
+                msg.message = text
+                msg.command, msg.target, msg.source
+                for command, params in requests:
+                    msg.derive("CTCP_%s" % command, params)
+            else:
+                msg.command, msg.target
+            n += 1
+    return n
+
+
+def new_path_all(reads):
+    """`seshet.parser` with every attribute of every message used."""
+
+    parser = Parser()
+    n = 0
+    for data in reads:
+        for msg in parser.feed(data):
+            (msg.command, msg.target, msg.params, msg.message, msg.source,
+             msg.user, msg.host, msg.tags, msg.folded_source,
+             msg.folded_target)
+            n += 1
+    return n
+
+
+def best(fun, reads, repeat=5):
+    times = []
+    for _ in range(repeat):
+        t = time.perf_counter()
+        n = fun(reads)
+        times.append(time.perf_counter() - t)
+    return n, min(times)
+
+
+def main():
+    args = sys.argv[1:]
+    corpus = None
+    if '--corpus' in args:
+        i = args.index('--corpus')
+        corpus = args[i + 1]
+        del args[i:i + 2]
+    n_lines = int(args[0]) if len(args) > 0 else 100000
+    size = int(args[1]) if len(args) > 1 else 4096
+
+    if corpus is not None:
+        with open(corpus, 'rb') as f:
+            data = b''.join(line.rstrip(b'\r\n') + b'\r\n' for line in f)
+    else:
+        data = generate(n_lines)
+    reads = chunks(data, size)
+    print("{:,} bytes in {:,} reads of {} bytes".format(len(data), len(reads),
+                                                       size))
+
+    baseline = None
+    for label, fun in (('ircutils3 events', old_path),
+                       ('seshet.parser', new_path),
+                       ('seshet.parser, all attributes', new_path_all)):
+        n, elapsed = best(fun, reads)
+        if baseline is None:
+            baseline = elapsed
+        print("{:32} {:,} lines in {:.3f}s: {:,.0f} lines/s ({:.2f}x)".format(
+            label, n, elapsed, n / elapsed, baseline / elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+
+"""Compare the memory used by the slotted `SeshetUser`/`SeshetChannel`
+model against the previous one, with many synthetic users spread over a
+few hundred channels.
+
+Each model is built in a fresh child process and the growth of its
+resident set size is reported.
+
+Usage: python benchmarks/bench_state_memory.py [users] [channels]
+"""
+
+import os
+import random
+import subprocess
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from seshet.bot import SeshetUser, SeshetChannel
+from seshet.state import Membership
+from seshet.utils import IRCDict, IRCSet, upper_to_lower
+
+
+class OldIRCstr(str):
+    """IRCstr before it had `__slots__` and an interned key."""
+
+    def __new__(cls, value=''):
+        self = str.__new__(cls, value)
+        self._key = str.translate(self, upper_to_lower)
+        return self
+
+    def __hash__(self):
+        return hash(self._key)
+
+    def __eq__(self, other):
+        if isinstance(other, OldIRCstr):
+            return self._key == other._key
+        return self._key == other.translate(upper_to_lower)
+
+
+class OldIRCDict(IRCDict):
+    """IRCDict without interned keys."""
+
+    def __setitem__(self, key, value):
+        self._data[key.translate(self._map.table)] = (key, value)
+
+
+class OldIRCSet(IRCSet):
+    """IRCSet without interned keys."""
+
+    def add(self, s):
+        self._data[s.translate(self._map.table)] = s
+
+
+class OldMembership(object):
+    """Membership as it was, with an IRCDict of channels for each nick."""
+
+    def __init__(self):
+        self._user_chans = OldIRCDict()
+
+    def join(self, nick, channel):
+        chans = self._user_chans.get(nick)
+        if chans is None:
+            chans = self._user_chans[nick] = OldIRCDict()
+        chans[channel.name] = channel
+        channel.users.add(nick)
+
+
+class OldSeshetUser(object):
+
+    def __init__(self, nick, user, host, membership):
+        self.nick = OldIRCstr(nick)
+        self.user = user
+        self.host = host
+        self._membership = membership
+
+    def join(self, channel):
+        self._membership.join(self.nick, channel)
+
+
+class OldSeshetChannel(object):
+
+    def __init__(self, name, users):
+        self.name = OldIRCstr(name)
+        self.users = users
+        self.message_log = []
+
+
+def rss():
+    """Resident set size of this process in bytes."""
+
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def build(model, n_users, n_channels):
+    rnd = random.Random(1)
+    # hosts are shared between users, as with cloaks and big ISPs
+    hosts = ['user/cloak/%d' % i for i in range(n_users // 20)]
+    idents = ['~u%d' % i for i in range(n_users // 10)]
+    # read the strings back from bytes so they aren't shared by accident,
+    # as they wouldn't be when parsed from the network
+    def fresh(s):
+        return s.encode().decode()
+
+    if model == 'old':
+        membership = OldMembership()
+        users = OldIRCDict()
+        channels = OldIRCDict()
+        for i in range(n_channels):
+            name = '#chan%d' % i
+            channels[name] = OldSeshetChannel(name, OldIRCSet())
+        chan_list = list(channels.values())
+        for i in range(n_users):
+            nick = 'User%d' % i
+            u = users[nick] = OldSeshetUser(nick, fresh(rnd.choice(idents)),
+                                            fresh(rnd.choice(hosts)),
+                                            membership)
+            for c in rnd.sample(chan_list, rnd.randint(1, 3)):
+                u.join(c)
+    else:
+        membership = Membership()
+        users = IRCDict()
+        channels = IRCDict()
+        for i in range(n_channels):
+            name = '#chan%d' % i
+            channels[name] = SeshetChannel(name, IRCSet())
+        chan_list = list(channels.values())
+        for i in range(n_users):
+            nick = 'User%d' % i
+            u = users[nick] = SeshetUser(nick, fresh(rnd.choice(idents)),
+                                         fresh(rnd.choice(hosts)),
+                                         membership)
+            for c in rnd.sample(chan_list, rnd.randint(1, 3)):
+                u.join(c)
+
+    return users, channels, membership
+
+
+def child(model, n_users, n_channels):
+    before = rss()
+    state = build(model, n_users, n_channels)   # noqa: F841, kept alive
+    print(rss() - before)
+
+
+def main():
+    if sys.argv[1:2] == ['--child']:
+        child(sys.argv[2], int(sys.argv[3]), int(sys.argv[4]))
+        return
+
+    n_users = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    n_channels = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+
+    results = {}
+    for model in ('old', 'new'):
+        out = subprocess.check_output([sys.executable, __file__, '--child',
+                                       model, str(n_users), str(n_channels)])
+        results[model] = int(out)
+
+    print("{} users in {} channels".format(n_users, n_channels))
+    print("{:<6} {:>12} {:>14}".format('model', 'RSS (MiB)', 'bytes/user'))
+    for model in ('old', 'new'):
+        b = results[model]
+        print("{:<6} {:>12.1f} {:>14.0f}".format(model, b / 2 ** 20,
+                                                 b / n_users))
+    print("saved {:.0%}".format(1 - results['new'] / results['old']))
+
+
+if __name__ == '__main__':
+    main()
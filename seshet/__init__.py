@@ -2,4 +2,4 @@
 and exceptions.
 """
 
-__all__ = ['bot', 'utils', 'config']
+__all__ = ['bot', 'utils', 'config', 'eventlog', 'routing', 'loader', 'workers', 'ratelimit', 'state', 'kvbackends', 'kvcodec', 'engine', 'runner', 'outbound', 'timers', 'parser', 'sync']
@@ -1,61 +1,94 @@
 """Implement SeshetBot as subclass of ircutils3.bot.SimpleBot."""
 
+import asyncio
+import inspect
 import logging
 import os
+import re
+import sys
+import time
 from io import StringIO
 from datetime import datetime
 
-from ircutils3 import bot, client
+from ircutils3 import bot, client, ctcp, events, format
 
-from .utils import KVStore, Storage, IRCstr
+from .engine import AsyncConnection
+from .eventlog import EventLogWriter, FileLogSink
+from .kvbackends import MemoryBackend
+from .loader import ModuleLoader
+from .outbound import OutboundQueue
+from .parser import Message
+from .ratelimit import RateLimiter
+from .routing import ModuleRouter, CommandIndex
+from .state import Membership, MessageLog, Snapshot, memory_usage
+from .state import save_snapshot
+from .sync import NamesListener, UserSync
+from .timers import Scheduler
+from .utils import KVStore, Storage, IRCstr, IRCDict, IRCSet
+from .utils import CaseMapping, casemappings
+from .workers import HandlerPool, THREAD, PROCESS
+
+
+# characters `ircutils3.format.filter()` removes
+_formatting = re.compile('[\x02\x03\x0f\x16\x1f]')
 
 
 class SeshetUser(object):
-    """Represent one IRC user."""
+    """Represent one IRC user.
+    
+    Channel membership is stored in a `seshet.state.Membership` index, which
+    is normally the bot's `membership`, shared by all of its users. The
+    ident and host strings are interned, since many users share a host.
+    `account` is the account the user is logged in to, if known from a WHOX
+    reply (see `seshet.sync`).
+    """
+    
+    __slots__ = ('nick', 'user', 'host', 'account', '_membership')
     
-    def __init__(self, nick, user, host):
+    def __init__(self, nick, user, host, membership=None):
         logging.debug("Building new SeshetUser, %s", nick)
         self.nick = IRCstr(nick)
-        self.user = user
-        self.host = host
-        self.channels = []
+        self.user = user and sys.intern(user)
+        self.host = host and sys.intern(host)
+        self.account = None
+        if membership is None:
+            membership = Membership()
+        self._membership = membership
+    
+    @property
+    def channels(self):
+        """List of channels this user is in."""
+        return self._membership.channels_of(self.nick)
         
     def join(self, channel):
         """Add this user to the channel's user list and add the channel to this
         user's list of joined channels.
         """
         
-        if channel not in self.channels:
-            channel.users.add(self.nick)
-            self.channels.append(channel)
+        self._membership.join(self.nick, channel)
     
     def part(self, channel):
         """Remove this user from the channel's user list and remove the channel
         from this user's list of joined channels.
+        
+        Returns True if the user is no longer in any channel.
         """
         
-        if channel in self.channels:
-            channel.users.remove(self.nick)
-            self.channels.remove(channel)
+        return self._membership.part(self.nick, channel)
             
     def quit(self):
         """Remove this user from all channels and reinitialize the user's list
         of joined channels.
         """
         
-        for c in self.channels:
-            c.users.remove(self.nick)
-        self.channels = []
+        self._membership.quit(self.nick)
         
     def change_nick(self, nick):
         """Update this user's nick in all joined channels."""
         
         old_nick = self.nick
         self.nick = IRCstr(nick)
-        
-        for c in self.channels:
-            c.users.remove(old_nick)
-            c.users.add(self.nick)
+        self._membership.rename(old_nick, self.nick)
             
     def __str__(self):
         return "{}!{}@{}".format(self.nick, self.user, self.host)
@@ -66,19 +99,26 @@ class SeshetUser(object):
         
         
 class SeshetChannel(object):
-    """Represent one IRC channel."""
+    """Represent one IRC channel.
+    
+    `id` is the small integer the bot's `Membership` index refers to this
+    channel by, or None if no one has joined it yet.
+    """
+    
+    __slots__ = ('id', 'name', 'users', 'message_log')
     
     def __init__(self, name, users, log_size=100):
+        self.id = None
         self.name = IRCstr(name)
         self.users = users
-        self.message_log = []
-        self._log_size = log_size
+        self.message_log = MessageLog(log_size)
         
     def log_message(self, user, message):
         """Log a channel message.
         
         This log acts as a sort of cache so that recent activity can be searched
-        by the bot and command modules without querying the database.
+        by the bot and command modules without querying the database. See
+        `seshet.state.MessageLog` for the methods used to search it.
         """
         
         if isinstance(user, SeshetUser):
@@ -88,10 +128,7 @@ class SeshetChannel(object):
 
         time = datetime.utcnow()
             
-        self.message_log.append((time, user, message))
-        
-        while len(self.message_log) > self._log_size:
-            del self.message_log[0]
+        self.message_log.append(time, user, message)
         
     def __str__(self):
         return str(self.name)
@@ -111,11 +148,16 @@ class SeshetBot(bot.SimpleBot):
     `seshet --config` or `seshet --new` commands.
     """
     
-    def __init__(self, nick='Seshet', db=None, debug_file=None, verbosity=99):
+    def __init__(self, nick='Seshet', db=None, debug_file=None, verbosity=99,
+                 workers=None, loader=None):
         """Extend `ircutils3.bot.SimpleBot.__init__()`.
         
         Keyword argument `db` is required for running commands other
         than core commands and should be an instance of pydal.DAL.
+        
+        `workers` (a `HandlerPool`) and `loader` (a `ModuleLoader`) may be
+        shared with other bots in the same process, as `seshet.runner`
+        does. A shared pool's `wakeup` and shutdown are left to its owner.
         """
         
         # initialize debug logging
@@ -135,10 +177,48 @@ class SeshetBot(bot.SimpleBot):
         
         self.log_file = 'seshet.log'
         self.log_formats = {}
+        self.log_max_open_files = 32
+        self.log_flush_interval = 1.0
+        self.message_log_size = 100
         self.locale = {}
+        self._file_log = None
+        
+        # network state is saved here on shutdown and every
+        # snapshot_interval seconds (0 to only save on shutdown); snapshots
+        # older than snapshot_max_age seconds (0 for any age) aren't
+        # restored, and one is closed snapshot_restore_timeout seconds
+        # after autojoin if its channels haven't all been rejoined
+        self.snapshot_file = None
+        self.snapshot_interval = 0.0
+        self.snapshot_max_age = 3600.0
+        self.snapshot_restore_timeout = 60.0
+        self._snapshot = None
+        self._snapshot_timer = None
+        self._last_snapshot = time.monotonic()
+        
+        # channel and user names are compared using the server's
+        # CASEMAPPING once it's known from RPL_ISUPPORT
+        self.casemapping = CaseMapping('rfc1459')
+        self.isupport = {}
+        self.channels = IRCDict(casemapping=self.casemapping)
+        self.users = IRCDict(casemapping=self.casemapping)
+        self.membership = Membership(self.casemapping)
         
-        self.channels = {}
-        self.users = {}
+        # runs handlers of modules that shouldn't block the poll loop
+        self._shared_workers = workers is not None
+        self.workers = workers if workers is not None else HandlerPool()
+        # tasks running coroutine handlers
+        self._tasks = set()
+        self._waiter = None
+        self.ssl_verify = True
+        # paces what's sent; see `seshet.outbound`
+        self.outbound = OutboundQueue()
+        # calls scheduled by modules; see `seshet.timers`
+        self.timers = Scheduler()
+        self.timers.run_coroutine = self.run_coroutine
+        self.rate_limiter = RateLimiter()
+        # fills in users' hosts after joins; see `seshet.sync`
+        self.sync = UserSync(self)
         
         if db is None:
             # no database connection, only log to file and run
@@ -147,18 +227,32 @@ class SeshetBot(bot.SimpleBot):
             self.log = self._log_to_file
             self.run_modules = self._run_only_core
             
-            # dummy KV store since no db
-            self.storage = Storage()
+            # KV store that's lost on exit, since no db
+            self.storage = KVStore(MemoryBackend())
+            self.event_log = None
+            self.router = None
+            self.loader = None
+            self.command_index = None
         else:
             logging.info("Using database %s", db)
             self.db = db
             self.storage = KVStore(db)
+            self.event_log = EventLogWriter(db)
+            self.router = ModuleRouter(db, casefold=self.casemapping.fold)
+            self.loader = loader if loader is not None else ModuleLoader()
+            self.loader.listeners.append(self._module_loaded)
+            # modules whose handle_startup() has run for this bot
+            self._started_modules = set()
+            self.command_index = CommandIndex(self.router, self.loader)
         
         # Add default handlers
         logging.debug("Adding default handlers...")
         self.events["any"].add_handler(client._update_client_info)
         self.events["ctcp_version"].add_handler(client._reply_to_ctcp_version)
+        self.events.register_listener("name_reply", NamesListener())
         self.events["name_reply"].add_handler(_add_channel_names)
+        self.events["any"].add_handler(self.sync.notify)
+        self.events["reply"].add_handler(_handle_isupport)
         
     def log(self, etype, source, msg='', target='', hostmask='', params=''):
         """Log an event in the database.
@@ -181,115 +275,435 @@ class SeshetBot(bot.SimpleBot):
             `parms` - any additional parameters associated with the event, such as
                 a new nickname (for NICK events), mode switches (for MODE events),
                 or a dump of local variables (for ERROR events).
+        
+        Rows are queued in `self.event_log` and written in batches; see
+        `seshet.eventlog.EventLogWriter`.
         """
         
-        self.db.event_log.insert(event_type=etype,
-                                 event_time=datetime.utcnow(),
-                                 source=source,
-                                 target=target,
-                                 message=msg,
-                                 host=hostmask,
-                                 params=params,
-                                 )
-        self.db.commit()
+        self.event_log.append(etype, source, msg, target, hostmask, params)
         
     def run_modules(self, e):
-        # grab local pointer to self.db for faster lookup
-        db = self.db
-        
-        # get initial list of modules handling this event type
-        event_types = db.modules.event_types
-        mod_enabled = db.modules.enabled
-        init_mods = db(event_types.contains(e.command) & mod_enabled).select()
-        
-        logging.debug(("Running modules for {} command. "
-                       "Initial module list:\n{}").format(e.command, init_mods)
-                      )
+        # nothing to do unless some enabled module handles this event type;
+        # see `seshet.routing.ModuleRouter`
+        if not self.router.routes(e.command):
+            return
         
         if e.command in ('PRIVMSG', 'CTCP_ACTION', 'NOTICE'):
-            # narrow down list of modules to run based on event parameters
-            
-            # lowercase for non-caps comparisons
-            m_low = e.message.lower()
-            bot_n = self.nickname.lower()
-            bot_u = self.user.lower()
-            bot_r = self.real_name.lower()
+            msg = e.message
+            argv = msg.split(None, 1)
+            if not argv:
+                return
             
-            # indicates whether or not name has already been stripped from
+            # indicates whether or not name has been stripped from
             # original message
             for_us = False
             
-            if e.target.startswith('#'):
-                chan_msg = True
-                chan_nicks = self.channels[e.target].users
-            else:
-                chan_msg = False
+            # look up the first word in the command index, then try again
+            # after stripping the bot's nick, user or real name from the
+            # start of the message
+            found = self.command_index.lookup(argv[0])
+            if not found:
+                # longest first, so a real name like "seshetbot" isn't
+                # taken for the nick "seshet"
+                names = sorted((self.nickname, self.user, self.real_name),
+                               key=len, reverse=True)
+                head = msg[:len(names[0])].lower()
+                for name in names:
+                    if head.startswith(name.lower()):
+                        stripped = msg[len(name):].lstrip(',: ')
+                        argv = stripped.split(None, 1)
+                        if argv:
+                            found = self.command_index.lookup(argv[0])
+                        if found:
+                            # strip name from original message so modules
+                            # can process it correctly
+                            e.message = stripped
+                            for_us = True
+                        break
+            
+            if not found:
+                return
+            cmd = argv[0][1:].lower()
             
-            fin_mods = list()  # final list of modules to run
-            for mod in init_mods:
-                if e.source in mod.whitelist:
-                    fin_mods.append(mod)
+            # every module registering the command runs if its own
+            # filters allow it
+            for mod, fun in found:
+                if e.command not in mod.event_types:
+                    continue
                 
-                elif e.source in mod.blacklist:
-                    pass
+                logging.debug("Command %s matched module %s", argv[0],
+                              mod.name)
                 
-                if self.nickname in mod.enicks:                    
-                    if e.target == self.nickname or for_us:
-                        fin_mods.append(mod)
-                    elif m_low.startswith(bot_n):
-                        # strip nickname from original message so modules can
-                        # process it correctly
-                        e.message = e.message[len(bot_n):].lstrip(',: ')
-                        
-                        fin_mods.append(mod)
-                        for_us = True
-                    elif m_low.startswith(bot_u):
-                        e.message = e.message[len(bot_u):].lstrip(',: ')
-                        
-                        fin_mods.append(mod)
-                        for_us = True
-                    elif m_low.startswith(bot_r):
-                        e.message = e.message[len(bot_r):].lstrip(',: ')
-                        
-                        fin_mods.append(mod)
-                        for_us = True
+                if not self._module_allowed(mod, e, for_us):
+                    continue
                 
-                if chan_msg:
-                    if e.target in mod.dchannels:
-                        pass
-                    elif set(mod.dnicks) & chan_nicks:
-                        pass
-                    elif e.target in mod.echannels:
-                        fin_mods.append(mod)
-                    elif set(mod.enicks) & chan_nicks:
-                        fin_mods.append(mod)
-                        
-            argv = m_low.split()
-            for mod in fin_mods:
-                # run each module
-                m = __import__(mod.name)  # TODO: use importlib
+                # no rate limiting for NOTICEs, which never get replies
+                if (e.command != 'NOTICE'
+                        and not self._rate_allowed(mod, cmd, e)):
+                    continue
                 
-                # TODO: add authentication and rate limiting
+                # TODO: add authentication
                 
-                for cmd, fun in m.commands.items():
-                    if (mod.cmd_prefix + cmd) == argv[0]:
-                        fun(self, e)
-                        break
+                self._run_handler(mod, fun, e, cmd)
+    
+    def _rate_allowed(self, mod, cmd, e):
+        """Check the module's rate limits (see `seshet.ratelimit`) for this
+        command and take a token from each bucket if none are exhausted.
+        """
+        
+        rules = mod.rate_rules
+        rules = rules.get(cmd) or rules.get(None) or ()
+        
+        source, target = self._folded(e)
+        channel = target if e.target.startswith('#') else None
+        
+        return self.rate_limiter.allow(rules, source, channel,
+                                       exempt=source in mod.whitelist)
+    
+    def _run_handler(self, mod, fun, e, cmd):
+        """Run a command handler inline, in a worker thread or in a worker
+        process, depending on the module's `exec_mode`. Handlers decorated
+        with `seshet.workers.inline` always run inline, and coroutine
+        functions always run as tasks on the bot's event loop.
+        """
+        
+        if inspect.iscoroutinefunction(fun):
+            self.run_coroutine(fun(self, e), mod.timeout, mod.name)
+        elif getattr(fun, 'seshet_inline', False):
+            fun(self, e)
+        elif mod.exec_mode == THREAD:
+            self.workers.submit(self, fun, e, mod.timeout, mod.name)
+        elif mod.exec_mode == PROCESS:
+            self.workers.submit_process(self, mod.name, cmd, e, mod.timeout)
+        else:
+            fun(self, e)
+    
+    def run_coroutine(self, coro, timeout=None, name=None):
+        """Run a coroutine as a task on the bot's event loop, cancelling it
+        if it's still running after `timeout` seconds (the worker pool's
+        `default_timeout` if None, or never if 0). Returns the task.
+        """
+        
+        if timeout is None:
+            timeout = self.workers.default_timeout
+        if timeout:
+            coro = asyncio.wait_for(coro, timeout)
+        task = asyncio.ensure_future(coro)
+        task.seshet_name = name or repr(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._task_done)
+        return task
+    
+    def _task_done(self, task):
+        self._tasks.discard(task)
+        if task.cancelled():
+            return
+        exc = task.exception()
+        if isinstance(exc, asyncio.TimeoutError):
+            logging.warning("Handler %s timed out", task.seshet_name)
+        elif exc is not None:
+            logging.error("Error in handler %s", task.seshet_name,
+                          exc_info=(type(exc), exc, exc.__traceback__))
+    
+    def _module_allowed(self, mod, e, for_us):
+        """Apply a module's whitelist, blacklist, and channel and nick
+        enablers and disablers to a message event.
+        """
+        
+        source, target = self._folded(e)
+        bot_nick = self.router.casefold(self.nickname)
+        
+        if source in mod.whitelist:
+            return True
+        elif source in mod.blacklist:
+            return False
+        
+        if bot_nick in mod.enicks and (target == bot_nick or for_us):
+            return True
+        
+        if e.target.startswith('#'):
+            channel = self.channels.get(e.target)
+            if channel is None:
+                return False
+            chan_nicks = channel.users
+            
+            if target in mod.dchannels:
+                return False
+            elif any(n in chan_nicks for n in mod.dnicks):
+                return False
+            elif target in mod.echannels:
+                return True
+            elif any(n in chan_nicks for n in mod.enicks):
+                return True
+        
+        return False
+    
+    def _folded(self, e):
+        """Return the casefolded source and target of an event."""
+        
+        if isinstance(e, Message):
+            # folded when first needed and kept with the message
+            return e.folded_source, e.folded_target
+        fold = self.router.casefold
+        return fold(e.source), fold(e.target)
+    
+    def _module_loaded(self, name, module, action):
+        """Listener for `self.loader`. Runs the module's `handle_startup()`
+        each time it's imported or reloaded, if it's enabled for this bot.
+        On reload, restarts its worker processes so they pick up the new
+        code (the `seshet.runner.Runner` does this for a shared pool) and
+        cancels its timers.
+        """
+        
+        if action == 'reload':
+            if not self._shared_workers:
+                self.workers.restart(name)
+            # the old code's timers; handle_startup() can schedule anew
+            self.timers.cancel_owner(name)
+        # a shared loader tells every bot about every module
+        if not any(r.name == name for r in self.router.all_routes()):
+            return
+        self._started_modules.add(name)
+        self._run_module_hook(module, 'handle_startup')
+    
+    def module_settings(self, module):
+        """Return the `KVNamespace` of a command module (or its name), for
+        modules to keep instead of going through `self.storage`.
+        """
+        
+        if not isinstance(module, str):
+            module = module.__name__
+        # same name KVStore works out from the module's file
+        return self.storage.namespace(module.rsplit('.', 1)[-1])
+    
+    def _run_module_hook(self, module, hook):
+        fun = getattr(module, hook, None)
+        if fun is None:
+            return
+        try:
+            fun(self.db, self.module_settings(module))
+        except Exception:
+            logging.exception("Error in %s.%s()", module.__name__, hook)
+    
+    def load_modules(self):
+        """Import every enabled module so their `handle_startup()` hooks
+        run now rather than on the first event they handle, and start
+        worker processes for modules that run in them.
+        """
+        
+        for mod in self.router.all_routes():
+            m = self.loader.get(mod.name)
+            if m is not None and mod.name not in self._started_modules:
+                # imported before this bot was told, e.g. for another bot
+                # sharing the loader
+                self._started_modules.add(mod.name)
+                self._run_module_hook(m, 'handle_startup')
+            if mod.exec_mode == PROCESS:
+                self.workers.warm(mod.name)
+    
+    def reload_module(self, name):
+        """Reload a command module now, without waiting for its source file
+        to change. Returns the module, or None if it couldn't be imported.
+        """
+        
+        return self.loader.reload(name)
+    
+    def enable_module(self, name):
+        """Globally enable a registered module and run its
+        `handle_enable()` hook.
+        """
+        
+        self._set_module_enabled(name, True)
+        
+    def disable_module(self, name):
+        """Globally disable a registered module, cancel the jobs it has
+        scheduled and run its `handle_disable()` hook.
+        """
+        
+        self._set_module_enabled(name, False)
+    
+    def _set_module_enabled(self, name, enabled):
+        db = self.db
+        if not db(db.modules.name == name).update(enabled=enabled):
+            raise KeyError("No module registered named %s" % name)
+        db.commit()
+        self.router.invalidate()
+        if not enabled:
+            self.timers.cancel_owner(name)
+            if not self._shared_workers:
+                # don't leave the module's worker processes running
+                self.workers.restart(name)
+        
+        m = self.loader.get(name)
+        if m is not None:
+            self._run_module_hook(m, 'handle_enable' if enabled
+                                  else 'handle_disable')
+    
+    def call_later(self, delay, fun, *args, owner=None, timeout=0):
+        """Call `fun(*args)` on the loop thread in `delay` seconds. `owner`
+        is the module (or its name) the job belongs to, so it's cancelled
+        when that module is disabled or reloaded. If `fun` is a coroutine
+        function, its coroutine is cancelled after `timeout` seconds, or
+        never if 0. Returns a `seshet.timers.Job`.
+        """
+        
+        return self.timers.call_later(delay, fun, *args, owner=owner,
+                                      timeout=timeout)
+    
+    def call_at(self, when, fun, *args, owner=None, timeout=0):
+        """Like `call_later()`, at `when` in `time.monotonic()` seconds."""
+        
+        return self.timers.call_at(when, fun, *args, owner=owner,
+                                   timeout=timeout)
+    
+    def call_every(self, interval, fun, *args, owner=None, first=None,
+                   timeout=0):
+        """Like `call_later()`, every `interval` seconds, first after
+        `first` seconds (by default `interval`).
+        """
+        
+        return self.timers.call_every(interval, fun, *args, owner=owner,
+                                      first=first, timeout=timeout)
+    
+    def is_me(self, nick):
+        """Return True if `nick` is the bot's current nickname."""
+        
+        fold = self.casemapping.fold
+        return fold(nick) == fold(self.nickname)
     
     def get_unique_users(self, chan):
         """Get the set of users that are unique to the given channel (i.e. not
         present in any other channel the bot is in).
         """
         
-        chan = IRCstr(chan)
+        return self.membership.unique_users(self.channels[chan])
+    
+    def save_snapshot(self):
+        """Save users, channels and message logs to `self.snapshot_file`."""
+        
+        if not self.snapshot_file:
+            return
+        self._last_snapshot = time.monotonic()
+        try:
+            save_snapshot(self.snapshot_file, self.users, self.channels)
+        except (OSError, ValueError):
+            logging.exception("Couldn't save state snapshot to %s",
+                              self.snapshot_file)
+    
+    def load_snapshot(self):
+        """Open `self.snapshot_file` if it exists. Its channels are restored
+        one at a time as the bot rejoins them and gets their NAMES replies.
+        """
+        
+        if not self.snapshot_file or not os.path.exists(self.snapshot_file):
+            return
+        try:
+            snapshot = Snapshot(self.snapshot_file, self.casemapping.fold)
+        except (OSError, ValueError):
+            logging.exception("Couldn't load state snapshot from %s",
+                              self.snapshot_file)
+            return
+        age = time.time() - snapshot.saved
+        if self.snapshot_max_age and age > self.snapshot_max_age:
+            logging.info("Ignoring state snapshot %s saved %.0fs ago",
+                         self.snapshot_file, age)
+            snapshot.close()
+            return
+        self._snapshot = snapshot
+        logging.info("Loaded state snapshot of %d channels from %s",
+                     len(snapshot), self.snapshot_file)
+    
+    def _autojoined(self, channels):
+        """Called once the autojoin channels have been joined. Only those
+        are restored from the snapshot, within `snapshot_restore_timeout`
+        seconds.
+        """
+        
+        snapshot = self._snapshot
+        if snapshot is None:
+            return
+        snapshot.keep_channels(channels)
+        if not len(snapshot):
+            self._close_snapshot()
+        elif self._snapshot_timer is None:
+            self._snapshot_timer = self.timers.call_later(
+                self.snapshot_restore_timeout, self._close_snapshot)
+    
+    def _close_snapshot(self):
+        snapshot = self._snapshot
+        if snapshot is None:
+            return
+        if len(snapshot):
+            logging.info("Not restoring %s from state snapshot",
+                         ', '.join(snapshot.channel_names()))
+        snapshot.close()
+        self._snapshot = None
+        if self._snapshot_timer is not None:
+            self._snapshot_timer.cancel()
+            self._snapshot_timer = None
+    
+    def _restore_channel(self, channel):
+        """Restore `channel`'s message log and its users' idents and hosts
+        from the loaded snapshot. Membership comes from the fresh NAMES
+        reply, so users who left while the bot was away aren't restored.
+        """
+        
+        snapshot = self._snapshot
+        saved = snapshot.take_channel(channel.name)
+        if saved is not None:
+            _, nicks, log = saved
+            # saved messages came before any logged since joining
+            channel.message_log.merge((t, IRCstr(nick), msg)
+                                      for t, nick, msg in log)
+            for nick in channel.users:
+                u = self.users.get(nick)
+                known = snapshot.user(nick)
+                if u is not None and u.user is None and known is not None:
+                    u.user = known[0] and sys.intern(known[0])
+                    u.host = known[1] and sys.intern(known[1])
+        
+        if not len(snapshot):
+            # every saved channel has been rejoined
+            self._close_snapshot()
+    
+    def memory_usage(self):
+        """Return a `Storage` estimating the bytes used by tracked users and
+        channels. See `seshet.state.memory_usage()`.
+        """
+        
+        return memory_usage(self.users, self.channels, self.membership)
+    
+    def _get_user(self, nick, user=None, host=None):
+        """Return the `SeshetUser` for `nick`, creating it if needed and
+        filling in its user and host if they weren't known.
+        """
+        
+        u = self.users.get(nick)
+        if u is None:
+            u = self.users[nick] = SeshetUser(nick, user, host,
+                                              self.membership)
+        elif user is not None and u.user is None:
+            u.user = sys.intern(user)
+            u.host = host and sys.intern(host)
+        return u
+    
+    def _remove_from_channel(self, nick, chan):
+        """Remove `nick` from `chan` after a PART or KICK. If it's the bot
+        leaving, drop the channel and every user only seen there.
+        """
         
-        these_users = self.channels[chan].users
-        other_users = set()
-        for c in self.channels.values():
-            if c.name != chan:
-                other_users |= c.users
+        channel = self.channels.get(chan)
+        if channel is None:
+            return
         
-        return these_users - other_users
+        if self.is_me(nick):
+            self.sync.forget(chan)
+            for n in self.membership.drop_channel(channel):
+                self.users.pop(n, None)
+            del self.channels[chan]
+        elif self.membership.part(nick, channel):
+            # no longer in any channel we can see
+            self.users.pop(nick, None)
     
     def on_message(self, e):
         self.log('privmsg',
@@ -309,12 +723,10 @@ class SeshetBot(bot.SimpleBot):
                  hostmask=e.user+'@'+e.host,
                  )
                  
-        chan = IRCstr(e.target)
-        nick = IRCstr(e.source)
-        if e.source != self.nickname:
-            if nick not in self.users:
-                self.users[nick] = SeshetUser(nick, e.user, e.host)
-            self.users[nick].join(self.channels[chan])
+        # the bot's own membership is added from the NAMES reply
+        if not self.is_me(e.source) and e.target in self.channels:
+            user = self._get_user(e.source, e.user, e.host)
+            user.join(self.channels[e.target])
                  
         self.run_modules(e)
     
@@ -322,83 +734,62 @@ class SeshetBot(bot.SimpleBot):
         self.log('part',
                  source=e.source,
                  hostmask=e.user+'@'+e.host,
-                 msg=' '.join(e.params[1:]),
+                 msg=e.params[-1] if e.params else '',
                  target=e.target,
                  )
         
-        chan = IRCstr(e.target)
-        nick = IRCstr(e.source)
-        channel = self.channels[chan]
-        user = self.users[nick]
-        
-        user.part(channel)
-        if nick == self.nickname:
-            # bot parted, remove that channel from all users and
-            # remove any users with empty channel lists
-            for u in self.users.values():
-                if channel in u.channels:
-                    u.channels.remove(channel)
-                if len(u.channels) == 0:
-                    del self.users[u.nick]
+        self._remove_from_channel(e.source, e.target)
     
     def on_quit(self, e):
-        nick = IRCstr(e.source)
-        
-        for chan in self.channels.values():
-            if nick in chan.users:
-                self.log('quit',
-                         source=e.source,
-                         hostmask=e.user+'@'+e.host,
-                         msg=' '.join(e.params),
-                         target=chan.name,
-                         )
-                         
-        self.users[nick].quit()
-        del self.users[nick]
+        nick = e.source
+        reason = e.params[-1] if e.params else ''
+        
+        for chan in self.membership.quit(nick):
+            self.log('quit',
+                     source=e.source,
+                     hostmask=e.user+'@'+e.host,
+                     msg=reason,
+                     target=chan.name,
+                     )
+        
+        self.users.pop(nick, None)
     
     def on_disconnect(self, e):
-        pass
+        if self.event_log is not None:
+            self.event_log.flush()
+        if self._file_log is not None:
+            self._file_log.close()
     
     def on_kick(self, e):
         self.log('kick',
                  source=e.source,
                  target=e.target,
                  params=e.params[0],
-                 msg=' '.join(e.params[1:]),
+                 msg=e.params[1] if len(e.params) > 1 else '',
                  hostmask=e.user+'@'+e.host,
                  )
         
-        chan = IRCstr(e.target)
-        nick = IRCstr(e.source)
-        channel = self.channels[chan]
-        user = self.users[nick]
-        
-        user.part(channel)
-        if nick == self.nickname:
-            # bot parted, remove that channel from all users and
-            # remove any users with empty channel lists
-            for u in self.users.values():
-                if channel in u.channels:
-                    u.channels.remove(channel)
-                if len(u.channels) == 0:
-                    del self.users[u.nick]
+        # the kicked nick is the first parameter, not the source
+        self._remove_from_channel(e.params[0], e.target)
     
     def on_nick_change(self, e):
-        new_nick = IRCstr(e.target)
-        old_nick = IRCstr(e.source)
-        
-        for chan in self.channels.values():
-            if e.source in chan.user_list:
-                self.log('nick',
-                         source=e.source,
-                         hostmask=e.user+'@'+e.host,
-                         target=chan.name,
-                         params=e.target,
-                         )
-        
-        self.users[old_nick].change_nick(new_nick)
-        self.users[new_nick] = self.users[old_nick]
-        del self.users[old_nick]
+        new_nick = e.target
+        old_nick = e.source
+        
+        for chan in self.membership.channels_of(old_nick):
+            self.log('nick',
+                     source=e.source,
+                     hostmask=e.user+'@'+e.host,
+                     target=chan.name,
+                     params=e.target,
+                     )
+        
+        user = self.users.pop(old_nick, None)
+        if user is not None:
+            user.change_nick(new_nick)
+            self.users[new_nick] = user
+        else:
+            self.membership.rename(old_nick, new_nick)
     
     def on_ctcp_action(self, e):
         self.log('action',
@@ -425,10 +816,25 @@ class SeshetBot(bot.SimpleBot):
         """Called each loop after polling sockets for I/O and
         handling any queued events.
         """
-        pass
+        self.workers.process()
+        if (self.snapshot_interval and time.monotonic() - self._last_snapshot
+                > self.snapshot_interval):
+            self.save_snapshot()
+        self.rate_limiter.evict_idle()
+        if self.event_log is not None:
+            self.event_log.flush_due()
+        if isinstance(self.storage, KVStore):
+            self.storage.flush_due()
+        if self.loader is not None:
+            self.loader.check()
+        if self._file_log is not None:
+            self._file_log.flush_due()
     
     def connect(self, *args, **kwargs):
-        """Extend `client.SimpleClient.connect()` with defaults"""
+        """Replace `client.SimpleClient.connect()`, using defaults for
+        missing arguments and a `seshet.engine.AsyncConnection`. The
+        connection is opened by `start()` or `run()`.
+        """
         defaults = {}
 
         for i, k in enumerate(('host', 'port', 'channel', 'use_ssl', 'password')):
@@ -451,36 +857,137 @@ class SeshetBot(bot.SimpleBot):
                      defaults['port'],
                      defaults['channel'],
                      )
-        client.SimpleClient.connect(self, **defaults)
+        conn = self.conn = AsyncConnection()
+        conn.ssl_verify = self.ssl_verify
+        self.outbound.attach(conn)
+        conn.parser.casefold = self.casemapping.fold
+        conn.handle_message = self._dispatch_message
+        conn.handle_line = self._dispatch_event
+        conn.handle_connect = self._handle_connect
+        conn.handle_close = self._handle_disconnect
+        conn.connect(defaults['host'], defaults['port'],
+                     defaults['use_ssl'], defaults['password'])
+        self.sync.start()
+        conn.execute("USER", self.user, self._mode, "*",
+                     trailing=self.real_name)
+        conn.execute("NICK", self.nickname)
+        
+        channels = defaults['channel']
+        if channels is None:
+            channels = []
+        elif isinstance(channels, str):
+            channels = [channels]
+        
+        def _auto_joiner(client, event):
+            for channel in channels:
+                client.join_channel(channel)
+            client._autojoined(channels)
+        
+        self.events["welcome"].add_handler(_auto_joiner)
+    
+    def _dispatch_message(self, msg):
+        """Dispatch a `seshet.parser.Message` as an event, as
+        `client.SimpleClient._dispatch_event()` does with the parts of a
+        line, without building an ircutils3 event for it. CTCP and
+        formatting are only looked for in messages that contain them.
+        """
+        
+        if msg.command not in ("PRIVMSG", "NOTICE"):
+            self.events.dispatch(self, msg)
+            return
+        
+        text = msg.message
+        ctcp_requests = ()
+        if ctcp.X_DELIM in text:
+            text, ctcp_requests = ctcp.extract(text)
+        if self.filter_formatting and _formatting.search(text):
+            text = format.filter(text)
+        if text.strip():
+            msg.message = text
+            self.events.dispatch(self, msg)
+        for command, params in ctcp_requests:
+            self.events.dispatch(self, msg.derive("CTCP_%s" % command,
+                                                  params))
+    
+    def _handle_connect(self):
+        self.events.dispatch(self, events.ConnectionEvent("CONN_CONNECT"))
+    
+    def _handle_disconnect(self):
+        self.events.dispatch(self, events.ConnectionEvent("CONN_DISCONNECT"))
 
+    def disconnect(self, message=None):
+        """Extend `client.SimpleClient.disconnect()` to save a snapshot
+        first and to keep `channels` an `IRCDict`.
+        """
+        
+        self.save_snapshot()
+        super().disconnect(message)
+        self.channels = IRCDict(casemapping=self.casemapping)
+        self.users = IRCDict(casemapping=self.casemapping)
+        self.membership = Membership(self.casemapping)
+    
     def start(self):
-        logging.debug("Beginning poll loop")
-        self._loop(self.conn._map)
+        """Run the bot on a new event loop until it's disconnected."""
+        asyncio.run(self.run())
+    
+    async def run(self):
+        """Open the connection set up by `connect()` and run until it's
+        closed, on the running event loop. Use this instead of `start()` to
+        run the bot alongside other tasks.
+        """
+        
+        if self.loader is not None:
+            self.load_modules()
+        self.load_snapshot()
+        
+        loop = asyncio.get_running_loop()
+        if not self._shared_workers:
+            self.workers.wakeup = lambda: loop.call_soon_threadsafe(self.wake)
+        self.conn.on_received = self.wake
+        self.timers.wakeup = lambda: loop.call_soon_threadsafe(self.wake)
+        
+        logging.debug("Beginning event loop")
+        try:
+            await self.conn.open()
+            await self._loop(loop)
+        finally:
+            self.timers.wakeup = None
+            for task in list(self._tasks):
+                task.cancel()
+            if self.channels:
+                self.save_snapshot()
+            self._close_snapshot()
+            if not self._shared_workers:
+                self.workers.wakeup = None
+                self.workers.shutdown()
+            if isinstance(self.storage, KVStore):
+                self.storage.flush()
+            if self.event_log is not None:
+                self.event_log.flush()
+            if self._file_log is not None:
+                self._file_log.close()
     
     def _log_to_file(self, etype, source, msg='', target='', hostmask='', params=''):
         """Override `log()` if bot is not initialized with a database
         connection. Do not call this method directly.
+        
+        Lines are written through a `seshet.eventlog.FileLogSink` built from
+        `self.log_file`, `self.log_formats` and `self.locale` on first use.
         """
-        today = datetime.utcnow()
         # TODO: Use self.locale['timezone'] for changing time
-        date = today.strftime(self.locale['date_fmt'])
-        time = today.strftime(self.locale['time_fmt'])
-        datetime_s = today.strftime(self.locale['short_datetime_fmt'])
-        datetime_l = today.strftime(self.locale['long_datetime_fmt'])
+        sink = self._file_log
+        if sink is None:
+            sink = self._file_log = FileLogSink(self.log_file,
+                                                self.log_formats,
+                                                self.locale,
+                                                self.log_max_open_files,
+                                                self.log_flush_interval,
+                                                )
         
         if target == self.nickname and etype in ('privmsg', 'action'):
             target = source
 
-        if etype in self.log_formats:
-            file_path = os.path.expanduser(self.log_file.format(**locals()))
-            file_dir = os.path.dirname(file_path)
-            if not os.path.isdir(file_dir):
-                os.makedirs(file_dir)
-
-            line = self.log_formats[etype].format(**locals())
-            with open(file_path, 'a') as log:
-                log.write(line+'\n')
-        # else do nothing
+        sink.write(etype, source, msg, target, hostmask, params)
     
     def _run_only_core(self, *args, **kwargs):
         """Override `_run_commands()` if bot is not initialized with a
@@ -499,27 +1006,103 @@ class SeshetBot(bot.SimpleBot):
         """
         pass
 
-    def _loop(self, map):
-        """The main loop. Poll sockets for I/O and run any other functions
+    async def _loop(self, loop):
+        """The main loop. Wait for lines to be received, for a wakeup or
+        for the poll timeout, then run due timers and any other functions
         that need to be run every loop.
         """
-        try:
-            from asyncore import poll
-        except ImportError:
-            raise Exception("Couldn't find poll function. Cannot start bot.")
-    
-        while map:
+        
+        conn = self.conn
+        while not conn.closed:
             self.before_poll()
-            poll(timeout=30.0, map=map)
+            waiter = self._waiter = loop.create_future()
+            timer = loop.call_later(self._poll_timeout(), self.wake)
+            try:
+                await waiter
+            finally:
+                timer.cancel()
+                self._waiter = None
+            self.timers.run_due()
             self.after_poll()
+    
+    def wake(self):
+        """End the current wait of the main loop so `after_poll()` runs
+        soon. Must be called from the loop thread.
+        """
+        
+        waiter = self._waiter
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
+    
+    def _poll_timeout(self):
+        """Return how long the main loop may wait for: until the next timer
+        is due, and no more than a second. Shortened while handlers are
+        running in workers so their replies go out promptly. The loop also
+        wakes when lines are received or workers finish.
+        """
+        
+        if self.workers.busy():
+            return self.timers.timeout(0.05)
+        return self.timers.timeout(1.0)
 
 
 def _add_channel_names(client, e):
-        """Add a new channel to self.channels and initialize its user list.
+        """Add a new channel to self.channels and initialize its user list,
+        with idents and hosts if the server sent them (see `seshet.sync`).
 
         Called as event handler for RPL_NAMES events. Do not call directly.
         """
 
-        chan = IRCstr(e.channel)
-        names = set([IRCstr(n) for n in e.name_list])
-        client.channels[chan] = SeshetChannel(chan, names)
\ No newline at end of file
+        channel = client.channels.get(e.channel)
+        if channel is None:
+            channel = SeshetChannel(e.channel,
+                                    IRCSet(casemapping=client.casemapping),
+                                    client.message_log_size)
+            client.channels[e.channel] = channel
+        else:
+            # fresh NAMES for a channel we already know; rebuild its
+            # memberships but keep the channel and its message log
+            fold = client.casemapping.fold
+            names = set(map(fold, e.name_list))
+            for n in client.membership.drop_channel(channel):
+                if fold(n) not in names:
+                    client.users.pop(n, None)
+
+        for n in e.name_list:
+            user, host = e.hosts.get(n, (None, None))
+            client._get_user(n, user, host).join(channel)
+        
+        if client._snapshot is not None:
+            client._restore_channel(channel)
+
+
+def _handle_isupport(client, e):
+    """Record the tokens of RPL_ISUPPORT (005) replies in `client.isupport`
+    and switch to the server's CASEMAPPING.
+
+    Called as event handler for RPL_ events. Do not call directly.
+    """
+
+    # ircutils3 names 005 after its RFC 2812 meaning
+    if e.command not in ('RPL_BOUNCE', 'RPL_ISUPPORT'):
+        return
+
+    # last parameter is "are supported by this server"
+    for token in e.params[:-1]:
+        if token.startswith('-'):
+            client.isupport.pop(token[1:].upper(), None)
+            continue
+        name, _, value = token.partition('=')
+        client.isupport[name.upper()] = value or True
+
+    mapping = client.isupport.get('CASEMAPPING')
+    if mapping and mapping != client.casemapping.name:
+        if mapping in casemappings:
+            logging.info("Using %s case mapping", mapping)
+            client.casemapping.set(mapping)
+            if client.router is not None:
+                # routes hold names casefolded with the old mapping
+                client.router.invalidate()
+        else:
+            logging.warning("Unknown CASEMAPPING %s, keeping %s",
+                            mapping, client.casemapping.name)
\ No newline at end of file
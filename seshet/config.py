@@ -6,6 +6,12 @@ from configparser import ConfigParser
 
 from pydal import DAL, Field
 
+from .ratelimit import RateLimiter
+from .kvbackends import open_backend
+from .outbound import OutboundQueue
+from .sync import default_caps
+from .utils import KVStore
+
 
 default_config = """
 [connection]
@@ -14,6 +20,15 @@ server: chat.freenode.net
 port: 6667
 channels: #botwar
 ssl: False
+# check the server's certificate when ssl is on
+ssl_verify: True
+# flood control: lines per second after a burst of send_burst lines
+send_rate: 1
+send_burst: 5
+# join short messages queued for the same target into one line
+merge_lines: False
+# IRCv3 capabilities to ask for (see seshet.sync); empty to skip CAP
+caps: multi-prefix userhost-in-names
 
 [client]
 nickname: Seshet
@@ -42,10 +57,36 @@ long_datetime_fmt: %A %d %B %Y at %H:%M:%S %Z
 [database]
 use_db: True
 db_string: sqlite://seshet.db
+# event log rows are written in batches of up to this many rows...
+log_batch_size: 100
+# ...or after this many seconds, whichever comes first
+log_flush_interval: 5
+# rows kept while the database can't be written to; the oldest are
+# dropped beyond this
+log_queue_size: 10000
+# seconds between re-reading the modules table for changes made elsewhere
+module_refresh: 60
+# seconds between checking loaded modules' source files for changes
+module_check: 2
+# where modules' key/value stores are kept: pydal (tables in this
+# database), sqlite or dbm (in the file kv_path), or memory (not saved)
+kv_backend: pydal
+kv_path:
+# how values are encoded: pickle (anything), marshal (plain builtins,
+# faster) or json; values marshal or json can't encode are pickled
+kv_codec: pickle
+# values cached per module key/value namespace; 0 disables the cache and
+# writes each change immediately
+kv_cache_size: 0
+# seconds between writing cached changes to the database
+kv_flush_interval: 5
 
 [logging]
 # if using db, this will be ignored
 file: logs/%(target)s_%(date)s.log
+# log files kept open at once, and seconds between flushing them
+max_open_files: 32
+flush_interval: 1
 privmsg: [{time}] <{source}> {msg}
 join: [{time}] -- {source} ({hostmask}) has joined
 part: [{time}] -- {source} ({hostmask}) has left ({msg})
@@ -55,6 +96,42 @@ mode: [{time}] -- {source} ({hostmask}) has set mode {parms} on {target}
 nick: [{time}] -- {source} is now known as {parms}
 action: [{time}] * {source} {msg}
 
+[workers]
+# handlers of modules with exec_mode 'thread' run in this many threads
+threads: 4
+# handler calls allowed to wait for a free thread
+queue: 32
+# default seconds before a handler is abandoned
+timeout: 30
+# worker processes for each module with exec_mode 'process'
+processes: 1
+
+[ratelimit]
+# bot-wide limit of commands from all modules: this many per period
+# (seconds); 0 to disable. Per-module limits are in the modules table.
+global_commands: 0
+global_period: 0
+# most user/channel buckets kept in memory at once
+max_keys: 10000
+
+[state]
+# recent messages kept in memory for each channel
+message_log_size: 100
+# users, channels and message logs are saved here on shutdown and
+# restored when the bot rejoins; leave empty to disable
+snapshot_file:
+# seconds between saving snapshots while running; 0 for shutdown only
+snapshot_interval: 300
+# snapshots older than this many seconds aren't restored; 0 for any age
+snapshot_max_age: 3600
+# seconds after autojoin to wait for saved channels to be rejoined before
+# the rest of the snapshot is given up on
+snapshot_restore_timeout: 60
+# send one WHO for each channel joined to learn its members' hosts,
+# with at most who_max_pending waiting for replies at once
+who_on_join: True
+who_max_pending: 1
+
 [debug]
 use_debug: False
 # corresponds to levels in logging module
@@ -70,6 +147,15 @@ server: chat.freenode.net
 port: 6667
 channels: #botwar
 ssl: False
+# check the server's certificate when ssl is on
+ssl_verify: True
+# flood control: lines per second after a burst of send_burst lines
+send_rate: 1
+send_burst: 5
+# join short messages queued for the same target into one line
+merge_lines: False
+# IRCv3 capabilities to ask for (see seshet.sync); empty to skip CAP
+caps: multi-prefix userhost-in-names
 
 [client]
 nickname: Seshet
@@ -98,10 +184,15 @@ long_datetime_fmt: %A %d %B %Y at %H:%M:%S %Z
 [database]
 # no db connection for testing
 use_db: False
+# modules' key/value stores are kept in memory
+kv_backend: memory
 
 [logging]
 # if using db, this will be ignored
 file: ~/.seshet/logs/{target}_{date}.log
+# log files kept open at once, and seconds between flushing them
+max_open_files: 32
+flush_interval: 1
 privmsg: [{time}] <{source}> {msg}
 join: [{time}] -- {source} ({hostmask}) has joined
 part: [{time}] -- {source} ({hostmask}) has left ({msg})
@@ -111,6 +202,24 @@ mode: [{time}] -- {source} ({hostmask}) has set mode {msg} on {target}
 nick: [{time}] -- {source} is now known as {params}
 action: [{time}] * {source} {msg}
 
+[state]
+# recent messages kept in memory for each channel
+message_log_size: 100
+# users, channels and message logs are saved here on shutdown and
+# restored when the bot rejoins; leave empty to disable
+snapshot_file:
+# seconds between saving snapshots while running; 0 for shutdown only
+snapshot_interval: 300
+# snapshots older than this many seconds aren't restored; 0 for any age
+snapshot_max_age: 3600
+# seconds after autojoin to wait for saved channels to be rejoined before
+# the rest of the snapshot is given up on
+snapshot_restore_timeout: 60
+# send one WHO for each channel joined to learn its members' hosts,
+# with at most who_max_pending waiting for replies at once
+who_on_join: True
+who_max_pending: 1
+
 [debug]
 # corresponds to levels in logging module
 verbosity: debug
@@ -150,15 +259,22 @@ def build_db_tables(db):
                     Field('cmd_prefix', length=1, default='!', notnull=True),
                     Field('acl', 'json'),
                     Field('rate_limit', 'json'),
+                    # 'inline', 'thread' or 'process'; see seshet.workers
+                    Field('exec_mode', length=16, default='inline'),
+                    # seconds before a handler run in a worker is abandoned
+                    Field('timeout', 'double'),
                     )
         
 
-def build_bot(config_file=None):
+def build_bot(config_file=None, workers=None, loader=None):
     """Parse a config and return a SeshetBot instance. After, the bot can be run
     simply by calling .connect() and then .start()
     
     Optional arguments:
         config_file - valid file path or ConfigParser instance
+        workers, loader - HandlerPool and ModuleLoader shared with other
+            bots; see seshet.runner. The [workers] section and
+            module_check setting are then left to their owner.
         
         If config_file is None, will read default config defined in this module.
     """
@@ -190,6 +306,8 @@ def build_bot(config_file=None):
     else:
         db = None
         log_file = log_conf.pop('file')
+        max_open_files = int(log_conf.pop('max_open_files', 32))
+        log_flush_interval = float(log_conf.pop('flush_interval', 1.0))
         log_fmts = dict(log_conf)
         
     # debug logging
@@ -202,19 +320,95 @@ def build_bot(config_file=None):
                   }
     lvl = int(debug_lvls[verbosity])
     
-    seshetbot = bot.SeshetBot(client_conf['nickname'], db, debug_file, lvl)
+    seshetbot = bot.SeshetBot(client_conf['nickname'], db, debug_file, lvl,
+                              workers, loader)
 
     # connection info for connect()
     seshetbot.default_host = conn_conf['server']
     seshetbot.default_port = int(conn_conf['port'])
     seshetbot.default_channel = conn_conf['channels'].split(',')
     seshetbot.default_use_ssl = conn_conf.getboolean('ssl')
+    seshetbot.ssl_verify = conn_conf.getboolean('ssl_verify', fallback=True)
+    seshetbot.outbound = OutboundQueue(
+        conn_conf.getfloat('send_rate', fallback=1.0),
+        conn_conf.getint('send_burst', fallback=5),
+        conn_conf.getboolean('merge_lines', fallback=False),
+        )
+    seshetbot.sync.caps = conn_conf.get('caps', fallback=' '.join(
+        default_caps)).split()
 
     # client info
     seshetbot.user = client_conf['user']
     seshetbot.real_name = client_conf['realname']
 
+    # module routing
+    if db is not None:
+        seshetbot.router.max_age = db_conf.getfloat('module_refresh',
+                                                    fallback=60.0)
+        if loader is None:
+            seshetbot.loader.check_interval = db_conf.getfloat(
+                'module_check', fallback=2.0)
+
+    # module key/value stores
+    # (the bot starts with the pydal backend, or memory without a db)
+    default_backend = 'pydal' if db is not None else 'memory'
+    kv_backend = db_conf.get('kv_backend') or default_backend
+    kv_cache_size = db_conf.getint('kv_cache_size', fallback=0)
+    kv_codec = db_conf.get('kv_codec') or 'pickle'
+    if (kv_backend != default_backend or kv_cache_size
+            or kv_codec != 'pickle'):
+        backend = open_backend(kv_backend, db, db_conf.get('kv_path'))
+        seshetbot.storage = KVStore(
+            backend, kv_cache_size,
+            db_conf.getfloat('kv_flush_interval', fallback=5.0),
+            kv_codec)
+
+    # module handler workers
+    if workers is None and config.has_section('workers'):
+        workers_conf = config['workers']
+        pool = seshetbot.workers
+        pool.max_workers = workers_conf.getint('threads', fallback=4)
+        pool.max_queued = workers_conf.getint('queue', fallback=32)
+        pool.default_timeout = workers_conf.getfloat('timeout', fallback=30.0)
+        pool.processes = workers_conf.getint('processes', fallback=1)
+
+    # rate limiting
+    if config.has_section('ratelimit'):
+        rl_conf = config['ratelimit']
+        seshetbot.rate_limiter = RateLimiter(
+            rl_conf.getint('global_commands', fallback=0),
+            rl_conf.getfloat('global_period', fallback=0),
+            rl_conf.getint('max_keys', fallback=10000),
+            )
+
+    # network state
+    if config.has_section('state'):
+        state_conf = config['state']
+        seshetbot.message_log_size = state_conf.getint('message_log_size',
+                                                       fallback=100)
+        seshetbot.snapshot_file = state_conf.get('snapshot_file') or None
+        seshetbot.snapshot_interval = state_conf.getfloat('snapshot_interval',
+                                                          fallback=0.0)
+        seshetbot.snapshot_max_age = state_conf.getfloat('snapshot_max_age',
+                                                         fallback=3600.0)
+        seshetbot.snapshot_restore_timeout = state_conf.getfloat(
+            'snapshot_restore_timeout', fallback=60.0)
+        seshetbot.sync.who_on_join = state_conf.getboolean('who_on_join',
+                                                           fallback=True)
+        seshetbot.sync.max_pending = state_conf.getint('who_max_pending',
+                                                       fallback=1)
+
     # logging info
+    if db is not None:
+        seshetbot.event_log.max_rows = db_conf.getint('log_batch_size',
+                                                      fallback=100)
+        seshetbot.event_log.max_delay = db_conf.getfloat('log_flush_interval',
+                                                         fallback=5.0)
+        seshetbot.event_log.max_queued = db_conf.getint('log_queue_size',
+                                                        fallback=10000)
+    else:
+        seshetbot.log_max_open_files = max_open_files
+        seshetbot.log_flush_interval = log_flush_interval
     seshetbot.log_file = log_file
     seshetbot.log_formats = log_fmts
     seshetbot.locale = dict(config['locale'])
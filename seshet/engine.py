@@ -0,0 +1,264 @@
+"""Run a bot's IRC connection on an asyncio event loop.
+
+`AsyncConnection` replaces `ircutils3.connection.Connection`, which is
+built on asyncore. It has the same interface as far as
+`ircutils3.client.SimpleClient` uses it: `execute()`, `connected`,
+`close_when_done()`, and the `handle_line`, `handle_connect` and
+`handle_close` callbacks. PINGs are answered automatically.
+
+Received data is split and parsed by a `seshet.parser.Parser`. Set
+`handle_message` to be passed each `seshet.parser.Message` rather than
+its parts through `handle_line`.
+
+Lines passed to `execute()` are buffered and written together once per
+pass of the event loop. While the transport's own buffer is over its high
+water mark, lines stay buffered here until it drains. TLS is done by the
+transport, so a slow handshake doesn't block other connections.
+
+Set `outbound` to a `seshet.outbound.OutboundQueue` to pace what's sent;
+`execute()` then queues lines there and the queue passes them back to
+`send_line()` when it's their turn.
+
+`SeshetBot.connect()` creates the connection and `SeshetBot.run()` opens
+it on the running loop.
+"""
+
+import asyncio
+import logging
+import ssl
+
+from .parser import Parser
+from .utils import Storage
+
+
+class IRCProtocol(asyncio.Protocol):
+    """Pass the data received on a transport to an `AsyncConnection`."""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def connection_made(self, transport):
+        self.conn._made(transport)
+
+    def data_received(self, data):
+        self.conn._received(data)
+
+    def connection_lost(self, exc):
+        self.conn._lost(exc)
+
+    def pause_writing(self):
+        self.conn._paused = True
+
+    def resume_writing(self):
+        self.conn._resume()
+
+
+class AsyncConnection(object):
+    """A connection to one IRC server on an asyncio event loop.
+
+    `connect()` only records where to connect; lines executed before the
+    connection is opened with `open()` are sent as soon as it is. Set
+    `on_received` to a callable to be called after each batch of lines
+    has been handled.
+    """
+
+    def __init__(self):
+        self.ping_auto_respond = True
+        self.ssl_verify = True
+        self.hostname = None
+        self.port = None
+        self.use_ssl = False
+        self.connected = False
+        self.closed = False
+        self.on_received = None
+        self.outbound = None
+        self.handle_message = None
+        self.parser = Parser()
+
+        self.transport = None
+        self._loop = None
+        self._out = []
+        self._flush_pending = False
+        self._paused = False
+        self._closing = False
+        self._lost_waiter = None
+
+        # statistics
+        self.lines_in = 0
+        self.lines_out = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def connect(self, hostname, port=None, use_ssl=False, password=None):
+        """Set the server to connect to. If a password is given, it's sent
+        first once connected.
+        """
+
+        self.hostname = hostname
+        self.port = port or (6697 if use_ssl else 6667)
+        self.use_ssl = use_ssl
+        if password is not None:
+            self.execute("PASS", password)
+
+    def ssl_context(self):
+        """Return the `ssl.SSLContext` used for TLS connections."""
+
+        context = ssl.create_default_context()
+        if not self.ssl_verify:
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+        return context
+
+    async def open(self):
+        """Open the connection on the running event loop."""
+
+        loop = self._loop = asyncio.get_running_loop()
+        self._lost_waiter = loop.create_future()
+        context = self.ssl_context() if self.use_ssl else None
+        await loop.create_connection(lambda: IRCProtocol(self),
+                                     self.hostname, self.port, ssl=context)
+
+    async def wait_closed(self):
+        """Wait until the connection has been closed."""
+
+        if self._lost_waiter is not None:
+            await self._lost_waiter
+
+    def execute(self, command, *params, **kwargs):
+        """Queue an IRC command to be sent. A trailing parameter is given as
+        a keyword argument, as with `ircutils3.connection.Connection`:
+
+            >>> conn.execute("PRIVMSG", "#channel", trailing="Hello!")
+        
+        With an `outbound` queue, keyword argument `priority` overrides
+        the line's priority class.
+        """
+
+        params = [x for x in params if x is not None]
+        trailing = kwargs.get("trailing")
+        if self.outbound is not None:
+            self.outbound.put(command, params, trailing,
+                              kwargs.get("priority"))
+        else:
+            self.send_line(command, params, trailing)
+
+    def send_line(self, command, params, trailing=None):
+        """Send a command now, bypassing `outbound`."""
+
+        if trailing is not None:
+            params = params + [":%s" % trailing]
+        cmd_line = "%s %s\r\n" % (command.upper(), " ".join(params))
+        self.push(cmd_line.encode('utf-8', errors='ignore'))
+
+    def push(self, data):
+        """Queue raw bytes to be sent."""
+
+        self._out.append(data)
+        if self.connected and not self._flush_pending:
+            self._flush_pending = True
+            self._loop.call_soon(self._flush)
+
+    def can_write(self):
+        """True if connected and the transport isn't over its high water
+        mark.
+        """
+        return self.connected and not self._paused
+
+    def close_when_done(self):
+        """Close the connection once everything queued has been sent."""
+
+        self._closing = True
+        if self.connected:
+            self._flush()
+
+    def _flush(self):
+        self._flush_pending = False
+        transport = self.transport
+        if transport is None or transport.is_closing():
+            return
+        if self._out and not self._paused:
+            out = self._out
+            self._out = []
+            self.lines_out += len(out)
+            data = b''.join(out)
+            self.bytes_out += len(data)
+            transport.write(data)
+        if self._closing and not self._out:
+            # the transport writes what it has buffered before closing
+            transport.close()
+
+    def _made(self, transport):
+        self.transport = transport
+        self.connected = True
+        self.handle_connect()
+        self._flush()
+        if self.outbound is not None:
+            self.outbound.pump()
+
+    def _resume(self):
+        self._paused = False
+        self._flush()
+        if self.outbound is not None:
+            self.outbound.pump()
+
+    def _received(self, data):
+        self.bytes_in += len(data)
+        messages = self.parser.feed(data)
+        self.lines_in += len(messages)
+        for msg in messages:
+            try:
+                self._handle_message(msg)
+            except Exception:
+                logging.exception("Error handling line %r", msg.line)
+        if self.on_received is not None:
+            self.on_received()
+
+    def _handle_message(self, msg):
+        if msg.command == "PING" and self.ping_auto_respond:
+            self.execute("PONG", *msg.args)
+        if self.handle_message is not None:
+            self.handle_message(msg)
+        else:
+            self.handle_line(msg.prefix, msg.command, msg.args)
+
+    def _lost(self, exc):
+        if exc is not None:
+            logging.warning("Connection to %s lost: %s", self.hostname, exc)
+        self.connected = False
+        self.closed = True
+        self.transport = None
+        if self.outbound is not None:
+            self.outbound.clear()
+        try:
+            self.handle_close()
+        finally:
+            if not self._lost_waiter.done():
+                self._lost_waiter.set_result(None)
+            if self.on_received is not None:
+                self.on_received()
+
+    def handle_line(self, prefix, command, params):
+        """Called with the parts of each line received, unless
+        `handle_message` is set. Meant to be replaced, as
+        `SimpleClient.connect()` does.
+        """
+
+        raise NotImplementedError("handle_line() must be overridden.")
+
+    def handle_connect(self):
+        """Called once the connection has been made."""
+        pass
+
+    def handle_close(self):
+        """Called once the connection has been closed."""
+        pass
+
+    def stats(self):
+        """Return a `Storage` of line and byte counts in each direction."""
+
+        return Storage(lines_in=self.lines_in,
+                       lines_out=self.lines_out,
+                       bytes_in=self.bytes_in,
+                       bytes_out=self.bytes_out,
+                       queued=len(self._out),
+                       )
@@ -0,0 +1,352 @@
+"""Buffered sinks for the bot's IRC event log.
+
+`EventLogWriter` collects rows for the `event_log` table and writes them
+to the database in batches instead of committing after every event.
+
+`FileLogSink` is used instead when the bot has no database connection. It
+writes formatted lines to per-target log files, keeping recently used files
+open between events.
+"""
+
+import logging
+import os
+import string
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+from .utils import Storage
+
+
+class EventLogWriter(object):
+    """Queue `event_log` rows and insert them in multi-row transactions.
+
+    Rows are written when the queue reaches `max_rows`, when the oldest
+    queued row is older than `max_delay` seconds (checked by `flush_due()`,
+    normally from `SeshetBot.after_poll()`), or when `flush()` is called
+    directly, e.g. on disconnect or shutdown.
+
+    After a write fails, only `flush_due()` tries again, waiting twice as
+    long after each failure, up to `max_backoff` seconds. While the
+    database is unavailable the queue holds no more than `max_queued` rows;
+    the oldest are dropped to make room and counted in `stats()`.
+    """
+
+    def __init__(self, db, max_rows=100, max_delay=5.0, max_queued=10000,
+                 max_backoff=300.0):
+        self._db = db
+        self._queue = []
+        self._oldest = None
+        self._backoff = 0.0
+        self._retry_at = None
+        self._dropped = 0       # since the last successful write
+
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        self.max_queued = max_queued
+        self.max_backoff = max_backoff
+
+        # statistics
+        self.flushes = 0
+        self.rows_written = 0
+        self.rows_dropped = 0
+        self.failed_flushes = 0
+        self.last_flush_time = 0.0
+        self.max_flush_time = 0.0
+        self.total_flush_time = 0.0
+
+    @property
+    def queued(self):
+        """Number of rows waiting to be written."""
+        return len(self._queue)
+
+    def append(self, etype, source, msg='', target='', hostmask='', params=''):
+        """Queue one row. Takes the same arguments as `SeshetBot.log()`."""
+
+        if not self._queue:
+            self._oldest = time.monotonic()
+
+        self._queue.append({'event_type': etype,
+                            'event_time': datetime.utcnow(),
+                            'source': source,
+                            'target': target,
+                            'message': msg,
+                            'host': hostmask,
+                            'params': params,
+                            })
+
+        if self._retry_at is not None:
+            # the last write failed; leave retrying to flush_due()
+            excess = len(self._queue) - self.max_queued
+            if excess > 0:
+                del self._queue[:excess]
+                if not self._dropped:
+                    logging.warning("Event log queue full at %d rows; "
+                                    "dropping the oldest", self.max_queued)
+                self._dropped += excess
+                self.rows_dropped += excess
+        elif len(self._queue) >= self.max_rows:
+            self.flush()
+
+    def flush_due(self):
+        """Flush if the oldest queued row has waited longer than `max_delay`,
+        or if it's time to retry a failed write.
+
+        Cheap enough to call every loop.
+        """
+
+        if not self._queue:
+            return
+        now = time.monotonic()
+        if self._retry_at is not None:
+            if now >= self._retry_at:
+                self.flush()
+        elif now - self._oldest >= self.max_delay:
+            self.flush()
+
+    def flush(self):
+        """Write all queued rows in a single transaction.
+
+        If the write fails, the transaction is rolled back and the rows stay
+        queued, to be retried by `flush_due()` after a backoff.
+        """
+
+        if not self._queue:
+            return 0
+
+        db = self._db
+        rows = self._queue
+        start = time.monotonic()
+
+        try:
+            db.event_log.bulk_insert(rows)
+            db.commit()
+        except Exception:
+            logging.exception("Couldn't write %d event log rows", len(rows))
+            db.rollback()
+            self.failed_flushes += 1
+            self._backoff = min(max(self._backoff * 2, self.max_delay, 1.0),
+                                self.max_backoff)
+            self._retry_at = time.monotonic() + self._backoff
+            return 0
+
+        elapsed = time.monotonic() - start
+        self._queue = []
+        self._oldest = None
+        self._backoff = 0.0
+        self._retry_at = None
+        if self._dropped:
+            logging.warning("Dropped %d event log rows while the database "
+                            "was unavailable", self._dropped)
+            self._dropped = 0
+
+        self.flushes += 1
+        self.rows_written += len(rows)
+        self.last_flush_time = elapsed
+        self.total_flush_time += elapsed
+        if elapsed > self.max_flush_time:
+            self.max_flush_time = elapsed
+
+        logging.debug("Wrote %d event log rows in %.4fs", len(rows), elapsed)
+        return len(rows)
+
+    def stats(self):
+        """Return a `Storage` of queue and flush statistics."""
+
+        if self.flushes:
+            mean = self.total_flush_time / self.flushes
+        else:
+            mean = 0.0
+
+        return Storage(queued=len(self._queue),
+                       flushes=self.flushes,
+                       failed_flushes=self.failed_flushes,
+                       rows_written=self.rows_written,
+                       rows_dropped=self.rows_dropped,
+                       last_flush_time=self.last_flush_time,
+                       max_flush_time=self.max_flush_time,
+                       mean_flush_time=mean,
+                       )
+
+
+# fields provided by `_LogClock`, mapped to the `[locale]` option that
+# formats them
+_clock_fields = {'date': 'date_fmt',
+                 'time': 'time_fmt',
+                 'datetime_s': 'short_datetime_fmt',
+                 'datetime_l': 'long_datetime_fmt',
+                 }
+
+
+def _template_fields(template):
+    """Return the set of field names used in a `str.format()` template."""
+
+    fields = set()
+    for _, name, _, _ in string.Formatter().parse(template):
+        if name:
+            # "{foo.bar}" or "{foo[0]}" both need "foo"
+            fields.add(name.split('.')[0].split('[')[0])
+    return fields
+
+
+class _LogClock(object):
+    """Cache the formatted date and time strings used in log lines.
+
+    The date string is only reformatted when the date rolls over and the
+    time strings at most once a second. Only the fields in `needed` are
+    ever formatted.
+    """
+
+    def __init__(self, locale, needed):
+        self._fmts = dict((k, locale[v]) for k, v in _clock_fields.items()
+                          if k in needed)
+        self._second = None
+        self._day = None
+        self._values = {}
+
+    def now(self):
+        """Return a dict of the current clock fields and whether the date
+        has changed since the last call.
+        """
+
+        rolled = False
+        second = int(time.time())
+        if second != self._second:
+            self._second = second
+            today = datetime.utcfromtimestamp(second)
+            day = today.toordinal()
+            values = self._values
+
+            if day != self._day:
+                rolled = self._day is not None
+                self._day = day
+                if 'date' in self._fmts:
+                    values['date'] = today.strftime(self._fmts['date'])
+
+            for k, fmt in self._fmts.items():
+                if k != 'date':
+                    values[k] = today.strftime(fmt)
+
+        return self._values, rolled
+
+
+class FileLogSink(object):
+    """Write formatted event log lines to files.
+
+    `path_fmt` and each template in `formats` (keyed by event type) are
+    `str.format()` templates as given in the `[logging]` config section.
+    They're parsed once here so only the fields they actually use are
+    computed for each event.
+
+    Open files are kept in an LRU keyed by their resolved path, holding at
+    most `max_open_files` (at least 1) at once. Writes are buffered and flushed by
+    `flush_due()` every `flush_interval` seconds, and by `flush()` or
+    `close()`. All files are closed when the date rolls over, since
+    their paths usually include the date.
+    """
+
+    def __init__(self, path_fmt, formats, locale, max_open_files=32,
+                 flush_interval=1.0):
+        self._path_fmt = path_fmt
+        self._formats = dict(formats)
+
+        self._path_fields = tuple(sorted(_template_fields(path_fmt)))
+        needed = set(self._path_fields)
+        for fmt in self._formats.values():
+            needed |= _template_fields(fmt)
+        self._clock = _LogClock(locale, needed)
+
+        self._paths = {}     # path field values -> resolved path
+        self._dirs = set()   # directories known to exist
+        self._files = OrderedDict()    # resolved path -> open file, LRU
+        self._last_flush = time.monotonic()
+
+        # the file being written to is always open
+        self.max_open_files = max(max_open_files, 1)
+        self.flush_interval = flush_interval
+
+        # statistics
+        self.lines_written = 0
+        self.opens = 0
+
+    def write(self, etype, source, msg='', target='', hostmask='', params=''):
+        """Format and write one event. Events with no template in the
+        `[logging]` config section are ignored.
+        """
+
+        fmt = self._formats.get(etype)
+        if fmt is None:
+            return
+
+        clock, rolled = self._clock.now()
+        if rolled:
+            self.close()
+
+        fields = dict(clock)
+        fields.update(etype=etype, source=source, msg=msg, target=target,
+                      hostmask=hostmask, params=params)
+
+        log = self._get_file(self._resolve(fields))
+        log.write(fmt.format_map(fields) + '\n')
+        self.lines_written += 1
+
+    def _resolve(self, fields):
+        key = tuple(fields[k] for k in self._path_fields)
+        path = self._paths.get(key)
+        if path is None:
+            if len(self._paths) > 4 * self.max_open_files:
+                self._paths.clear()
+            path = os.path.expanduser(self._path_fmt.format_map(fields))
+            self._paths[key] = path
+        return path
+
+    def _get_file(self, path):
+        files = self._files
+        log = files.get(path)
+        if log is not None:
+            files.move_to_end(path)
+            return log
+
+        file_dir = os.path.dirname(path)
+        if file_dir not in self._dirs:
+            if file_dir:
+                os.makedirs(file_dir, exist_ok=True)
+            self._dirs.add(file_dir)
+
+        while files and len(files) >= self.max_open_files:
+            _, old = files.popitem(last=False)
+            old.close()
+
+        log = files[path] = open(path, 'a')
+        self.opens += 1
+        return log
+
+    @property
+    def open_files(self):
+        """Number of log files currently held open."""
+        return len(self._files)
+
+    def flush_due(self):
+        """Flush buffered lines if `flush_interval` seconds have passed since
+        the last flush. Cheap enough to call every loop.
+        """
+
+        now = time.monotonic()
+        if now - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """Flush buffered lines for every open file."""
+
+        for log in self._files.values():
+            log.flush()
+        self._last_flush = time.monotonic()
+
+    def close(self):
+        """Flush and close every open file."""
+
+        while self._files:
+            _, log = self._files.popitem(last=False)
+            log.close()
+        self._paths.clear()
+        self._last_flush = time.monotonic()
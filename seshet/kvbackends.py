@@ -0,0 +1,429 @@
+"""Storage backends for `seshet.utils.KVStore`.
+
+A backend stores encoded values (bytes) by namespace and key. `KVStore`
+and `KVNamespace` handle caching and encoding on top of it. Every backend
+implements the methods of `KVBackend`; writes made by `set_many()` and
+`clear()` are committed before they return. Backends may be used from
+the loop thread and handler worker threads at once, and lock around
+anything that isn't thread-safe.
+
+    pydal   - one `kv_<name>` table per namespace in the bot's DAL
+              database, as KVStore has always used
+    sqlite  - one table in a separate sqlite3 database in WAL mode
+    dbm     - a stdlib `dbm` file
+    memory  - a dict, for testing and for running without a database
+
+Use `open_backend()` to build one from the `[database]` config section.
+"""
+
+import dbm
+import sqlite3
+import threading
+
+from pydal import Field
+
+
+class KVBackend(object):
+    """Interface of key/value storage backends. Keys are `str`, values are
+    `bytes`, and a value of None passed to `set_many()` deletes the key.
+    """
+
+    def namespaces(self):
+        """Return a list of the names of all registered namespaces."""
+        raise NotImplementedError
+
+    def has_namespace(self, name):
+        return name in self.namespaces()
+
+    def create_namespace(self, name):
+        """Register namespace `name` if it isn't already."""
+        raise NotImplementedError
+
+    def get(self, ns, k):
+        """Return the value of `k` in `ns`, or None."""
+        return self.get_many(ns, [k]).get(k)
+
+    def get_many(self, ns, keys):
+        """Return a dict of those of `keys` in `ns` that are set."""
+        raise NotImplementedError
+
+    def set_many(self, ns, values):
+        """Write a dict of values to `ns` in one transaction."""
+        raise NotImplementedError
+
+    def items(self, ns):
+        """Iterate over the `(key, value)` pairs in `ns`."""
+        raise NotImplementedError
+
+    def clear(self, ns):
+        """Delete every key in `ns`."""
+        raise NotImplementedError
+
+    def legacy_items(self, ns):
+        """Iterate over the `(key, value)` pairs in `ns` that may have been
+        written by an older version and need migrating. Only the pydal
+        backend predates `seshet.kvcodec`.
+        """
+        return iter(())
+
+    def close(self):
+        pass
+
+
+class PydalBackend(KVBackend):
+    """Store each namespace in a `kv_<name>` table of a pydal `DAL`, with
+    the names of namespaces in the `namespaces` table.
+
+    Values are kept in the blob column `b`. Older versions kept text in
+    column `v`; those rows are read from `v` until they're migrated.
+
+    Tables are defined the first time they're used, and the DAL isn't
+    safe to define tables in or share a transaction from several threads,
+    so every method holds a lock.
+    """
+
+    def __init__(self, db):
+        if 'namespaces' not in db:
+            # list of registered modules
+            db.define_table('namespaces', Field('name'))
+        self.db = db
+        self._lock = threading.RLock()
+
+    def _table(self, ns):
+        # called with the lock held
+        db = self.db
+        tbl_name = 'kv_' + ns
+        if tbl_name not in db:
+            db.define_table(tbl_name,
+                            Field('k', 'string', unique=True),
+                            # legacy text-encoded pickles
+                            Field('v', 'text'),
+                            Field('b', 'blob'),
+                            )
+        return db[tbl_name]
+
+    def namespaces(self):
+        db = self.db
+        with self._lock:
+            return [r.name for r in db().select(db.namespaces.name)]
+
+    def has_namespace(self, name):
+        db = self.db
+        with self._lock:
+            return not db(db.namespaces.name == name).isempty()
+
+    def create_namespace(self, name):
+        db = self.db
+        with self._lock:
+            if db(db.namespaces.name == name).isempty():
+                db.namespaces.insert(name=name)
+                db.commit()
+            self._table(name)
+
+    @staticmethod
+    def _value(r):
+        if r.b is not None:
+            # pydal gives blobs that are valid UTF-8 back as str
+            b = r.b
+            return b.encode('utf-8') if isinstance(b, str) else b
+        # legacy row; the text column held a pickle decoded as text
+        return r.v.encode(errors='ignore') if r.v is not None else None
+
+    def get(self, ns, k):
+        with self._lock:
+            tbl = self._table(ns)
+            r = self.db(tbl.k == k).select(tbl.b, tbl.v,
+                                           limitby=(0, 1)).first()
+        return self._value(r) if r is not None else None
+
+    def get_many(self, ns, keys):
+        if not keys:
+            return {}
+        with self._lock:
+            tbl = self._table(ns)
+            rows = self.db(tbl.k.belongs(keys)).select(tbl.k, tbl.b, tbl.v)
+        return dict((r.k, self._value(r)) for r in rows)
+
+    def set_many(self, ns, values):
+        # replace rows with one DELETE and one multi-row INSERT
+        if not values:
+            return
+        db = self.db
+        with self._lock:
+            tbl = self._table(ns)
+            try:
+                if len(values) == 1:
+                    (k, v), = values.items()
+                    if v is None:
+                        db(tbl.k == k).delete()
+                    else:
+                        tbl.update_or_insert(tbl.k == k, k=k, b=v, v=None)
+                else:
+                    db(tbl.k.belongs(list(values))).delete()
+                    rows = [dict(k=k, b=v)
+                            for k, v in values.items() if v is not None]
+                    if rows:
+                        tbl.bulk_insert(rows)
+                db.commit()
+            except Exception:
+                db.rollback()
+                raise
+
+    def items(self, ns):
+        # selected while locked rather than read from a shared cursor
+        with self._lock:
+            tbl = self._table(ns)
+            rows = self.db(tbl).select(tbl.k, tbl.b, tbl.v)
+        return iter([(r.k, self._value(r)) for r in rows])
+
+    def legacy_items(self, ns):
+        with self._lock:
+            tbl = self._table(ns)
+            rows = self.db(tbl.b == None).select(tbl.k, tbl.b, tbl.v)
+        return iter([(r.k, self._value(r)) for r in rows
+                     if r.v is not None])
+
+    def clear(self, ns):
+        with self._lock:
+            self.db(self._table(ns)).delete()
+            self.db.commit()
+
+
+class SQLiteBackend(KVBackend):
+    """Store every namespace in one table of an sqlite3 database in WAL
+    mode, so reads don't wait for writes. Statements are fixed strings,
+    so sqlite3 prepares each one once and reuses it.
+
+    The one connection is shared by the loop thread and worker threads, so
+    every use of it holds a lock; otherwise one thread's BEGIN could land
+    inside another's transaction.
+    """
+
+    # most parameters per statement in older SQLite builds is 999
+    chunk_size = 500
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, isolation_level=None,
+                                    check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS kv_namespaces "
+                          "(name TEXT PRIMARY KEY)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS kv "
+                          "(ns TEXT, k TEXT, v BLOB, PRIMARY KEY (ns, k)) "
+                          "WITHOUT ROWID")
+
+    def namespaces(self):
+        with self._lock:
+            return [r[0] for r in self.conn.execute(
+                "SELECT name FROM kv_namespaces")]
+
+    def has_namespace(self, name):
+        with self._lock:
+            return self.conn.execute(
+                "SELECT 1 FROM kv_namespaces WHERE name = ?",
+                (name,)).fetchone() is not None
+
+    def create_namespace(self, name):
+        with self._lock:
+            self.conn.execute("INSERT OR IGNORE INTO kv_namespaces VALUES (?)",
+                              (name,))
+
+    def get(self, ns, k):
+        with self._lock:
+            r = self.conn.execute("SELECT v FROM kv WHERE ns = ? AND k = ?",
+                                  (ns, k)).fetchone()
+        return r[0] if r is not None else None
+
+    def get_many(self, ns, keys):
+        found = {}
+        with self._lock:
+            for i in range(0, len(keys), self.chunk_size):
+                chunk = keys[i:i + self.chunk_size]
+                sql = ("SELECT k, v FROM kv WHERE ns = ? AND k IN (%s)"
+                       % ','.join('?' * len(chunk)))
+                found.update(self.conn.execute(sql, [ns] + chunk))
+        return found
+
+    def set_many(self, ns, values):
+        with self._lock:
+            conn = self.conn
+            conn.execute("BEGIN")
+            try:
+                conn.executemany("INSERT OR REPLACE INTO kv VALUES (?, ?, ?)",
+                                 [(ns, k, v) for k, v in values.items()
+                                  if v is not None])
+                conn.executemany("DELETE FROM kv WHERE ns = ? AND k = ?",
+                                 [(ns, k) for k, v in values.items()
+                                  if v is None])
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+    def items(self, ns):
+        # fetched while locked rather than read from a shared cursor
+        with self._lock:
+            rows = self.conn.execute("SELECT k, v FROM kv WHERE ns = ?",
+                                     (ns,)).fetchall()
+        return iter(rows)
+
+    def clear(self, ns):
+        with self._lock:
+            self.conn.execute("DELETE FROM kv WHERE ns = ?", (ns,))
+
+    def close(self):
+        with self._lock:
+            self.conn.close()
+
+
+class DbmBackend(KVBackend):
+    """Store values in a `dbm` file under `<namespace>\\0<key>`.
+
+    `dbm` can't list keys by prefix, so `items()` and `clear()` scan every
+    key in the file. Best for a few small namespaces. `dbm` modules aren't
+    thread-safe, so every method holds a lock.
+    """
+
+    _ns_key = b'\0namespaces'
+
+    def __init__(self, path):
+        self.path = path
+        self.db = dbm.open(path, 'c')
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def _key(ns, k):
+        return (ns + '\0' + k).encode('utf-8')
+
+    def namespaces(self):
+        with self._lock:
+            names = self.db.get(self._ns_key)
+        return names.decode('utf-8').split('\0') if names else []
+
+    def create_namespace(self, name):
+        with self._lock:
+            names = self.namespaces()
+            if name not in names:
+                names.append(name)
+                self.db[self._ns_key] = '\0'.join(names).encode('utf-8')
+                self._sync()
+
+    def _sync(self):
+        sync = getattr(self.db, 'sync', None)
+        if sync is not None:
+            sync()
+
+    def get(self, ns, k):
+        with self._lock:
+            return self.db.get(self._key(ns, k))
+
+    def get_many(self, ns, keys):
+        db = self.db
+        found = {}
+        with self._lock:
+            for k in keys:
+                v = db.get(self._key(ns, k))
+                if v is not None:
+                    found[k] = v
+        return found
+
+    def set_many(self, ns, values):
+        db = self.db
+        with self._lock:
+            for k, v in values.items():
+                key = self._key(ns, k)
+                if v is not None:
+                    db[key] = v
+                elif key in db:
+                    del db[key]
+            self._sync()
+
+    def _keys(self, ns):
+        # called with the lock held
+        prefix = (ns + '\0').encode('utf-8')
+        return [key for key in self.db.keys() if key.startswith(prefix)]
+
+    def items(self, ns):
+        start = len(ns) + 1
+        found = []
+        with self._lock:
+            for key in self._keys(ns):
+                v = self.db.get(key)
+                if v is not None:
+                    found.append((key.decode('utf-8')[start:], v))
+        return iter(found)
+
+    def clear(self, ns):
+        with self._lock:
+            for key in self._keys(ns):
+                del self.db[key]
+            self._sync()
+
+    def close(self):
+        with self._lock:
+            self.db.close()
+
+
+class MemoryBackend(KVBackend):
+    """Keep everything in a dict. Nothing is saved."""
+
+    def __init__(self):
+        self.data = {}
+
+    def namespaces(self):
+        return list(self.data)
+
+    def has_namespace(self, name):
+        return name in self.data
+
+    def create_namespace(self, name):
+        self.data.setdefault(name, {})
+
+    def get(self, ns, k):
+        return self.data.get(ns, {}).get(k)
+
+    def get_many(self, ns, keys):
+        d = self.data.get(ns, {})
+        return dict((k, d[k]) for k in keys if k in d)
+
+    def set_many(self, ns, values):
+        d = self.data.setdefault(ns, {})
+        for k, v in values.items():
+            if v is not None:
+                d[k] = v
+            else:
+                d.pop(k, None)
+
+    def items(self, ns):
+        return iter(list(self.data.get(ns, {}).items()))
+
+    def clear(self, ns):
+        self.data.get(ns, {}).clear()
+
+
+backends = {'pydal': PydalBackend,
+            'sqlite': SQLiteBackend,
+            'dbm': DbmBackend,
+            'memory': MemoryBackend,
+            }
+
+
+def open_backend(kind, db=None, path=None):
+    """Return a backend by name: 'pydal' (using the DAL `db`), 'sqlite' or
+    'dbm' (using the file `path`), or 'memory'.
+    """
+
+    if kind not in backends:
+        raise ValueError("Unknown kv_backend: %s" % kind)
+    if kind == 'pydal':
+        if db is None:
+            raise ValueError("The pydal kv_backend needs a database")
+        return PydalBackend(db)
+    elif kind == 'memory':
+        return MemoryBackend()
+    if not path:
+        raise ValueError("The %s kv_backend needs kv_path to be set" % kind)
+    return backends[kind](path)
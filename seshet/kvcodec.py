@@ -0,0 +1,107 @@
+"""Encode `KVStore` values as bytes for the `seshet.kvbackends` backends.
+
+Every encoded value starts with a three byte header: a NUL byte, the
+format version, and the id of the codec used for the rest:
+
+    p  - pickle protocol 5, for any picklable value
+    m  - marshal, for plain builtins (faster, smaller)
+    j  - JSON, readable by other programs
+
+`encode()` falls back to pickle for values the chosen codec can't store
+exactly, so every value reads back with the same types and the header
+always says how to decode. For JSON that means anything but dicts with
+`str` keys, lists, `str`, `int`, `float`, `bool` and None; a tuple, say,
+would otherwise come back as a list. Values without the header were
+written before it existed, as text-mangled pickles; `decode()` still
+reads them where possible, and `is_legacy()` finds them for migration.
+"""
+
+import json
+import marshal
+import pickle
+
+
+VERSION = 1
+PICKLE = 'pickle'
+MARSHAL = 'marshal'
+JSON = 'json'
+
+_ids = {PICKLE: b'p', MARSHAL: b'm', JSON: b'j'}
+_headers = dict((name, b'\0' + bytes([VERSION]) + i)
+                for name, i in _ids.items())
+_header_len = 3
+
+
+_json_scalars = frozenset([str, int, float, bool, type(None)])
+
+
+def _json_exact(v):
+    """True if `v` would be read back from JSON with the same types."""
+
+    t = type(v)
+    if t in _json_scalars:
+        return True
+    elif t is list:
+        return all(_json_exact(x) for x in v)
+    elif t is dict:
+        return all(type(k) is str and _json_exact(x) for k, x in v.items())
+    return False
+
+
+def _json_dumps(v):
+    if not _json_exact(v):
+        # e.g. tuples or int keys, which JSON would turn into lists and str
+        raise TypeError("Not exactly representable in JSON")
+    return json.dumps(v, separators=(',', ':')).encode('utf-8')
+
+
+_dumps = {PICKLE: lambda v: pickle.dumps(v, protocol=5),
+          MARSHAL: marshal.dumps,
+          JSON: _json_dumps,
+          }
+_loads = {ord('p'): pickle.loads,
+          ord('m'): marshal.loads,
+          ord('j'): json.loads,
+          }
+
+
+def encode(v, codec=PICKLE):
+    """Return `v` encoded with `codec`, or with pickle if `codec` can't
+    encode it.
+    """
+
+    if codec != PICKLE:
+        try:
+            return _headers[codec] + _dumps[codec](v)
+        except (ValueError, TypeError, RecursionError):
+            # not plain builtins, or nested too deeply
+            pass
+    return _headers[PICKLE] + pickle.dumps(v, protocol=5)
+
+
+def is_legacy(data):
+    """True if `data` was written before values had a header."""
+    return data[:1] != b'\0'
+
+
+def decode(data):
+    """Decode a value written by `encode()` or by an older KVStore. Raises
+    `ValueError` if it can't be decoded.
+    """
+
+    if is_legacy(data):
+        try:
+            return pickle.loads(data)
+        except Exception as e:
+            raise ValueError("Can't decode legacy value: %r" % e)
+
+    if data[1] != VERSION:
+        raise ValueError("Unknown value format version %d" % data[1])
+    loads = _loads.get(data[2])
+    if loads is None:
+        raise ValueError("Unknown value codec %r" % chr(data[2]))
+    payload = memoryview(data)[_header_len:]
+    if data[2] == ord('j'):
+        # json needs bytes, not a memoryview
+        payload = bytes(payload)
+    return loads(payload)
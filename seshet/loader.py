@@ -0,0 +1,199 @@
+"""Import and cache command modules, reloading them when they change.
+
+`ModuleLoader` imports each command module once with `importlib` and hands
+out the cached module object afterward. `check()` stats the source files
+of loaded modules at most every `check_interval` seconds and reloads any
+whose contents have changed, so modules can still be edited while the bot
+is running without paying for an import on every event.
+"""
+
+import hashlib
+import importlib
+import logging
+import os
+import time
+from collections import deque
+
+from .utils import Storage
+
+
+def _file_digest(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+class _Entry(object):
+    """Bookkeeping for one loaded module."""
+
+    __slots__ = ('module', 'path', 'mtime', 'digest', 'load_time')
+
+    def __init__(self, module, load_time):
+        self.module = module
+        self.path = getattr(module, '__file__', None)
+        self.mtime = None
+        self.digest = None
+        self.load_time = load_time
+        self.stamp()
+
+    def stamp(self):
+        """Record the source file's current mtime and digest."""
+
+        if self.path is None:
+            return
+        try:
+            self.mtime = os.stat(self.path).st_mtime
+            self.digest = _file_digest(self.path)
+        except OSError:
+            self.mtime = self.digest = None
+
+
+class ModuleLoader(object):
+    """Cache of imported command modules.
+
+    Callables in `listeners` are called as `listener(name, module, action)`
+    after a module is loaded (`action` is 'load') or reloaded ('reload').
+    The last `history_size` load and reload events are kept in `history`
+    as `(time, name, action, seconds)` tuples for monitoring.
+    """
+
+    def __init__(self, check_interval=2.0, history_size=100):
+        self._entries = {}
+        self._failed = {}   # name -> time of last failed import
+        self._last_check = time.monotonic()
+
+        self.check_interval = check_interval
+        self.listeners = []
+        self.history = deque(maxlen=history_size)
+
+        # statistics
+        self.loads = 0
+        self.reloads = 0
+        self.failures = 0
+
+    def __contains__(self, name):
+        return name in self._entries
+
+    def get(self, name):
+        """Return the module `name`, importing it if it hasn't been loaded
+        yet. Returns None if the module can't be imported; the import won't
+        be retried for `check_interval` seconds.
+        """
+
+        entry = self._entries.get(name)
+        if entry is not None:
+            return entry.module
+
+        failed = self._failed.get(name)
+        if failed is not None:
+            if time.monotonic() - failed < self.check_interval:
+                return None
+            del self._failed[name]
+
+        return self._import(name, 'load')
+
+    def reload(self, name):
+        """Reload the module `name` now, e.g. at an admin's request.
+        Loads it if it isn't loaded yet.
+        """
+
+        if name not in self._entries:
+            self._failed.pop(name, None)
+            return self._import(name, 'load')
+        return self._import(name, 'reload')
+
+    def unload(self, name):
+        """Forget the cached module `name`. It will be imported again the
+        next time it's needed.
+        """
+
+        self._entries.pop(name, None)
+        self._failed.pop(name, None)
+
+    def check(self, force=False):
+        """Reload any loaded module whose source file has changed.
+
+        The file is only hashed if its mtime has changed, and the module is
+        only reloaded if the hash differs, so merely touching a file doesn't
+        cause a reload. Unless `force` is true, does nothing if the last
+        check was less than `check_interval` seconds ago.
+        """
+
+        now = time.monotonic()
+        if not force and now - self._last_check < self.check_interval:
+            return []
+        self._last_check = now
+
+        reloaded = []
+        for name, entry in list(self._entries.items()):
+            if entry.path is None:
+                continue
+            try:
+                mtime = os.stat(entry.path).st_mtime
+                if mtime == entry.mtime:
+                    continue
+                digest = _file_digest(entry.path)
+            except OSError:
+                continue
+
+            if digest == entry.digest:
+                entry.mtime = mtime
+                continue
+
+            logging.info("Module %s changed on disk, reloading", name)
+            if self._import(name, 'reload') is not None:
+                reloaded.append(name)
+            else:
+                # keep the old module, and don't try the broken file again
+                # until it changes
+                entry.mtime = mtime
+                entry.digest = digest
+
+        return reloaded
+
+    def _import(self, name, action):
+        start = time.monotonic()
+        try:
+            if action == 'reload':
+                module = importlib.reload(self._entries[name].module)
+            else:
+                module = importlib.import_module(name)
+        except Exception:
+            logging.exception("Couldn't %s module %s", action, name)
+            self.failures += 1
+            if action == 'load':
+                self._failed[name] = time.monotonic()
+            return None
+
+        elapsed = time.monotonic() - start
+        self._entries[name] = _Entry(module, elapsed)
+        self.history.append((time.time(), name, action, elapsed))
+        if action == 'reload':
+            self.reloads += 1
+        else:
+            self.loads += 1
+        logging.debug("%s of module %s took %.4fs",
+                      action.capitalize(), name, elapsed)
+
+        for listener in self.listeners:
+            try:
+                listener(name, module, action)
+            except Exception:
+                logging.exception("Error in module loader listener for %s",
+                                  name)
+
+        return module
+
+    def load_times(self):
+        """Return a dict of module name to seconds taken by its last load."""
+        return dict((k, e.load_time) for k, e in self._entries.items())
+
+    def stats(self):
+        """Return a `Storage` of loader statistics."""
+
+        return Storage(loaded=sorted(self._entries),
+                       failed=sorted(self._failed),
+                       loads=self.loads,
+                       reloads=self.reloads,
+                       failures=self.failures,
+                       load_times=self.load_times(),
+                       )
@@ -0,0 +1,246 @@
+"""Pace the lines a bot sends so the server doesn't kill it for flooding.
+
+Every line executed on the bot's `seshet.engine.AsyncConnection` goes
+through an `OutboundQueue`. Sending is paced by a token bucket: up to
+`burst` lines go out at once, then `rate` lines per second.
+
+Lines are sent in order of priority class:
+
+    PROTOCOL  - registration, PING/PONG and QUIT; never wait for the
+                bucket, though they still use up tokens
+    ADMIN     - channel management: JOIN, PART, MODE, KICK, WHO, ...
+    MODULE    - everything else, mostly PRIVMSG and NOTICE replies
+
+Within a class, each target (channel or nick) has its own queue and the
+targets take turns, so one module spamming a channel doesn't hold up
+replies elsewhere. With `merge` on, a short PRIVMSG or NOTICE waiting
+behind another one to the same target is appended to it, joined by
+`merge_sep`, rather than queued as its own line.
+
+`stats()` reports the depth of each class's queue and how long lines
+waited to be sent.
+"""
+
+import asyncio
+import collections
+import logging
+import time
+
+from .utils import Storage
+
+
+PROTOCOL = 0
+ADMIN = 1
+MODULE = 2
+
+class_names = ('protocol', 'admin', 'module')
+
+command_classes = {
+    'PASS': PROTOCOL, 'CAP': PROTOCOL, 'AUTHENTICATE': PROTOCOL,
+    'USER': PROTOCOL, 'NICK': PROTOCOL, 'PING': PROTOCOL, 'PONG': PROTOCOL,
+    'QUIT': PROTOCOL,
+    'JOIN': ADMIN, 'PART': ADMIN, 'MODE': ADMIN, 'KICK': ADMIN,
+    'TOPIC': ADMIN, 'INVITE': ADMIN, 'WHO': ADMIN, 'WHOIS': ADMIN,
+    'NAMES': ADMIN, 'OPER': ADMIN, 'AWAY': ADMIN,
+}
+
+# commands whose first parameter is where the line is going
+_targeted = frozenset(['PRIVMSG', 'NOTICE', 'KICK', 'MODE', 'TOPIC',
+                       'INVITE', 'WHO', 'NAMES', 'JOIN', 'PART'])
+_mergeable = frozenset(['PRIVMSG', 'NOTICE'])
+
+
+class _Line(object):
+    """One queued line."""
+
+    __slots__ = ('command', 'params', 'trailing', 'queued')
+
+    def __init__(self, command, params, trailing, queued):
+        self.command = command
+        self.params = params
+        self.trailing = trailing
+        self.queued = queued
+
+
+class OutboundQueue(object):
+    """Flood-controlled send queue for one connection.
+
+    `rate` is in lines per second; 0 sends everything at once. Lines of
+    the ADMIN and MODULE classes are dropped once `max_queued` are
+    waiting.
+    """
+
+    def __init__(self, rate=1.0, burst=5, merge=False, merge_max=350,
+                 merge_sep=' | ', max_queued=1000):
+        self.rate = rate
+        self.burst = burst
+        self.merge = merge
+        self.merge_max = merge_max
+        self.merge_sep = merge_sep
+        self.max_queued = max_queued
+
+        self.conn = None
+        self.tokens = float(burst)
+        self._last = time.monotonic()
+        # one OrderedDict of target -> deque of _Lines per class
+        self._queues = [collections.OrderedDict() for _ in class_names]
+        self._depth = [0] * len(class_names)
+        self._timer = None
+
+        # statistics
+        self.sent = [0] * len(class_names)
+        self.merged = 0
+        self.dropped = 0
+        self._wait_total = [0.0] * len(class_names)
+        self._wait_max = [0.0] * len(class_names)
+        self._recent_waits = collections.deque(maxlen=1000)
+
+    def attach(self, conn):
+        """Send through `conn`, an `AsyncConnection`."""
+
+        self.conn = conn
+        conn.outbound = self
+
+    @property
+    def queued(self):
+        """Number of lines waiting to be sent."""
+        return sum(self._depth)
+
+    def put(self, command, params, trailing=None, priority=None):
+        """Queue a line and send what the bucket allows. `priority` is
+        PROTOCOL, ADMIN or MODULE; by default it depends on the command.
+        """
+
+        command = command.upper()
+        if priority is None:
+            priority = command_classes.get(command, MODULE)
+        if priority != PROTOCOL and self.queued >= self.max_queued:
+            self.dropped += 1
+            logging.warning("Send queue full, dropping %s to %s", command,
+                            params[0] if params else None)
+            return
+
+        target = None
+        if command in _targeted and params:
+            target = params[0].lower()
+        targets = self._queues[priority]
+        lines = targets.get(target)
+        if lines is None:
+            lines = targets[target] = collections.deque()
+        elif self.merge and self._merge(lines[-1], command, params, trailing):
+            self.merged += 1
+            return
+
+        lines.append(_Line(command, params, trailing, time.monotonic()))
+        self._depth[priority] += 1
+        self.pump()
+
+    def _merge(self, last, command, params, trailing):
+        if (command not in _mergeable or last.command != command
+                or last.params != params or trailing is None
+                or last.trailing is None):
+            return False
+        # CTCP messages can't be joined
+        if trailing[:1] == '\x01' or last.trailing[:1] == '\x01':
+            return False
+        merged = last.trailing + self.merge_sep + trailing
+        if len(merged) > self.merge_max:
+            return False
+        last.trailing = merged
+        return True
+
+    def _refill(self, now):
+        if self.rate:
+            self.tokens = min(float(self.burst),
+                              self.tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def _pop(self, priority):
+        targets = self._queues[priority]
+        target, lines = next(iter(targets.items()))
+        line = lines.popleft()
+        if lines:
+            # let the other targets go next
+            targets.move_to_end(target)
+        else:
+            del targets[target]
+        self._depth[priority] -= 1
+        return line
+
+    def pump(self):
+        """Send every line the bucket allows, and schedule the next call if
+        lines are left waiting. Called as lines are queued.
+        """
+
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        conn = self.conn
+        if conn is None or conn.closed:
+            return
+
+        now = time.monotonic()
+        self._refill(now)
+        depth = self._depth
+        while depth[PROTOCOL]:
+            self._send(self._pop(PROTOCOL), PROTOCOL, now)
+        if not conn.can_write():
+            # pumped again once connected or the transport has drained
+            return
+        for priority in (ADMIN, MODULE):
+            while depth[priority] and (not self.rate or self.tokens >= 1):
+                self._send(self._pop(priority), priority, now)
+
+        if self.queued:
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                return
+            delay = (1 - self.tokens) / self.rate
+            self._timer = loop.call_later(delay, self.pump)
+
+    def _send(self, line, priority, now):
+        self.tokens -= 1
+        wait = now - line.queued
+        self.sent[priority] += 1
+        self._wait_total[priority] += wait
+        if wait > self._wait_max[priority]:
+            self._wait_max[priority] = wait
+        self._recent_waits.append(wait)
+        self.conn.send_line(line.command, line.params, line.trailing)
+
+    def clear(self):
+        """Drop every queued line."""
+
+        for targets in self._queues:
+            targets.clear()
+        self._depth = [0] * len(class_names)
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def stats(self):
+        """Return a `Storage` of queue depths, lines sent and seconds spent
+        waiting, by class, and the median and 95th percentile wait of the
+        last 1000 lines sent.
+        """
+
+        classes = {}
+        for i, name in enumerate(class_names):
+            n = self.sent[i]
+            classes[name] = Storage(queued=self._depth[i],
+                                    sent=n,
+                                    mean_wait=self._wait_total[i] / n if n
+                                              else 0.0,
+                                    max_wait=self._wait_max[i],
+                                    )
+        waits = sorted(self._recent_waits)
+        return Storage(queued=self.queued,
+                       classes=classes,
+                       merged=self.merged,
+                       dropped=self.dropped,
+                       tokens=self.tokens,
+                       median_wait=waits[len(waits) // 2] if waits else 0.0,
+                       p95_wait=waits[int(len(waits) * 0.95)] if waits
+                                else 0.0,
+                       )
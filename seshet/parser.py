@@ -0,0 +1,270 @@
+"""Split and parse lines received from an IRC server.
+
+`Parser.feed()` takes the bytes of each read and returns a `Message` for
+every complete line in it. The complete part of the read is decoded in one
+call, through a `memoryview` so it isn't copied first, and split in one
+pass; only a trailing partial line is kept back for the next read.
+
+`Message` works as an event for `ircutils3` listeners and the bot's
+`on_*` handlers: it has the same `command`, `prefix`, `source`, `user`,
+`host`, `target`, `params` and `message` attributes as
+`ircutils3.events.StandardEvent` and `MessageEvent`. Only the command is
+found when the line is parsed; parameters, IRCv3 message tags, the parts
+of the prefix and the casefolded source and target are worked out the
+first time they're used.
+"""
+
+import logging
+
+from ircutils3 import responses
+from ircutils3.protocol import commands_with_no_target
+
+from .utils import default_casemapping
+
+
+_no_target = frozenset(commands_with_no_target)
+
+_tag_escapes = {':': ';', 's': ' ', '\\': '\\', 'r': '\r', 'n': '\n'}
+
+
+def unescape_tag(value):
+    """Unescape an IRCv3 message tag value."""
+
+    if '\\' not in value:
+        return value
+    out = []
+    chars = iter(value)
+    for c in chars:
+        if c == '\\':
+            c = next(chars, '')
+            out.append(_tag_escapes.get(c, c))
+        else:
+            out.append(c)
+    return ''.join(out)
+
+
+class Message(object):
+    """One line from the server.
+
+    `line` is the line as received and `raw_command` its command as sent,
+    such as '001'; `command` has numerics replaced by their names, such as
+    'RPL_WELCOME', as ircutils3 does. `args` is every parameter, while
+    `params` leaves out the target, as with ircutils3 events.
+    """
+
+    # '__dict__' lets handlers add their own attributes to an event, as
+    # they could to ircutils3's; it's only created when they do
+    __slots__ = ('line', 'prefix', 'raw_command', 'command', '_rest',
+                 '_tags_raw', '_fold', '_args', '_params', '_tags',
+                 '_nuh', '_message', '_folded_source', '_folded_target',
+                 '__dict__')
+
+    def __init__(self, line, fold=None):
+        self.line = line
+        self._fold = fold
+        self._args = self._params = self._tags = self._nuh = None
+        self._message = self._folded_source = self._folded_target = None
+
+        rest = line
+        if rest[:1] == '@':
+            self._tags_raw, _, rest = rest[1:].partition(' ')
+        else:
+            self._tags_raw = None
+        if rest[:1] == ':':
+            self.prefix, _, rest = rest[1:].partition(' ')
+        else:
+            self.prefix = None
+        command, _, self._rest = rest.lstrip(' ').partition(' ')
+        self.raw_command = command
+        if command.isdigit():
+            command = responses.from_digit(command)
+        self.command = command
+
+    def derive(self, command, params):
+        """Return a `Message` from the same source to the same target with
+        a different command and parameters, as for a CTCP request within a
+        PRIVMSG. Its `message` is the parameters joined by spaces.
+        """
+
+        m = Message.__new__(Message)
+        m.line = self.line
+        m.prefix = self.prefix
+        m.raw_command = m.command = command
+        m._rest = None
+        m._tags_raw = self._tags_raw
+        m._fold = self._fold
+        m._tags = self._tags
+        m._nuh = self._nuh
+        m._folded_source = m._folded_target = None
+        m._params = list(params)
+        m._message = ' '.join(m._params)
+        m._args = [self.target] + m._params
+        return m
+
+    @property
+    def args(self):
+        """Every parameter, with the trailing one last."""
+
+        args = self._args
+        if args is None:
+            rest = self._rest
+            if rest[:1] == ':':
+                args = [rest[1:]]
+            else:
+                head, sep, trailing = rest.partition(' :')
+                args = head.split()
+                if sep:
+                    args.append(trailing)
+            self._args = args
+        return args
+
+    @property
+    def target(self):
+        args = self.args
+        if args and self.command not in _no_target:
+            return args[0]
+        return None
+
+    @property
+    def params(self):
+        params = self._params
+        if params is None:
+            args = self.args
+            if args and self.command not in _no_target:
+                params = args[1:]
+            else:
+                params = args
+            self._params = params
+        return params
+
+    @property
+    def message(self):
+        """The text of a PRIVMSG or NOTICE, or else the last parameter.
+        May be set, e.g. to strip the bot's name from the start.
+        """
+
+        if self._message is None:
+            args = self.args
+            return args[-1] if args else ''
+        return self._message
+
+    @message.setter
+    def message(self, value):
+        self._message = value
+
+    def _split_prefix(self):
+        prefix = self.prefix
+        if prefix is None:
+            nuh = (None, None, None)
+        else:
+            rest, _, host = prefix.partition('@')
+            nick, _, user = rest.partition('!')
+            nuh = (nick, user or None, host or None)
+        self._nuh = nuh
+        return nuh
+
+    @property
+    def source(self):
+        return (self._nuh or self._split_prefix())[0]
+
+    @property
+    def user(self):
+        return (self._nuh or self._split_prefix())[1]
+
+    @property
+    def host(self):
+        return (self._nuh or self._split_prefix())[2]
+
+    @property
+    def tags(self):
+        """Dict of IRCv3 message tags, with values unescaped; tags without
+        a value are True.
+        """
+
+        tags = self._tags
+        if tags is None:
+            tags = {}
+            if self._tags_raw:
+                for tag in self._tags_raw.split(';'):
+                    name, sep, value = tag.partition('=')
+                    tags[name] = unescape_tag(value) if sep else True
+            self._tags = tags
+        return tags
+
+    @property
+    def folded_source(self):
+        """`source` casefolded with the server's case mapping."""
+
+        folded = self._folded_source
+        if folded is None and self.source is not None:
+            fold = self._fold or default_casemapping.fold
+            folded = self._folded_source = fold(self.source)
+        return folded
+
+    @property
+    def folded_target(self):
+        """`target` casefolded with the server's case mapping."""
+
+        folded = self._folded_target
+        if folded is None and self.target is not None:
+            fold = self._fold or default_casemapping.fold
+            folded = self._folded_target = fold(self.target)
+        return folded
+
+    def __repr__(self):
+        return "<Message {} from {} to {}>".format(self.command, self.source,
+                                                   self.target)
+
+
+class Parser(object):
+    """Turn the data read from a connection into `Message`s. `casefold` is
+    the function used for `Message.folded_source` and `folded_target`.
+    """
+
+    # longest partial line kept while waiting for its end
+    # (IRCv3 allows 8191 bytes of tags on top of the 512 byte message)
+    max_line = 8704
+
+    def __init__(self, casefold=None):
+        self.casefold = casefold
+        self._partial = b''
+
+        # statistics
+        self.lines = 0
+        self.dropped = 0
+
+    def split(self, data):
+        """Return the complete lines in `data`, after any partial line kept
+        from the last call, as decoded strings without line endings.
+        """
+
+        if self._partial:
+            data = self._partial + data
+        end = data.rfind(b'\n')
+        if end < 0:
+            if len(data) > self.max_line:
+                logging.warning("Dropping %d bytes without a line end",
+                                len(data))
+                self.dropped += 1
+                data = b''
+            self._partial = data
+            return []
+
+        view = memoryview(data)
+        self._partial = bytes(view[end + 1:])
+        # one decode for every line; '\n' never occurs inside a UTF-8
+        # sequence, so this is the same as decoding each line
+        text = str(view[:end], 'utf-8', 'ignore')
+        view.release()
+        lines = text.split('\n')
+        if '\r' in text:
+            lines = [l[:-1] if l[-1:] == '\r' else l for l in lines]
+        return lines
+
+    def feed(self, data):
+        """Return a `Message` for each complete line received so far."""
+
+        fold = self.casefold
+        messages = [Message(line, fold) for line in self.split(data) if line]
+        self.lines += len(messages)
+        return messages
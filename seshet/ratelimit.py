@@ -0,0 +1,274 @@
+"""Token bucket rate limiting for command modules.
+
+Each module's limits come from the `rate_limit` json column of the
+`modules` table and are compiled once, when the routing table is built.
+The supported keys are:
+
+    {
+      "rate-limit": 20,            # per channel: one use every 20 seconds
+      "user-rate": 10,             # per user: one use every 10 seconds
+      "global-rate": 2,            # whole module: one use every 2 seconds
+      "amount-limit": 5,           # per user: up to 5 uses...
+      "cooldown": "1 minute",      # ...every minute
+      "group": "games",            # share buckets with other modules
+      "commands": {                # per command, replacing the above
+        "weather": {"rate-limit": 60}
+      }
+    }
+
+`RateLimiter` keeps bucket state in memory and forgets buckets once they
+have refilled, so memory use is bounded by the number of recently active
+users and channels rather than every nick ever seen.
+"""
+
+import heapq
+import logging
+import time
+from collections import OrderedDict
+
+from .utils import Storage
+
+
+_units = {'s': 1, 'sec': 1, 'second': 1,
+          'm': 60, 'min': 60, 'minute': 60,
+          'h': 3600, 'hour': 3600,
+          'd': 86400, 'day': 86400,
+          }
+
+
+def parse_duration(value):
+    """Return a number of seconds from a number or a string like
+    "30 seconds", "1 minute" or "2h".
+    """
+
+    if isinstance(value, (int, float)):
+        return float(value)
+
+    value = value.strip().lower()
+    num = value.rstrip('abcdefghijklmnopqrstuvwxyz ')
+    unit = value[len(num):].strip()
+    if unit.endswith('s') and unit[:-1] in _units:
+        unit = unit[:-1]
+    if not num:
+        num = '1'
+    try:
+        return float(num) * _units[unit or 's']
+    except (KeyError, ValueError):
+        raise ValueError("Can't parse duration: %r" % value)
+
+
+class Rule(object):
+    """One bucket definition: holds up to `capacity` tokens and refills at
+    `rate` tokens per second. `scope` is 'channel', 'user' or 'module'.
+    `kind` tells apart rules of the same scope and `name`, such as
+    'user-rate' and 'amount-limit', so each has buckets of its own.
+    """
+
+    __slots__ = ('scope', 'capacity', 'rate', 'name', 'kind')
+
+    def __init__(self, scope, capacity, period, name, kind=None):
+        self.scope = scope
+        self.capacity = float(capacity)
+        self.rate = self.capacity / period
+        self.name = name
+        self.kind = kind or scope
+
+    @property
+    def period(self):
+        """Seconds for an empty bucket to refill."""
+        return self.capacity / self.rate
+
+    def __repr__(self):
+        return "<Rule {} {}: {:g} per {:g}s>".format(
+            self.name, self.kind, self.capacity, self.period)
+
+
+def _compile_block(block, name):
+    rules = []
+    if 'rate-limit' in block:
+        rules.append(Rule('channel', 1, parse_duration(block['rate-limit']),
+                          name, 'rate-limit'))
+    if 'user-rate' in block:
+        rules.append(Rule('user', 1, parse_duration(block['user-rate']), name,
+                          'user-rate'))
+    if 'global-rate' in block:
+        rules.append(Rule('module', 1, parse_duration(block['global-rate']),
+                          name, 'global-rate'))
+    if 'amount-limit' in block:
+        cooldown = parse_duration(block.get('cooldown', 60))
+        rules.append(Rule('user', int(block['amount-limit']), cooldown, name,
+                          'amount-limit'))
+    return tuple(rules)
+
+
+def compile_rules(module, rate_limit):
+    """Compile a module's `rate_limit` column into a dict of command name
+    (or None for the module-wide default) to a tuple of `Rule`s. Returns an
+    empty dict if the module has no limits.
+    """
+
+    if not rate_limit:
+        return {}
+
+    try:
+        group = rate_limit.get('group') or module
+        rules = {None: _compile_block(rate_limit, group)}
+        for cmd, block in (rate_limit.get('commands') or {}).items():
+            rules[cmd.lower()] = _compile_block(block, '%s:%s' % (group, cmd))
+    except (AttributeError, TypeError, ValueError):
+        logging.exception("Invalid rate_limit for module %s: %r",
+                          module, rate_limit)
+        return {}
+
+    return dict((k, v) for k, v in rules.items() if v)
+
+
+class RateLimiter(object):
+    """Check and consume tokens from module, user and channel buckets.
+
+    If `global_capacity` and `global_period` are set, every command also
+    draws from one bot-wide bucket.
+
+    Buckets are keyed by rule name, kind and user or channel, and stored
+    as `[tokens, last_update, full_at, period]` lists in an `OrderedDict`
+    ordered by last use. `period` is the longest of the rules that have
+    used the bucket, which differ when modules of a group have different
+    limits, and `full_at` is when the bucket will have refilled under all
+    of them. `evict_idle()` drops buckets once they're full, since a
+    missing bucket is the same as a full one, finding them from a heap of
+    those times. At most `max_keys` buckets are
+    kept; past that, the least recently used are dropped even if they
+    haven't refilled, which is logged and counted as `forced` in `stats()`.
+    """
+
+    # seconds between warnings about forced evictions
+    warn_interval = 60.0
+
+    def __init__(self, global_capacity=None, global_period=None,
+                 max_keys=10000):
+        self._buckets = OrderedDict()
+        self._refills = []      # heap of (full_at, key)
+        self._last_warning = None
+
+        self.global_rule = None
+        if global_capacity and global_period:
+            self.global_rule = Rule('module', global_capacity, global_period,
+                                    '*')
+        self.max_keys = max_keys
+
+        # statistics
+        self.allowed = 0
+        self.rejected = 0
+        self.evicted = 0
+        self.forced = 0
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def allow(self, rules, source, channel, exempt=False):
+        """Try to take a token from every bucket in `rules` for a command
+        used by `source` (casefolded nick) in `channel` (casefolded channel,
+        or None for private messages). User buckets are skipped if `exempt`
+        is true, e.g. for whitelisted users.
+
+        Tokens are only taken if all buckets have one, so a rejected command
+        doesn't use up any of the user's other limits.
+        """
+
+        if self.global_rule is not None:
+            rules = (self.global_rule,) + tuple(rules)
+        if not rules:
+            return True
+
+        buckets = self._buckets
+        now = time.monotonic()
+        taken = []
+        for rule in rules:
+            if rule.scope == 'user':
+                if exempt:
+                    continue
+                key = (rule.name, rule.kind, source)
+            elif rule.scope == 'channel':
+                key = (rule.name, rule.kind, channel or source)
+            else:
+                key = (rule.name, rule.kind)
+
+            bucket = buckets.get(key)
+            if bucket is None:
+                tokens = rule.capacity
+            else:
+                tokens = bucket[0] + (now - bucket[1]) * rule.rate
+                if tokens > rule.capacity:
+                    tokens = rule.capacity
+
+            if tokens < 1.0:
+                self.rejected += 1
+                logging.debug("Rate limit %r reached for %s in %s",
+                              rule, source, channel)
+                return False
+            taken.append((key, tokens - 1.0, rule))
+
+        refills = self._refills
+        for key, tokens, rule in taken:
+            full_at = now + (rule.capacity - tokens) / rule.rate
+            bucket = buckets.get(key)
+            if bucket is None:
+                buckets[key] = [tokens, now, full_at, rule.period]
+            else:
+                if bucket[3] > rule.period:
+                    # another rule sharing the bucket refills more slowly
+                    full_at = max(full_at, now + bucket[3])
+                else:
+                    bucket[3] = rule.period
+                bucket[0] = tokens
+                bucket[1] = now
+                bucket[2] = full_at
+                buckets.move_to_end(key)
+            # the bucket's earlier entry, if any, is skipped once it's due
+            heapq.heappush(refills, (full_at, key))
+
+        while len(buckets) > self.max_keys:
+            key, bucket = buckets.popitem(last=False)
+            self.evicted += 1
+            if bucket[2] > now:
+                self._forced(key, now)
+
+        if len(refills) > 2 * len(buckets) + 64:
+            # drop the entries of buckets since used again or evicted
+            self._refills = [(b[2], k) for k, b in buckets.items()]
+            heapq.heapify(self._refills)
+
+        self.allowed += 1
+        return True
+
+    def _forced(self, key, now):
+        self.forced += 1
+        last = self._last_warning
+        if last is None or now - last >= self.warn_interval:
+            self._last_warning = now
+            logging.warning("Rate limiter has more than %d buckets; "
+                            "dropped %r before it refilled (%d so far)",
+                            self.max_keys, key, self.forced)
+
+    def evict_idle(self):
+        """Drop buckets that have refilled completely under their rules."""
+
+        buckets = self._buckets
+        refills = self._refills
+        now = time.monotonic()
+        while refills and refills[0][0] <= now:
+            full_at, key = heapq.heappop(refills)
+            bucket = buckets.get(key)
+            if bucket is not None and bucket[2] == full_at:
+                del buckets[key]
+                self.evicted += 1
+
+    def stats(self):
+        """Return a `Storage` of rate limiter statistics."""
+
+        return Storage(buckets=len(self._buckets),
+                       allowed=self.allowed,
+                       rejected=self.rejected,
+                       evicted=self.evicted,
+                       forced=self.forced,
+                       )
@@ -0,0 +1,193 @@
+"""Route IRC events to command modules without querying the database.
+
+`ModuleRouter` reads the `modules` table once and keeps an in-memory index
+of enabled modules by event type. The index is rebuilt after `invalidate()`
+is called, or when it's older than `max_age` seconds so that changes made
+to the table by other processes are still picked up.
+
+`CommandIndex` maps each prefixed command of every enabled module to its
+handler so a message's first word can be resolved with one dict lookup.
+"""
+
+import logging
+import time
+
+from .ratelimit import compile_rules
+from .utils import upper_to_lower
+
+
+def irc_casefold(s):
+    """Lowercase `s` using the RFC 1459 case mapping."""
+    return str(s).translate(upper_to_lower)
+
+
+class ModuleRoute(object):
+    """One enabled module's row from the `modules` table, with its channel
+    and nick lists converted to casefolded sets for fast membership tests.
+    """
+
+    __slots__ = ('id', 'name', 'event_types', 'cmd_prefix',
+                 'echannels', 'dchannels', 'enicks', 'dnicks',
+                 'whitelist', 'blacklist', 'acl', 'rate_limit',
+                 'exec_mode', 'timeout', 'rate_rules')
+
+    def __init__(self, row, casefold=irc_casefold):
+        def folded(values):
+            return frozenset(casefold(v) for v in values or ())
+
+        self.id = row.id
+        self.name = row.name
+        self.event_types = tuple(row.event_types or ())
+        self.cmd_prefix = row.cmd_prefix
+        self.echannels = folded(row.echannels)
+        self.dchannels = folded(row.dchannels)
+        self.enicks = folded(row.enicks)
+        self.dnicks = folded(row.dnicks)
+        self.whitelist = folded(row.whitelist)
+        self.blacklist = folded(row.blacklist)
+        self.acl = row.acl
+        self.rate_limit = row.rate_limit
+        self.rate_rules = compile_rules(row.name, row.rate_limit)
+        self.exec_mode = row.get('exec_mode') or 'inline'
+        self.timeout = row.get('timeout')
+
+    def __repr__(self):
+        return "<ModuleRoute {} for {}>".format(self.name,
+                                                 ', '.join(self.event_types))
+
+
+class ModuleRouter(object):
+    """In-memory routing table built from the `modules` table.
+
+    Call `invalidate()` whenever module configuration changes; the table
+    is rebuilt lazily on the next lookup. `version` is bumped by every
+    invalidation and can be compared cheaply by other caches built from
+    the same table.
+    """
+
+    def __init__(self, db, max_age=60.0, casefold=irc_casefold):
+        self._db = db
+        self._routes = {}
+        self._all = ()
+        self._built_version = None
+        self._built_at = 0.0
+
+        self.casefold = casefold
+        self.max_age = max_age
+        self.version = 0
+        self.rebuilds = 0
+
+    def invalidate(self):
+        """Mark the routing table as stale."""
+        self.version += 1
+
+    def is_stale(self):
+        if self._built_version != self.version:
+            return True
+        if self.max_age and time.monotonic() - self._built_at > self.max_age:
+            return True
+        return False
+
+    def rebuild(self):
+        """Read all enabled modules and rebuild the routing table."""
+
+        db = self._db
+        rows = db(db.modules.enabled == True).select()
+
+        routes = {}
+        all_routes = []
+        for row in rows:
+            route = ModuleRoute(row, self.casefold)
+            all_routes.append(route)
+            for etype in route.event_types:
+                routes.setdefault(etype, []).append(route)
+
+        self._routes = dict((k, tuple(v)) for k, v in routes.items())
+        self._all = tuple(all_routes)
+        self._built_version = self.version
+        self._built_at = time.monotonic()
+        self.rebuilds += 1
+        logging.debug("Rebuilt module routing table: %s", self._routes)
+
+    def routes(self, event_type):
+        """Return a tuple of `ModuleRoute`s for enabled modules handling
+        `event_type`.
+        """
+
+        if self.is_stale():
+            self.rebuild()
+        return self._routes.get(event_type, ())
+
+    def all_routes(self):
+        """Return a tuple of `ModuleRoute`s for every enabled module."""
+
+        if self.is_stale():
+            self.rebuild()
+        return self._all
+
+
+class CommandIndex(object):
+    """Index of `(cmd_prefix, command)` to the `(ModuleRoute, handler)`
+    pairs of every enabled module registering it, in module id order.
+
+    Command names are matched case-insensitively. The index is rebuilt
+    whenever `router` rebuilds its table or `loader` loads or reloads a
+    module. If more than one module registers the same prefixed command,
+    each of them is a candidate, subject to its own event types and
+    channel and nick filters; the clash is logged and recorded in
+    `collisions` as `{(prefix, command): [module names]}`.
+    """
+
+    def __init__(self, router, loader):
+        self._router = router
+        self._loader = loader
+        self._index = {}
+        self._built_for = None
+        self._dirty = True
+
+        self.collisions = {}
+
+        loader.listeners.append(self._module_loaded)
+
+    def _module_loaded(self, name, module, action):
+        self._dirty = True
+
+    def invalidate(self):
+        self._dirty = True
+
+    def rebuild(self):
+        routes = self._router.all_routes()
+
+        index = {}
+        owners = {}
+        for route in sorted(routes, key=lambda r: r.id):
+            m = self._loader.get(route.name)
+            if m is None:
+                continue
+            for cmd, fun in getattr(m, 'commands', {}).items():
+                key = (route.cmd_prefix, cmd.lower())
+                owners.setdefault(key, []).append(route.name)
+                index.setdefault(key, []).append((route, fun))
+
+        self.collisions = dict((k, v) for k, v in owners.items()
+                               if len(v) > 1)
+        for (prefix, cmd), names in self.collisions.items():
+            logging.warning("Command %s%s is registered by more than one "
+                            "module: %s.", prefix, cmd, ', '.join(names))
+
+        self._index = dict((k, tuple(v)) for k, v in index.items())
+        self._built_for = self._router.rebuilds
+        self._dirty = False
+
+    def lookup(self, word):
+        """Return a tuple of `(ModuleRoute, handler)` pairs for a message's
+        first word, in module id order; empty if it isn't a registered
+        command.
+        """
+
+        # make sure the router is current first; it may rebuild here
+        self._router.all_routes()
+        if self._dirty or self._built_for != self._router.rebuilds:
+            self.rebuild()
+
+        return self._index.get((word[:1], word[1:].lower()), ())
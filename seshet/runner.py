@@ -0,0 +1,193 @@
+"""Run bots for several IRC networks in one process, on one event loop.
+
+A `Runner` builds a `SeshetBot` from each config file with
+`seshet.config.build_bot()`. The bots share one `ModuleLoader`, so each
+command module is imported once, and one `HandlerPool` of worker threads
+and processes, while each keeps its own database, key/value store and
+network state:
+
+    runner = Runner()
+    runner.add('freenode.cfg')
+    runner.add('oftc.cfg')
+    runner.start()
+
+A network that disconnects or fails doesn't stop the others. Throughput
+per network and in total is logged every `report_interval` seconds and
+is available from `stats()`.
+"""
+
+import asyncio
+import logging
+import os
+import sys
+import time
+
+from .config import build_bot
+from .loader import ModuleLoader
+from .utils import Storage
+from .workers import HandlerPool
+
+
+class Runner(object):
+    """Supervisor for several `SeshetBot`s sharing one event loop. Bots
+    are kept in `bots` by network name.
+    """
+
+    def __init__(self, workers=None, loader=None, report_interval=60.0):
+        self.workers = workers if workers is not None else HandlerPool()
+        self.loader = loader if loader is not None else ModuleLoader()
+        self.report_interval = report_interval
+        self.bots = {}
+        self.started = None
+        self._last_report = None
+
+        self.loader.listeners.append(self._module_loaded)
+
+    def _module_loaded(self, name, module, action):
+        # the bots leave the shared pool to us; restart once, not per bot
+        if action == 'reload':
+            self.workers.restart(name)
+
+    def add(self, config_file, name=None):
+        """Build a bot from `config_file` (a path or a `ConfigParser`) and
+        set up its connection. `name` defaults to the config file's name
+        without extension, or the server for a `ConfigParser`. Returns the
+        bot.
+        """
+
+        bot = build_bot(config_file, self.workers, self.loader)
+        if name is None:
+            if isinstance(config_file, str):
+                name = os.path.splitext(os.path.basename(config_file))[0]
+            else:
+                name = bot.default_host
+        if name in self.bots:
+            raise ValueError("A network named %s was already added" % name)
+
+        bot.connect()
+        self.bots[name] = bot
+        return bot
+
+    def start(self):
+        """Run every bot on a new event loop until all have disconnected."""
+        asyncio.run(self.run())
+
+    async def run(self):
+        """Run every bot on the running event loop until all have
+        disconnected.
+        """
+
+        loop = asyncio.get_running_loop()
+        self.workers.wakeup = lambda: loop.call_soon_threadsafe(self._wake_all)
+        self.started = time.monotonic()
+        self._last_report = (self.started, self._counts())
+
+        names = list(self.bots)
+        reporter = None
+        if self.report_interval:
+            reporter = loop.create_task(self._report_loop())
+        try:
+            results = await asyncio.gather(
+                *(self.bots[name].run() for name in names),
+                return_exceptions=True)
+        finally:
+            if reporter is not None:
+                reporter.cancel()
+            self.workers.wakeup = None
+            self.workers.shutdown()
+
+        for name, result in zip(names, results):
+            if isinstance(result, BaseException):
+                logging.error("Network %s stopped with an error", name,
+                              exc_info=(type(result), result,
+                                        result.__traceback__))
+        self.report()
+
+    def _wake_all(self):
+        # whichever bot runs first processes the shared pool's results
+        for bot in self.bots.values():
+            bot.wake()
+
+    def _counts(self):
+        counts = {}
+        for name, bot in self.bots.items():
+            conn = bot.conn
+            counts[name] = (conn.lines_in, conn.lines_out)
+        return counts
+
+    def _throughput(self, since, since_counts):
+        elapsed = max(time.monotonic() - since, 1e-9)
+        networks = {}
+        total_in = total_out = 0
+        for name, (lines_in, lines_out) in self._counts().items():
+            in_0, out_0 = since_counts.get(name, (0, 0))
+            total_in += lines_in - in_0
+            total_out += lines_out - out_0
+            networks[name] = Storage(
+                connected=self.bots[name].conn.connected,
+                lines_in=lines_in - in_0,
+                lines_out=lines_out - out_0,
+                in_rate=(lines_in - in_0) / elapsed,
+                out_rate=(lines_out - out_0) / elapsed,
+                )
+        return Storage(seconds=elapsed,
+                       networks=networks,
+                       lines_in=total_in,
+                       lines_out=total_out,
+                       in_rate=total_in / elapsed,
+                       out_rate=total_out / elapsed,
+                       )
+
+    def stats(self):
+        """Return a `Storage` of the lines received and sent, and lines per
+        second, since the runner started: for each network in `networks`
+        and in total.
+        """
+
+        if self.started is None:
+            return self._throughput(time.monotonic(), self._counts())
+        return self._throughput(self.started, {})
+
+    def report(self):
+        """Log the throughput of each network and in total since the last
+        report, and return it as from `stats()`.
+        """
+
+        if self._last_report is None:
+            self._last_report = (time.monotonic(), self._counts())
+        since, since_counts = self._last_report
+        self._last_report = (time.monotonic(), self._counts())
+        tp = self._throughput(since, since_counts)
+
+        for name, net in sorted(tp.networks.items()):
+            logging.info("%s: %.1f lines/s in, %.1f lines/s out%s", name,
+                         net.in_rate, net.out_rate,
+                         '' if net.connected else ' (disconnected)')
+        logging.info("All networks: %.1f lines/s in, %.1f lines/s out",
+                     tp.in_rate, tp.out_rate)
+        return tp
+
+    async def _report_loop(self):
+        while True:
+            await asyncio.sleep(self.report_interval)
+            self.report()
+
+
+def main(argv=None):
+    """Run a bot for each config file given on the command line:
+
+        python -m seshet.runner freenode.cfg oftc.cfg
+    """
+
+    paths = sys.argv[1:] if argv is None else argv
+    if not paths:
+        sys.exit("usage: python -m seshet.runner CONFIG [CONFIG ...]")
+
+    runner = Runner()
+    for path in paths:
+        runner.add(path)
+    runner.start()
+
+
+if __name__ == '__main__':
+    main()
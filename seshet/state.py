@@ -0,0 +1,531 @@
+"""Data structures for the network state tracked by the bot.
+
+`Membership` is the index of which users are in which channels. Every
+join, part, kick, quit and nick change goes through it so each operation
+only touches the memberships it affects.
+
+`MessageLog` is the fixed-size cache of recent messages kept for each
+channel, which modules can search without querying the database.
+
+`memory_usage()` estimates how much memory all of this takes.
+
+`save_snapshot()` writes the users, channels and message logs to a file
+that `Snapshot` reads back after a restart, so the bot can restore them as
+it rejoins its channels.
+"""
+
+import logging
+import marshal
+import mmap
+import os
+import struct
+import sys
+import time
+from datetime import datetime, timedelta
+
+from .utils import IRCDict, IRCSet, Storage, default_casemapping
+
+
+class Membership(object):
+    """Bidirectional index of channel membership.
+
+    The channel to nicks direction is each `SeshetChannel.users` set. The
+    nick to channels direction is kept here as a tuple of small integer
+    channel ids for each nick, whose length is that user's reference count:
+    a user whose count drops to zero is no longer visible to the bot.
+
+    A channel is given an id (stored in `SeshetChannel.id`) the first time
+    someone joins it, and the id is reused once the channel is dropped.
+    """
+
+    def __init__(self, casemapping=None):
+        self._map = casemapping or default_casemapping
+        self._user_chans = IRCDict(casemapping=self._map)
+        self._channels = {}     # id -> SeshetChannel
+        self._free_ids = []
+
+    def __contains__(self, nick):
+        return nick in self._user_chans
+
+    def _channel_id(self, channel):
+        cid = channel.id
+        if cid is None or self._channels.get(cid) is not channel:
+            if self._free_ids:
+                cid = self._free_ids.pop()
+            else:
+                cid = len(self._channels)
+            channel.id = cid
+            self._channels[cid] = channel
+        return cid
+
+    def join(self, nick, channel):
+        """Record `nick` as present in `channel`."""
+
+        cid = self._channel_id(channel)
+        ids = self._user_chans.get(nick, ())
+        if cid not in ids:
+            self._user_chans[nick] = ids + (cid,)
+        channel.users.add(nick)
+
+    def part(self, nick, channel):
+        """Record `nick` leaving `channel`. Returns True if the user is no
+        longer in any channel the bot is in.
+        """
+
+        channel.users.discard(nick)
+        ids = self._user_chans.get(nick)
+        if ids is None:
+            return True
+        ids = tuple(i for i in ids if i != channel.id)
+        if not ids:
+            del self._user_chans[nick]
+            return True
+        self._user_chans[nick] = ids
+        return False
+
+    def quit(self, nick):
+        """Remove `nick` from every channel. Returns the list of channels
+        the user was in.
+        """
+
+        ids = self._user_chans.pop(nick, None)
+        if ids is None:
+            return []
+        chans = [self._channels[i] for i in ids]
+        for c in chans:
+            c.users.discard(nick)
+        return chans
+
+    def rename(self, old, new):
+        """Move all of `old`'s memberships to `new`."""
+
+        ids = self._user_chans.pop(old, None)
+        if ids is None:
+            return
+        for i in ids:
+            users = self._channels[i].users
+            users.discard(old)
+            users.add(new)
+        self._user_chans[new] = ids
+
+    def drop_channel(self, channel):
+        """Remove every membership of `channel`, e.g. when the bot leaves it.
+        Returns the nicks that are no longer in any channel.
+
+        Only the channel's own members are visited.
+        """
+
+        cid = channel.id
+        orphans = []
+        if cid is not None and self._channels.get(cid) is channel:
+            user_chans = self._user_chans
+            for nick in list(channel.users):
+                ids = user_chans.get(nick)
+                if ids is None:
+                    continue
+                ids = tuple(i for i in ids if i != cid)
+                if ids:
+                    user_chans[nick] = ids
+                else:
+                    del user_chans[nick]
+                    orphans.append(nick)
+            del self._channels[cid]
+            self._free_ids.append(cid)
+        channel.id = None
+        channel.users.clear()
+        return orphans
+
+    def channels_of(self, nick):
+        """Return a list of the `SeshetChannel`s `nick` is in."""
+
+        channels = self._channels
+        return [channels[i] for i in self._user_chans.get(nick, ())]
+
+    def count(self, nick):
+        """Return the number of channels `nick` is in."""
+        return len(self._user_chans.get(nick, ()))
+
+    def unique_users(self, channel):
+        """Return an `IRCSet` of the members of `channel` who aren't in any
+        other channel the bot is in.
+        """
+
+        user_chans = self._user_chans
+        return IRCSet((n for n in channel.users
+                       if len(user_chans.get(n, ())) <= 1), self._map)
+
+
+class MessageLog(object):
+    """Ring buffer of the last `size` messages in a channel.
+
+    Entries are `(time, nick, message)` tuples, oldest first. Appending is
+    O(1) and overwrites the oldest entry once the log is full. The log
+    supports `len()`, iteration, `reversed()`, indexing and slicing like a
+    list (a slice is a new list), and the query methods below walk the
+    buffer in place instead of copying it.
+
+    Times are kept in non-decreasing order (a time earlier than the last
+    entry's, e.g. after the clock is adjusted, is raised to match it) so
+    `since()` can use a binary search.
+    """
+
+    def __init__(self, size=100):
+        self._entries = [None] * size
+        self._next = 0      # index the next entry is written to
+        self._count = 0
+        self.size = size
+
+    def __len__(self):
+        return self._count
+
+    def _index(self, i):
+        # buffer index of the i-th oldest entry
+        return (self._next - self._count + i) % self.size
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            entries = self._entries
+            return [entries[self._index(j)]
+                    for j in range(*i.indices(self._count))]
+        if i < 0:
+            i += self._count
+        if not 0 <= i < self._count:
+            raise IndexError("MessageLog index out of range")
+        return self._entries[self._index(i)]
+
+    def __iter__(self):
+        entries = self._entries
+        for i in range(self._count):
+            yield entries[self._index(i)]
+
+    def __reversed__(self):
+        entries = self._entries
+        for i in range(self._count - 1, -1, -1):
+            yield entries[self._index(i)]
+
+    def append(self, time, nick, message):
+        """Add a message, dropping the oldest one if the log is full."""
+
+        if not self.size:
+            return
+        if self._count:
+            last = self._entries[(self._next - 1) % self.size][0]
+            if time < last:
+                time = last
+        self._entries[self._next] = (time, nick, message)
+        self._next = (self._next + 1) % self.size
+        if self._count < self.size:
+            self._count += 1
+
+    def merge(self, entries):
+        """Add `(time, nick, message)` entries logged elsewhere, e.g. saved
+        in a snapshot, in time order among the entries already here. Where
+        times are equal, `entries` go first. Only the newest `size` are
+        kept.
+        """
+
+        if not self.size:
+            return
+        live = list(self)
+        merged = sorted(list(entries) + live, key=lambda entry: entry[0])
+        self.clear()
+        for entry in merged[-self.size:]:
+            self.append(*entry)
+
+    def clear(self):
+        self._entries = [None] * self.size
+        self._next = self._count = 0
+
+    def resize(self, size):
+        """Change the capacity of the log, keeping the newest entries."""
+
+        keep = list(self)[-size:] if size else []
+        self._entries = keep + [None] * (size - len(keep))
+        self._count = len(keep)
+        self._next = self._count % size if size else 0
+        self.size = size
+
+    def last(self, n=1, nick=None):
+        """Return up to `n` of the newest messages, newest first, optionally
+        only those from `nick`.
+        """
+
+        found = []
+        if n <= 0:
+            return found
+        for entry in reversed(self):
+            if nick is None or entry[1] == nick:
+                found.append(entry)
+                if len(found) == n:
+                    break
+        return found
+
+    def last_from(self, nick):
+        """Return the newest message from `nick`, or None."""
+
+        found = self.last(1, nick)
+        return found[0] if found else None
+
+    def _bisect(self, time):
+        # position of the first entry at or after `time`
+        lo, hi = 0, self._count
+        entries = self._entries
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if entries[self._index(mid)][0] < time:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def since(self, time):
+        """Iterate over messages logged at or after `time`, oldest first."""
+
+        entries = self._entries
+        for i in range(self._bisect(time), self._count):
+            yield entries[self._index(i)]
+
+    def search(self, pattern, nick=None, limit=None):
+        """Iterate over messages matching `pattern`, newest first.
+
+        `pattern` is a substring to look for, or a compiled regular
+        expression whose `search()` is used. Only messages from `nick` are
+        checked if it's given, and at most `limit` are returned.
+        """
+
+        if hasattr(pattern, 'search'):
+            match = pattern.search
+        else:
+            def match(message):
+                return pattern in message
+
+        found = 0
+        for entry in reversed(self):
+            if nick is not None and entry[1] != nick:
+                continue
+            if match(entry[2]):
+                yield entry
+                found += 1
+                if limit is not None and found >= limit:
+                    return
+
+    def __repr__(self):
+        return "<MessageLog {}/{} messages>".format(self._count, self.size)
+
+
+def _sizeof(seen, *objs):
+    # shallow size of each object not already counted
+    total = 0
+    for o in objs:
+        if o is None or id(o) in seen:
+            continue
+        seen.add(id(o))
+        total += sys.getsizeof(o)
+    return total
+
+
+def memory_usage(users, channels, membership):
+    """Estimate the memory used by the bot's network state.
+
+    `users` and `channels` are the bot's `IRCDict`s of `SeshetUser` and
+    `SeshetChannel`. Returns a `Storage` with the total bytes used by users
+    (including their entries in `users` and `membership`) and by channels
+    (including their user sets and message logs), and the average bytes
+    per user and per channel. Strings shared between objects, like
+    interned hosts and casefolded nicks, are only counted once.
+    """
+
+    seen = set()
+
+    user_chans = membership._user_chans
+    user_bytes = _sizeof(seen, users, users._data,
+                         user_chans, user_chans._data)
+    for folded, entry in users._data.items():
+        nick, u = entry
+        user_bytes += _sizeof(seen, folded, entry, nick, u,
+                              u.nick, u.user, u.host, u.account)
+    for folded, entry in user_chans._data.items():
+        user_bytes += _sizeof(seen, folded, entry, entry[0], entry[1])
+
+    channel_bytes = _sizeof(seen, channels, channels._data,
+                            membership._channels)
+    for c in channels.values():
+        log = c.message_log
+        channel_bytes += _sizeof(seen, c, c.name, c.users, c.users._data,
+                                 log, log._entries)
+        for folded, nick in c.users._data.items():
+            channel_bytes += _sizeof(seen, folded, nick)
+        for entry in log:
+            channel_bytes += _sizeof(seen, entry, *entry)
+
+    return Storage(users=len(users),
+                   user_bytes=user_bytes,
+                   bytes_per_user=user_bytes // len(users) if users else 0,
+                   channels=len(channels),
+                   channel_bytes=channel_bytes,
+                   bytes_per_channel=(channel_bytes // len(channels)
+                                      if channels else 0),
+                   )
+
+
+# Snapshot file layout: magic, the length of the index, the marshalled
+# index, then one marshalled section per channel plus one for users.
+# Offsets in the index are relative to the end of the index.
+SNAPSHOT_MAGIC = b'SESHSNP1'
+_index_len = struct.Struct('<I')
+_epoch = datetime(1970, 1, 1)
+
+
+def _timestamp(dt):
+    return (dt - _epoch).total_seconds()
+
+
+def save_snapshot(path, users, channels):
+    """Write `users` and `channels` (the bot's `IRCDict`s) to `path`.
+
+    The file is written under a temporary name and then renamed over
+    `path`, so a crash while saving never leaves a partial snapshot.
+    """
+
+    sections = []
+    offset = 0
+
+    def add(data):
+        nonlocal offset
+        data = marshal.dumps(data)
+        sections.append(data)
+        start, offset = offset, offset + len(data)
+        return (start, len(data))
+
+    user_rows = [(str(u.nick), u.user, u.host) for u in users.values()]
+    index = {'saved': time.time(),
+             'users': add(user_rows),
+             'channels': {},
+             }
+    for c in channels.values():
+        log = [(_timestamp(t), str(n), m) for t, n, m in c.message_log]
+        index['channels'][c.name.lower()] = add(
+            (str(c.name), [str(n) for n in c.users], log))
+
+    index = marshal.dumps(index)
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(SNAPSHOT_MAGIC)
+        f.write(_index_len.pack(len(index)))
+        f.write(index)
+        for data in sections:
+            f.write(data)
+    os.replace(tmp, path)
+
+
+class Snapshot(object):
+    """Read-only view of a file written by `save_snapshot()`.
+
+    The file is memory-mapped and only its index is decoded when it's
+    opened; each channel is decoded when it's asked for. Channel names are
+    looked up casefolded with `casefold`. Raises `ValueError` if the file
+    isn't a snapshot.
+    """
+
+    def __init__(self, path, casefold=None):
+        self.path = path
+        self._fold = casefold or default_casemapping.fold
+        self._users = None
+        with open(path, 'rb') as f:
+            try:
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # empty file
+                raise ValueError("%s is not a seshet snapshot" % path)
+
+        m = self._mmap
+        header = len(SNAPSHOT_MAGIC) + _index_len.size
+        if len(m) < header or m[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+            m.close()
+            raise ValueError("%s is not a seshet snapshot" % path)
+        (size,) = _index_len.unpack_from(m, len(SNAPSHOT_MAGIC))
+        try:
+            index = marshal.loads(m[header:header + size])
+        except (EOFError, ValueError, TypeError):
+            m.close()
+            raise ValueError("%s is a damaged seshet snapshot" % path)
+
+        self._base = header + size
+        self.saved = index['saved']
+        self._user_section = index['users']
+        # channel sections by casefolded name; removed once taken
+        self._channels = dict((self._fold(k), v)
+                              for k, v in index['channels'].items())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return len(self._channels)
+
+    def _section(self, where):
+        start, length = where
+        start += self._base
+        return marshal.loads(self._mmap[start:start + length])
+
+    def channel_names(self):
+        """Casefolded names of the channels not taken yet."""
+        return list(self._channels)
+
+    def take_channel(self, name):
+        """Decode and remove the saved state of channel `name`.
+
+        Returns `(name, nicks, log)`, where `log` is a list of
+        `(datetime, nick, message)` tuples, or None if the channel isn't
+        in the snapshot or its section is damaged.
+        """
+
+        where = self._channels.pop(self._fold(name), None)
+        if where is None:
+            return None
+        try:
+            name, nicks, log = self._section(where)
+            log = [(_epoch + timedelta(seconds=t), n, msg)
+                   for t, n, msg in log]
+        except (EOFError, ValueError, TypeError, OverflowError):
+            logging.warning("Damaged section for %s in snapshot %s",
+                            name, self.path)
+            return None
+        return name, nicks, log
+
+    def keep_channels(self, names):
+        """Forget every channel not in `names`, e.g. those the bot won't
+        rejoin.
+        """
+
+        keep = set(map(self._fold, names))
+        for name in list(self._channels):
+            if name not in keep:
+                del self._channels[name]
+
+    def user(self, nick):
+        """Return the saved `(user, host)` of `nick`, or None."""
+
+        if self._users is None:
+            try:
+                self._users = dict(
+                    (self._fold(n), (u, h))
+                    for n, u, h in self._section(self._user_section))
+            except (EOFError, ValueError, TypeError, OverflowError):
+                logging.warning("Damaged users section in snapshot %s",
+                                self.path)
+                self._users = {}
+        return self._users.get(self._fold(nick))
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        self._users = None
+
+    def __repr__(self):
+        return "<Snapshot {} with {} channels>".format(self.path,
+                                                       len(self._channels))
@@ -0,0 +1,374 @@
+"""Find out who is in the channels the bot joins, with their hosts.
+
+From a plain NAMES reply the bot only learns the nicks in a channel, and
+ircutils3's handling of it strips no more than one status symbol from
+each. `UserSync` fills in the rest for a `SeshetBot`:
+
+* While registering, it asks for the IRCv3 capabilities in `caps` with
+  CAP. With `multi-prefix`, NAMES replies list every status symbol of a
+  member, and with `userhost-in-names`, their ident and host as well.
+* `NamesListener` replaces ircutils3's listener for NAMES replies. Its
+  `NamesEvent`s have each member's status symbols and, if sent, ident
+  and host, as well as the nicks.
+* After joining a channel, the bot sends one WHO for the whole channel,
+  rather than one for each member, unless NAMES has already given their
+  hosts. If the server supports WHOX, the WHO asks for only the fields
+  used, including the account each member is logged in to. No more than
+  `max_pending` WHOs are waiting for replies at once, and the next one is
+  sent as one ends, so joining hundreds of channels doesn't flood the
+  server or the bot's send queue.
+* The replies to a WHO are collected and applied to the bot's users in
+  one pass once RPL_ENDOFWHO arrives.
+
+`stats()` reports the capabilities in use and how long WHOs took.
+"""
+
+import collections
+import logging
+import sys
+import time
+
+from ircutils3 import events
+
+from .utils import Storage
+
+
+# marks replies to our WHOX queries; see `UserSync._send_who()`
+WHOX_TOKEN = '152'
+
+# asks for token, channel, ident, host, nick and account
+WHOX_FIELDS = '%tcuhna'
+
+default_caps = ('multi-prefix', 'userhost-in-names')
+
+
+def prefix_symbols(isupport):
+    """Return the channel status symbols of a server, such as '@+', from
+    its RPL_ISUPPORT tokens.
+    """
+
+    prefix = isupport.get('PREFIX')
+    if not isinstance(prefix, str):
+        return '~&@%+'
+    return prefix.partition(')')[2]
+
+
+def parse_names(names, symbols='@+'):
+    """Parse the names of one RPL_NAMREPLY. Returns a list of
+    `(nick, prefixes, user, host)` tuples, with user and host None unless
+    names are given as nick!user@host.
+    """
+
+    members = []
+    for name in names.split():
+        nick = name.lstrip(symbols)
+        prefixes = name[:len(name) - len(nick)]
+        if '!' in nick:
+            nick, _, userhost = nick.partition('!')
+            user, _, host = userhost.partition('@')
+            members.append((nick, prefixes, user, host or None))
+        else:
+            members.append((nick, prefixes, None, None))
+    return members
+
+
+class NamesEvent(events.Event):
+    """The whole NAMES reply for a channel. `name_list` is the nicks in
+    the channel, `prefixes` maps nicks to their status symbols, and
+    `hosts` maps nicks to `(user, host)` if the server sent them.
+    """
+
+    def __init__(self, channel):
+        self.command = 'NAMES'
+        self.channel = channel
+        self.name_list = []
+        self.prefixes = {}
+        self.hosts = {}
+
+
+class NamesListener(events.EventListener):
+    """Collect RPL_NAMREPLY lines into a `NamesEvent` for each channel and
+    activate its handlers at RPL_ENDOFNAMES. The client's `casemapping`
+    and `isupport` are used to match channels and strip status symbols.
+    """
+
+    def __init__(self):
+        events.EventListener.__init__(self)
+        self._replies = {}
+
+    def notify(self, client, event):
+        command = event.command
+        if command == 'RPL_NAMREPLY':
+            # <me> ( "=" / "*" / "@" ) <channel> :[prefix]<nick>{ [prefix]<nick>}
+            if len(event.params) < 3:
+                return
+            channel = event.params[1]
+            key = client.casemapping.fold(channel)
+            names = self._replies.get(key)
+            if names is None:
+                names = self._replies[key] = NamesEvent(channel)
+            symbols = prefix_symbols(client.isupport)
+            for nick, prefixes, user, host in parse_names(event.params[2],
+                                                          symbols):
+                names.name_list.append(nick)
+                if prefixes:
+                    names.prefixes[nick] = prefixes
+                if user is not None:
+                    names.hosts[nick] = (user, host)
+        elif command == 'RPL_ENDOFNAMES':
+            # <me> <channel> :End of NAMES list
+            if not event.params:
+                return
+            channel = event.params[0]
+            names = self._replies.pop(client.casemapping.fold(channel), None)
+            if names is None:
+                # an empty or unknown channel
+                names = NamesEvent(channel)
+            self.activate_handlers(client, names)
+
+
+class _Who(object):
+    """A WHO sent for a channel and the replies collected so far."""
+
+    __slots__ = ('channel', 'sent', 'rows', 'timer')
+
+    def __init__(self, channel, sent, timer):
+        self.channel = channel
+        self.sent = sent
+        self.rows = []
+        self.timer = timer
+
+
+class UserSync(object):
+    """Keep `bot.users` filled in with the idents, hosts and accounts of
+    the members of the bot's channels. `notify()` is added as a handler for
+    every event; `SeshetBot` does this itself.
+
+    `caps` is the capabilities to ask for, `who_on_join` whether to send a
+    WHO after joining a channel, `max_pending` the number of WHOs that may
+    wait for replies at once, and `timeout` the seconds after which one
+    that never ended is given up on.
+    """
+
+    def __init__(self, bot, caps=default_caps, who_on_join=True,
+                 max_pending=1, timeout=30.0):
+        self.bot = bot
+        self.caps = list(caps)
+        self.who_on_join = who_on_join
+        self.max_pending = max_pending
+        self.timeout = timeout
+
+        self.enabled = set()        # capabilities the server acknowledged
+        self._offered = set()
+        self._negotiating = False
+        self._queue = collections.OrderedDict()   # folded channel -> name
+        self._pending = {}                         # folded channel -> _Who
+
+        # statistics
+        self.synced = 0
+        self.timeouts = 0
+        self.users_updated = 0
+        self._time_total = 0.0
+        self._time_max = 0.0
+
+    def start(self):
+        """Begin CAP negotiation. Called as the connection is set up,
+        before the bot registers with USER and NICK.
+        """
+
+        self.reset()
+        if self.caps:
+            self._negotiating = True
+            self.bot.execute("CAP", "LS", "302")
+
+    def reset(self):
+        """Forget capabilities and drop queued and pending WHOs."""
+
+        self.enabled.clear()
+        self._offered.clear()
+        self._negotiating = False
+        self._queue.clear()
+        for who in self._pending.values():
+            who.timer.cancel()
+        self._pending.clear()
+
+    def notify(self, client, e):
+        """Event handler for every event."""
+
+        command = e.command
+        if command == 'RPL_WHOSPCRPL':
+            self._whox_reply(e)
+        elif command == 'RPL_WHOREPLY':
+            self._who_reply(e)
+        elif command == 'RPL_ENDOFWHO':
+            if e.params:
+                self._finish(client.casemapping.fold(e.params[0]))
+        elif command == 'JOIN':
+            if self.who_on_join and client.is_me(e.source):
+                self.queue(e.target)
+        elif command == 'CAP':
+            self._cap(e)
+        elif command == 'RPL_WELCOME':
+            # servers without CAP register without it
+            self._negotiating = False
+        elif command == 'CONN_DISCONNECT':
+            self.reset()
+
+    # capability negotiation
+
+    def _cap(self, e):
+        # CAP <nick or *> <subcommand> [*] :<capabilities>
+        if len(e.params) < 2:
+            return
+        sub = e.params[0].upper()
+        names = [c.partition('=')[0] for c in e.params[-1].split()]
+        if sub in ('LS', 'NEW'):
+            self._offered.update(names)
+            if sub == 'LS' and len(e.params) > 2 and e.params[1] == '*':
+                # more to come
+                return
+            wanted = [c for c in self.caps
+                      if c in self._offered and c not in self.enabled]
+            if wanted:
+                self.bot.execute("CAP", "REQ", trailing=' '.join(wanted))
+            else:
+                self._end_negotiation()
+        elif sub == 'ACK':
+            for name in names:
+                if name.startswith('-'):
+                    self.enabled.discard(name[1:])
+                else:
+                    self.enabled.add(name)
+            logging.info("Enabled capabilities: %s",
+                         ' '.join(sorted(self.enabled)))
+            self._end_negotiation()
+        elif sub == 'NAK':
+            logging.warning("Server refused capabilities: %s",
+                            ' '.join(names))
+            self._end_negotiation()
+        elif sub == 'DEL':
+            self._offered.difference_update(names)
+            self.enabled.difference_update(names)
+
+    def _end_negotiation(self):
+        if self._negotiating:
+            self._negotiating = False
+            self.bot.execute("CAP", "END")
+
+    # channel WHOs
+
+    def _needs_who(self):
+        # with userhost-in-names, only WHOX adds anything (accounts)
+        return ('WHOX' in self.bot.isupport
+                or 'userhost-in-names' not in self.enabled)
+
+    def queue(self, channel):
+        """Send a WHO for `channel` once it's its turn."""
+
+        if not self._needs_who():
+            return
+        key = self.bot.casemapping.fold(channel)
+        if key in self._pending or key in self._queue:
+            return
+        self._queue[key] = channel
+        self._send_next()
+
+    def forget(self, channel):
+        """Drop a queued or pending WHO for `channel`, after leaving it."""
+
+        key = self.bot.casemapping.fold(channel)
+        self._queue.pop(key, None)
+        who = self._pending.pop(key, None)
+        if who is not None:
+            who.timer.cancel()
+            self._send_next()
+
+    def _send_next(self):
+        while self._queue and len(self._pending) < self.max_pending:
+            key, channel = self._queue.popitem(last=False)
+            self._send_who(key, channel)
+
+    def _send_who(self, key, channel):
+        timer = self.bot.timers.call_later(self.timeout, self._expire, key)
+        self._pending[key] = _Who(channel, time.monotonic(), timer)
+        if 'WHOX' in self.bot.isupport:
+            self.bot.execute("WHO", channel,
+                             "%s,%s" % (WHOX_FIELDS, WHOX_TOKEN))
+        else:
+            self.bot.execute("WHO", channel)
+
+    def _whox_reply(self, e):
+        # <me> <token> <channel> <user> <host> <nick> <account>
+        params = e.params
+        if len(params) < 6 or params[0] != WHOX_TOKEN:
+            return
+        who = self._pending.get(self.bot.casemapping.fold(params[1]))
+        if who is not None:
+            account = params[5]
+            who.rows.append((params[4], params[2], params[3],
+                             None if account == '0' else account))
+
+    def _who_reply(self, e):
+        # <me> <channel> <user> <host> <server> <nick> <flags> :<hops> <real name>
+        params = e.params
+        if len(params) < 5:
+            return
+        who = self._pending.get(self.bot.casemapping.fold(params[0]))
+        if who is not None:
+            who.rows.append((params[4], params[1], params[2], False))
+
+    def _finish(self, key):
+        who = self._pending.pop(key, None)
+        if who is None:
+            # someone else's WHO
+            return
+        who.timer.cancel()
+
+        # account is None if logged out, False if WHO didn't say
+        users = self.bot.users
+        updated = 0
+        for nick, user, host, account in who.rows:
+            u = users.get(nick)
+            if u is None:
+                # left before the reply came
+                continue
+            u.user = sys.intern(user)
+            u.host = sys.intern(host)
+            if account is not False:
+                u.account = account and sys.intern(account)
+            updated += 1
+
+        elapsed = time.monotonic() - who.sent
+        self.synced += 1
+        self.users_updated += updated
+        self._time_total += elapsed
+        if elapsed > self._time_max:
+            self._time_max = elapsed
+        logging.debug("Synced %d users of %s in %.3fs", updated, who.channel,
+                      elapsed)
+        self._send_next()
+
+    def _expire(self, key):
+        who = self._pending.pop(key, None)
+        if who is not None:
+            self.timeouts += 1
+            logging.warning("No end to WHO for %s after %gs", who.channel,
+                            self.timeout)
+            self._send_next()
+
+    def stats(self):
+        """Return a `Storage` of enabled capabilities, WHOs queued and
+        pending, channels synced and users updated, and the mean and max
+        seconds WHOs took.
+        """
+
+        return Storage(caps=sorted(self.enabled),
+                       queued=len(self._queue),
+                       pending=len(self._pending),
+                       synced=self.synced,
+                       timeouts=self.timeouts,
+                       users_updated=self.users_updated,
+                       mean_time=self._time_total / self.synced if self.synced
+                                 else 0.0,
+                       max_time=self._time_max,
+                       )
@@ -0,0 +1,289 @@
+"""Schedule calls on the bot's event loop.
+
+`Scheduler` keeps pending calls in a heap ordered by deadline. The bot
+runs the due ones each time through its main loop, and waits no longer
+than the time left until the next one, so a timer fires on time however
+quiet the connection is. Modules use it through `SeshetBot.call_later()`,
+`call_at()` and `call_every()` rather than sleeping in a handler:
+
+    def do_remind(bot, event):
+        # reminds you in ten minutes
+        bot.call_later(600, bot.send_message, event.target, "Time's up!",
+                       owner=__name__)
+
+Each job may name an owner module. The bot cancels a module's jobs when
+the module is disabled or reloaded. Jobs may be scheduled and cancelled
+from worker threads. Callbacks returning a coroutine have it run as a task,
+cancelled after the job's `timeout` seconds if one is given.
+
+`stats()` reports how late jobs ran compared to their deadlines.
+"""
+
+import heapq
+import inspect
+import itertools
+import logging
+import threading
+import time
+from collections import deque
+
+from .utils import Storage
+
+
+class Job(object):
+    """A scheduled call. `interval` is set for jobs that repeat, and
+    `timeout` for coroutines that should be cancelled if they run too long.
+    `cancelled` is true once the job won't run again.
+    """
+
+    __slots__ = ('when', 'fun', 'args', 'interval', 'owner', 'timeout',
+                 'cancelled', '_scheduler')
+
+    def __init__(self, scheduler, when, fun, args, interval, owner,
+                 timeout=0):
+        self._scheduler = scheduler
+        self.when = when
+        self.fun = fun
+        self.args = args
+        self.interval = interval
+        self.owner = owner
+        self.timeout = timeout
+        self.cancelled = False
+
+    def cancel(self):
+        """Stop the job from running (again)."""
+        self._scheduler.cancel(self)
+
+    @property
+    def name(self):
+        return getattr(self.fun, '__qualname__', repr(self.fun))
+
+    def __repr__(self):
+        temp = "<Job {} at {:.3f}{}{}>"
+        return temp.format(self.name, self.when,
+                           ' every %gs' % self.interval if self.interval
+                           else '',
+                           ' cancelled' if self.cancelled else '')
+
+
+def _owner_name(owner):
+    if owner is None or isinstance(owner, str):
+        return owner
+    return owner.__name__
+
+
+class Scheduler(object):
+    """Heap of `Job`s by deadline, in `time.monotonic()` seconds.
+
+    Set `wakeup` to a thread-safe callable to be told when a job is added
+    ahead of the others, so a wait for the old earliest deadline can be
+    cut short. Set `run_coroutine` to a callable taking a coroutine and
+    keyword arguments `timeout` and `name` to run the coroutines returned
+    by callbacks, like `SeshetBot.run_coroutine()`.
+
+    A coroutine runs for as long as it takes unless its job was scheduled
+    with a `timeout` in seconds.
+    """
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.wakeup = None
+        self.run_coroutine = None
+
+        self._heap = []
+        self._seq = itertools.count()
+        self._owned = {}    # owner -> set of jobs
+        self._stale = 0     # cancelled jobs still in the heap
+        self._lock = threading.Lock()
+
+        # statistics
+        self.ran = 0
+        self.failed = 0
+        self.skipped = 0
+        self._late_total = 0.0
+        self._late_max = 0.0
+        self._recent_lateness = deque(maxlen=1000)
+
+    def __len__(self):
+        return len(self._heap) - self._stale
+
+    def call_at(self, when, fun, *args, owner=None, timeout=0):
+        """Call `fun(*args)` at `when` on the `clock`. Returns the `Job`."""
+        return self._add(when, fun, args, None, owner, timeout)
+
+    def call_later(self, delay, fun, *args, owner=None, timeout=0):
+        """Call `fun(*args)` in `delay` seconds. Returns the `Job`."""
+        return self._add(self.clock() + delay, fun, args, None, owner,
+                         timeout)
+
+    def call_every(self, interval, fun, *args, owner=None, first=None,
+                   timeout=0):
+        """Call `fun(*args)` every `interval` seconds, first after `first`
+        seconds (by default `interval`). Runs that are missed because the
+        loop was busy are skipped rather than run back to back. Returns
+        the `Job`.
+        """
+
+        if interval <= 0:
+            raise ValueError("interval must be positive")
+        if first is None:
+            first = interval
+        return self._add(self.clock() + first, fun, args, interval, owner,
+                         timeout)
+
+    def _add(self, when, fun, args, interval, owner, timeout):
+        owner = _owner_name(owner)
+        job = Job(self, when, fun, args, interval, owner, timeout)
+        with self._lock:
+            self._push(job)
+            if owner is not None:
+                self._owned.setdefault(owner, set()).add(job)
+            first = self._heap[0][2] is job
+        if first and self.wakeup is not None:
+            self.wakeup()
+        return job
+
+    def _push(self, job):
+        heapq.heappush(self._heap, (job.when, next(self._seq), job))
+
+    def cancel(self, job):
+        """Cancel `job`. Does nothing if it has already run or been
+        cancelled.
+        """
+
+        with self._lock:
+            if job.cancelled:
+                return
+            job.cancelled = True
+            self._stale += 1
+            self._disown(job)
+            # don't let cancelled jobs pile up in the heap
+            if self._stale > 64 and self._stale > len(self._heap) // 2:
+                # in place, as run_due() may be iterating over it
+                self._heap[:] = [e for e in self._heap if not e[2].cancelled]
+                heapq.heapify(self._heap)
+                self._stale = 0
+
+    def _disown(self, job):
+        jobs = self._owned.get(job.owner)
+        if jobs is not None:
+            jobs.discard(job)
+            if not jobs:
+                del self._owned[job.owner]
+
+    def cancel_owner(self, owner):
+        """Cancel every job of module `owner` (a module or its name).
+        Returns the number cancelled.
+        """
+
+        with self._lock:
+            jobs = self._owned.pop(_owner_name(owner), ())
+        for job in jobs:
+            self.cancel(job)
+        return len(jobs)
+
+    def jobs_of(self, owner):
+        """Return a list of the pending jobs of module `owner`."""
+        with self._lock:
+            return list(self._owned.get(_owner_name(owner), ()))
+
+    def next_deadline(self):
+        """Return the deadline of the earliest job, or None."""
+
+        with self._lock:
+            heap = self._heap
+            while heap and heap[0][2].cancelled:
+                heapq.heappop(heap)
+                self._stale -= 1
+            return heap[0][0] if heap else None
+
+    def timeout(self, default):
+        """Return how long the loop may wait before the next job is due,
+        at most `default` seconds.
+        """
+
+        deadline = self.next_deadline()
+        if deadline is None:
+            return default
+        return min(default, max(0.0, deadline - self.clock()))
+
+    def run_due(self):
+        """Run every job whose deadline has passed. Must be called from the
+        loop thread. Returns the number of jobs run.
+        """
+
+        now = self.clock()
+        heap = self._heap
+        ran = 0
+        while True:
+            with self._lock:
+                if not heap or heap[0][0] > now:
+                    break
+                due, _, job = heapq.heappop(heap)
+                if job.cancelled:
+                    self._stale -= 1
+                    continue
+                if job.interval:
+                    job.when += job.interval
+                    if job.when <= now:
+                        missed = int((now - job.when) // job.interval) + 1
+                        self.skipped += missed
+                        job.when += missed * job.interval
+                    self._push(job)
+                else:
+                    # it's done; drop it from its owner's jobs
+                    job.cancelled = True
+                    self._disown(job)
+            self._run(job, due)
+            ran += 1
+        return ran
+
+    def _run(self, job, due):
+        late = max(self.clock() - due, 0.0)
+        self.ran += 1
+        self._late_total += late
+        if late > self._late_max:
+            self._late_max = late
+        self._recent_lateness.append(late)
+        try:
+            result = job.fun(*job.args)
+            if inspect.iscoroutine(result):
+                if self.run_coroutine is None:
+                    result.close()
+                    raise TypeError("No event loop to run coroutine on")
+                self.run_coroutine(result, timeout=job.timeout,
+                                   name=job.name)
+        except Exception:
+            self.failed += 1
+            logging.exception("Error in scheduled job %s", job.name)
+
+    def clear(self):
+        """Cancel every job."""
+
+        with self._lock:
+            for _, _, job in self._heap:
+                job.cancelled = True
+            del self._heap[:]
+            self._owned.clear()
+            self._stale = 0
+
+    def stats(self):
+        """Return a `Storage` of pending jobs by owner and how late jobs
+        ran, in seconds: mean and max overall, and the median and 95th
+        percentile of the last 1000.
+        """
+
+        late = sorted(self._recent_lateness)
+        with self._lock:
+            owners = dict((k, len(v)) for k, v in self._owned.items())
+        return Storage(pending=len(self),
+                       owners=owners,
+                       ran=self.ran,
+                       failed=self.failed,
+                       skipped=self.skipped,
+                       mean_late=self._late_total / self.ran if self.ran
+                                 else 0.0,
+                       max_late=self._late_max,
+                       median_late=late[len(late) // 2] if late else 0.0,
+                       p95_late=late[int(len(late) * 0.95)] if late else 0.0,
+                       )
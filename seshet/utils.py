@@ -7,11 +7,17 @@
 
 import random
 import inspect
-import pickle
+import logging
 import string
-from collections import UserString
+import sys
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from collections.abc import MutableMapping, MutableSet
 
-from pydal import Field
+from . import kvcodec
+from .kvbackends import KVBackend, PydalBackend
 
 # TODO: IRCstr should go in next version of ircutils3.protocol
 
@@ -20,42 +26,232 @@ irc_lowercase = string.ascii_lowercase + "{}|^"
 upper_to_lower = str.maketrans(irc_uppercase, irc_lowercase)
 lower_to_upper = str.maketrans(irc_lowercase, irc_uppercase)
 
+# translation tables for the CASEMAPPING values servers advertise in
+# RPL_ISUPPORT (005)
+casemappings = {
+    'ascii': str.maketrans(string.ascii_uppercase, string.ascii_lowercase),
+    'rfc1459': upper_to_lower,
+    'strict-rfc1459': str.maketrans(string.ascii_uppercase + "[]\\",
+                                    string.ascii_lowercase + "{}|"),
+}
 
-class IRCstr(UserString):
+
+class IRCstr(str):
     """Implement str, overriding case-changing methods to only handle ASCII
     cases plus "{}|^" and "[]\~" as defined by RFC 2812.
     
     Hashing and equality testing is case insensitive! That is, __hash__ will
     return the hash of the lowercase version of the string, and __eq__ will
-    convert both operands to lowercase before testing equality.
+    compare the lowercase versions of both operands.
+    
+    The lowercase version is computed once, when the string is created, so
+    hashing and comparing IRCstr objects doesn't allocate anything. It's
+    interned, so it's shared with the keys of `IRCDict` and `IRCSet`.
     """
     
+    __slots__ = ('_key',)
+    
+    def __new__(cls, value=''):
+        self = str.__new__(cls, value)
+        if isinstance(value, IRCstr):
+            self._key = value._key
+        else:
+            self._key = sys.intern(str.translate(self, upper_to_lower))
+        return self
+    
+    @property
+    def data(self):
+        """The plain `str` value, as `collections.UserString` provided."""
+        return str.__str__(self)
+    
     def casefold(self):
-        return self.lower()
+        return self._key
         
     def lower(self):
-        return self.data.translate(upper_to_lower)
+        return self._key
     
     def upper(self):
-        return self.data.translate(lower_to_upper)
+        return str.translate(self, lower_to_upper)
     
     def islower(self):
-        return self.data == self.lower()
+        return str.__eq__(self, self._key)
     
     def isupper(self):
-        return self.data == self.upper()
+        return str.__eq__(self, self.upper())
     
     def __hash__(self):
-        return hash(self.lower())
+        # str caches its own hash, so this is only computed once
+        return hash(self._key)
         
     def __eq__(self, other):
         if isinstance(other, IRCstr):
-            return self.lower() == other.lower()
+            return self._key == other._key
         elif isinstance(other, str):
             # Use our custom lowercasing for IRC on other
-            return self.lower() == other.translate(upper_to_lower)
+            return self._key == other.translate(upper_to_lower)
         else:
-            return False
+            return NotImplemented
+    
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+    
+    def __reduce__(self):
+        return (IRCstr, (str.__str__(self),))
+
+
+class CaseMapping(object):
+    """A switchable IRC case mapping, shared by `IRCDict` and `IRCSet`
+    containers.
+    
+    Changing the mapping with `set()` re-keys every container using it, so
+    a bot can start with 'rfc1459' and switch once the server advertises
+    its CASEMAPPING.
+    """
+    
+    def __init__(self, name='rfc1459'):
+        self.name = name
+        self.table = casemappings[name]
+        self._containers = weakref.WeakValueDictionary()
+        
+    def set(self, name):
+        """Switch to the named mapping and re-key all containers."""
+        
+        if name == self.name:
+            return
+        self.table = casemappings[name]
+        self.name = name
+        for c in list(self._containers.values()):
+            c.refold()
+    
+    def fold(self, s):
+        """Return `s` lowercased with this mapping."""
+        return s.translate(self.table)
+    
+    def register(self, container):
+        self._containers[id(container)] = container
+        
+    def __repr__(self):
+        return "<CaseMapping %s>" % self.name
+
+
+# used by containers created without a mapping of their own
+default_casemapping = CaseMapping()
+
+
+class IRCDict(MutableMapping):
+    """Dict with case insensitive `str` keys, compared using a `CaseMapping`.
+    
+    Keys are casefolded internally, so plain `str` keys can be used for
+    lookups. Iterating gives the keys as they were first set. Stored keys
+    are interned so containers holding the same nicks share one copy.
+    """
+    
+    def __init__(self, data=(), casemapping=None, **kwargs):
+        self._map = casemapping or default_casemapping
+        self._map.register(self)
+        self._data = {}
+        self.update(data, **kwargs)
+    
+    def __getitem__(self, key):
+        return self._data[key.translate(self._map.table)][1]
+    
+    def __setitem__(self, key, value):
+        self._data[sys.intern(key.translate(self._map.table))] = (key, value)
+    
+    def __delitem__(self, key):
+        del self._data[key.translate(self._map.table)]
+    
+    def __contains__(self, key):
+        return key.translate(self._map.table) in self._data
+    
+    def __iter__(self):
+        return (k for k, _ in self._data.values())
+    
+    def __len__(self):
+        return len(self._data)
+    
+    def get(self, key, default=None):
+        item = self._data.get(key.translate(self._map.table))
+        if item is None:
+            return default
+        return item[1]
+    
+    def values(self):
+        return [v for _, v in self._data.values()]
+    
+    def items(self):
+        return list(self._data.values())
+    
+    def copy(self):
+        return IRCDict(self.items(), self._map)
+    
+    def refold(self):
+        """Re-key after the case mapping has changed."""
+        
+        table = self._map.table
+        self._data = dict((sys.intern(k.translate(table)), (k, v))
+                          for k, v in self._data.values())
+    
+    def __repr__(self):
+        return "<IRCDict %s %r>" % (self._map.name, dict(self.items()))
+
+
+class IRCSet(MutableSet):
+    """Set of case insensitive `str`s, compared using a `CaseMapping`.
+    
+    Members are casefolded internally, so plain `str`s can be used for
+    membership tests. Iterating gives the members as they were added.
+    Stored keys are interned, as in `IRCDict`.
+    """
+    
+    def __init__(self, data=(), casemapping=None):
+        self._map = casemapping or default_casemapping
+        self._map.register(self)
+        table = self._map.table
+        self._data = dict((sys.intern(s.translate(table)), s) for s in data)
+    
+    def _from_iterable(self, it):
+        return IRCSet(it, self._map)
+    
+    def __contains__(self, s):
+        return s.translate(self._map.table) in self._data
+    
+    def __iter__(self):
+        return iter(self._data.values())
+    
+    def __len__(self):
+        return len(self._data)
+    
+    def add(self, s):
+        self._data[sys.intern(s.translate(self._map.table))] = s
+    
+    def discard(self, s):
+        self._data.pop(s.translate(self._map.table), None)
+    
+    def remove(self, s):
+        del self._data[s.translate(self._map.table)]
+    
+    def clear(self):
+        self._data.clear()
+    
+    def isdisjoint(self, other):
+        return not any(s in self for s in other)
+    
+    def copy(self):
+        return IRCSet(self, self._map)
+    
+    def refold(self):
+        """Re-key after the case mapping has changed."""
+        
+        table = self._map.table
+        self._data = dict((sys.intern(s.translate(table)), s)
+                          for s in self._data.values())
+    
+    def __repr__(self):
+        return "<IRCSet %s %r>" % (self._map.name, set(self))
 
 
 class Storage(dict):
@@ -168,78 +364,17 @@ class Storage(dict):
         return values[-1] if values else default
 
 
-class KVStore:
-    """Create a key/value store in the bot's database for each
-    command module to use for persistent storage. Can be accessed
-    either like a class:
-    
-        >>> store = KVStore(db)
-        >>> store.foo = 'bar'
-        >>> store.foo
-        'bar'
-        
-    Or like a dict:
-    
-        >>> store['spam'] = 'eggs'
-        >>> store['spam']
-        'eggs'
-        
-    The KVStore object uses `inspect` to determine which module
-    the object is being accessed from and will automatically create
-    a database table as needed or determine which one to use if it
-    already exists, so that each module the object is used from has
-    its own namespace.
-    
-    KVStore has most of the same interfaces as an ordinary `dict`, but
-    is not a subclass of `dict` or `collections.UserDict` because
-    so many functions had to be completely rewritten to work with
-    KVStore's database model.
+class _KVMapping(object):
+    """Dict-like methods shared by `KVStore` and `KVNamespace`, built on
+    their `_get()`, `_set()`, `_get_many()`, `_set_many()`, `_items()`,
+    `_iter_items()` and `_clear()` methods. Setting a key to None deletes
+    it.
     """
 
-    def __init__(self, db):
-        # make sure some tables are defined:
-        
-        if 'namespaces' not in db:
-            # list of registered modules
-            db.define_table('namespaces', Field('name'))
-            
-        for m in db().select(db.namespaces.ALL):
-            # these are modules' own "namespaces"
-            tbl_name = 'kv_' + m.name
-            if tbl_name not in db:
-                db.define_table(tbl_name,
-                                Field('k', 'string', unique=True),
-                                Field('v', 'text'),
-                                )
-        
-        self._db = db   # pydal DAL instance
-        # It's recommended to use a separate database
-        # for the bot and for the KV store to avoid
-        # accidental or malicious name collisions
-        #
-        # (Then why doesn't the default implimentation?)
-        
     def __getattr__(self, k):
         if k.startswith('_'):
-            return self.__dict__[k]
-        
-        db = self._db
-        
-        tbl = self._get_calling_module()
-        tbl_name = 'kv_' + tbl if tbl is not None else None
-        if tbl is None or tbl_name not in db:
-            # table doesn't exist
-            return None
-        
-        r = db(db[tbl_name].k == k)
-        if r.isempty():
-            # no db entry for this key
-            return None
-        
-        r = r.select().first()
-        
-        # db should return string, pickle expects bytes
-        return pickle.loads(r.v.encode(errors='ignore'))
+            raise AttributeError(k)
+        return self._get(k)
 
     def __setattr__(self, k, v):
         if k.startswith('_'):
@@ -248,160 +383,516 @@ class KVStore:
         elif k in self.__dict__:
             # instance attributes should be read-only-ish
             raise AttributeError("Name already in use: %s" % k)
-        
-        db = self._db
-        
-        if v is not None:
-            v = pickle.dumps(v).decode(errors='ignore')
-        
-        tbl = self._get_calling_module()
-        tbl_name = 'kv_' + tbl if tbl is not None else None
-        
-        if tbl is None or tbl_name not in db:
-            if v is not None:
-                # module not registered, need to create
-                # a new table
-                self._register_module(tbl)
-                db[tbl_name].insert(k=k, v=repr(v))
-            else:
-                # no need to delete a non-existent key
-                return None
-        else:
-            if v is not None:
-                db[tbl_name].update_or_insert(db[tbl_name].k == k, k=k, v=v)
-            else:
-                db(db[tbl_name].k == k).delete()
-        
-        db.commit()
-        self._db = db
-    
+        self._set(k, v)
+
     def __delattr__(self, k):
-        self.__setattr__(k, None)
-    
+        self._set(k, None)
+
     def __getitem__(self, k):
-        return self.__getattr__(k)
-    
+        return self._get(k)
+
     def __setitem__(self, k, v):
-        self.__setattr__(k, v)
-    
-    def __delitem__(self, k):
-        self.__setattr__(k, None)
+        self._set(k, v)
 
-    def _register_module(self, name):
-        db = self._db
-        
-        tbl_name = 'kv_' + name
-            
-        if db(db.namespaces.name == name).isempty():
-            db.namespaces.insert(name=name)
-            db.commit()
-        if tbl_name not in db:
-            db.define_table(tbl_name,
-                            Field('k', 'string', unique=True),
-                            Field('v', 'text'),
-                            )
-        self._db = db
+    def __delitem__(self, k):
+        self._set(k, None)
 
-    def _get_calling_module(self):
-        # in theory, bot modules will be registered with register_module
-        # when they're uploaded and installed
-
-        curfrm = inspect.currentframe()
-        for f in inspect.getouterframes(curfrm)[1:]:
-            if self.__module__.split('.')[-1] not in f[1]:
-                calling_file = f[1]
-                break
-        caller_mod = inspect.getmodulename(calling_file)
-    
-        db = self._db
-        mod = db(db.namespaces.name == caller_mod)
-        if mod.isempty():
-            return None
-        else:
-            return caller_mod
-        
     def keys(self):
-        db = self._db
-        tbl = self._get_calling_module()
-        tbl_name = 'kv_' + tbl if tbl is not None else None
-        if tbl is None or tbl_name not in db:
-            return []
-        all_items = db().select(db[tbl_name].ALL)
-        all_keys = [r.k for r in all_items]
-        return all_keys
-    
+        return [k for k, _ in self._items()]
+
     def values(self):
-        all_keys = self.keys()
-        all_vals = list()
-        for k in all_keys:
-            all_vals.append(self[k])
-        return all_vals
-    
+        return [v for _, v in self._items()]
+
+    def items(self):
+        return self._items()
+
+    def get_many(self, keys):
+        """Return a dict of the values of those of `keys` that are set, read
+        with one query.
+        """
+        return self._get_many(list(keys))
+
+    def set_many(self, mapping):
+        """Set several keys from a dict or iterable of `(key, value)` pairs
+        in one transaction. Keys set to None are deleted.
+        """
+        if hasattr(mapping, 'items'):
+            mapping = mapping.items()
+        self._set_many(dict(mapping))
+
+    def delete_many(self, keys):
+        """Delete several keys in one transaction."""
+        self._set_many(dict.fromkeys(keys))
+
     def update(self, other):
-        for k, v in other.items():
-            self[k] = v
+        self.set_many(other)
         return None
-    
-    def items(self):
-        return zip(self.keys(), self.values())
-    
+
     def iterkeys(self):
-        return iter(self.keys())
-    
+        return (k for k, _ in self._iter_items())
+
     def itervalues(self):
-        return iter(self.values())
-    
+        return (v for _, v in self._iter_items())
+
     def iteritems(self):
-        return iter(self.items())
-    
+        """Iterate over `(key, value)` pairs, reading rows from the database
+        as they're needed instead of all at once.
+        """
+        return self._iter_items()
+
     def __iter__(self):
-        return iter(self.keys())
-    
+        return self.iterkeys()
+
     def __contains__(self, k):
-        if self[k] is not None:
-            return True
-        else:
-            return False
-        
+        return self[k] is not None
+
     def __copy__(self):
         """Return a dict representing the current table"""
-        d = dict()
-        d.update(self.items())
-        return d
-    
+        return dict(self.items())
+
     def copy(self):
         """Return a dict representing the current table"""
         return self.__copy__()
-    
+
     def pop(self, k):
         v = self[k]
         self[k] = None
         return v
-    
+
     def popitem(self):
         """Unlike `dict.popitem()`, this is actually random"""
         all_items = self.items()
         removed_item = random.choice(all_items)
         self[removed_item[0]] = None
         return removed_item
-    
+
     def setdefault(self, k, v=None):
         existing_v = self[k]
         if existing_v is None:
             self[k] = v
             return v
         return existing_v
-    
+
     def has_key(self, k):
         return k in self
-    
+
     def get(self, k, v=None):
         existing_v = self[k]
         if existing_v is None:
             return v
         else:
             return existing_v
-        
+
     def clear(self):
-        for k in self.keys():
-            self[k] = None
+        """Delete every key with one query."""
+        self._clear()
+
+
+# cached marker for keys known not to be in the table
+_ABSENT = object()
+
+
+class KVNamespace(_KVMapping):
+    """One module's key/value store in a `seshet.kvbackends` backend.
+
+    Returned by `KVStore.namespace()`, and passed to module hooks as their
+    `settings`. Supports the same interfaces as `KVStore`, but goes straight
+    to its own namespace instead of working out which module is calling.
+
+    Values are encoded with `codec` (see `seshet.kvcodec`).
+
+    If `cache_size` is nonzero, up to that many decoded values are kept in
+    an LRU cache, and writes are held as dirty entries until `flush()`
+    writes them all in one transaction. Values read from the cache are the
+    same objects each time, so a mutable value changed in place must be
+    assigned again to be saved.
+
+    Handlers running in worker threads use the same namespaces as the
+    loop thread, so every read and write holds a lock, cached or not. A
+    flush holds it until the backend has the writes, so a read can't miss
+    a value that is between the two. Backends, shared by every namespace,
+    lock their own state (see `seshet.kvbackends`).
+    """
+
+    def __init__(self, backend, name, cache_size=0, codec=kvcodec.PICKLE):
+        self._backend = backend
+        self._name = name
+        self._codec = codec
+        self._cache_size = cache_size
+        self._cache = OrderedDict()
+        self._dirty = {}    # key -> value to write, or None to delete
+        self._lock = threading.RLock()
+
+        # statistics
+        self._hits = 0
+        self._misses = 0
+        self._flushes = 0
+        self._flushed = 0
+
+    def _encode(self, v):
+        return kvcodec.encode(v, self._codec)
+
+    def _decode(self, v):
+        try:
+            return kvcodec.decode(v)
+        except ValueError as e:
+            # e.g. a legacy pickle that was mangled when it was stored
+            logging.warning("Unreadable value in key/value namespace %s: %s",
+                            self._name, e)
+            return None
+
+    def _load(self, k):
+        v = self._backend.get(self._name, k)
+        return self._decode(v) if v is not None else None
+
+    def _store_many(self, values):
+        encode = self._encode
+        self._backend.set_many(self._name, dict(
+            (k, encode(v) if v is not None else None)
+            for k, v in values.items()))
+
+    def _get(self, k):
+        with self._lock:
+            if not self._cache_size:
+                return self._load(k)
+
+            cache = self._cache
+            v = cache.get(k)
+            if v is not None:
+                self._hits += 1
+                cache.move_to_end(k)
+                return None if v is _ABSENT else v
+
+            self._misses += 1
+            if k in self._dirty:
+                # evicted before it was flushed
+                v = self._dirty[k]
+            else:
+                v = self._load(k)
+            self._cache_put(k, v)
+            return v
+
+    def _cache_put(self, k, v):
+        # called with the lock held
+        cache = self._cache
+        cache[k] = _ABSENT if v is None else v
+        cache.move_to_end(k)
+        # dirty values are also kept in _dirty, so evicting them is safe
+        while len(cache) > self._cache_size:
+            cache.popitem(last=False)
+
+    def _set(self, k, v):
+        self._set_many({k: v})
+
+    def _get_many(self, keys):
+        with self._lock:
+            if not self._cache_size:
+                return self._load_many(keys)
+
+            found = {}
+            missing = []
+            cache = self._cache
+            dirty = self._dirty
+            for k in keys:
+                if k in dirty:
+                    v = dirty[k]
+                else:
+                    v = cache.get(k)
+                    if v is None:
+                        missing.append(k)
+                        continue
+                    if v is _ABSENT:
+                        v = None
+                if v is not None:
+                    found[k] = v
+            self._hits += len(keys) - len(missing)
+            self._misses += len(missing)
+
+            if missing:
+                loaded = self._load_many(missing)
+                found.update(loaded)
+                for k in missing:
+                    self._cache_put(k, loaded.get(k))
+            return found
+
+    def _load_many(self, keys):
+        decode = self._decode
+        loaded = dict((k, decode(v)) for k, v in
+                      self._backend.get_many(self._name, keys).items())
+        return dict((k, v) for k, v in loaded.items() if v is not None)
+
+    def _set_many(self, values):
+        with self._lock:
+            if not self._cache_size:
+                self._store_many(values)
+                return
+
+            self._dirty.update(values)
+            for k, v in values.items():
+                self._cache_put(k, v)
+
+    def _items(self):
+        return list(self._iter_items())
+
+    def _iter_items(self):
+        self.flush()
+        decode = self._decode
+        for k, v in self._backend.items(self._name):
+            v = decode(v)
+            if v is not None:
+                yield k, v
+
+    def _clear(self):
+        with self._lock:
+            self._dirty.clear()
+            self._cache.clear()
+            self._backend.clear(self._name)
+
+    @property
+    def dirty(self):
+        """Number of writes waiting to be flushed."""
+        return len(self._dirty)
+
+    def flush(self):
+        """Write all pending writes in one transaction. On error, the
+        writes are kept for next time.
+        """
+
+        with self._lock:
+            if not self._dirty:
+                return 0
+            dirty = self._dirty
+            self._store_many(dirty)
+            self._dirty = {}
+            self._flushes += 1
+            self._flushed += len(dirty)
+            return len(dirty)
+
+    def migrate(self):
+        """Re-encode values written by older versions of KVStore. Values that
+        can't be decoded are logged and left alone. Returns the number of
+        values migrated.
+        """
+
+        values = {}
+        for k, data in self._backend.legacy_items(self._name):
+            try:
+                values[k] = kvcodec.decode(data)
+            except ValueError:
+                logging.warning("Can't migrate value of %s in key/value "
+                                "namespace %s, leaving it", k, self._name)
+        if values:
+            self._store_many(values)
+            logging.info("Migrated %d values in key/value namespace %s",
+                         len(values), self._name)
+        return len(values)
+
+    def invalidate(self):
+        """Forget cached values, e.g. after the table was changed elsewhere.
+        Pending writes are kept.
+        """
+        with self._lock:
+            self._cache.clear()
+
+    def stats(self):
+        """Return a `Storage` of cache statistics."""
+
+        with self._lock:
+            return Storage(cached=len(self._cache),
+                           dirty=len(self._dirty),
+                           hits=self._hits,
+                           misses=self._misses,
+                           flushes=self._flushes,
+                           flushed=self._flushed,
+                           )
+
+    def __repr__(self):
+        return "<KVNamespace %s>" % self._name
+
+
+class KVStore(_KVMapping):
+    """Create a key/value store in the bot's database (or another
+    `seshet.kvbackends` backend) for each command module to use for
+    persistent storage. Can be accessed either like a class:
+    
+        >>> store = KVStore(db)
+        >>> store.foo = 'bar'
+        >>> store.foo
+        'bar'
+        
+    Or like a dict:
+    
+        >>> store['spam'] = 'eggs'
+        >>> store['spam']
+        'eggs'
+        
+    The KVStore object looks at the call stack to determine which module
+    the object is being accessed from and will automatically create
+    a database table as needed or determine which one to use if it
+    already exists, so that each module the object is used from has
+    its own namespace. The module for each calling file is only worked
+    out once.
+    
+    Modules should prefer a `KVNamespace` from `namespace()`, which is
+    bound to the module's table up front.
+    
+    With a nonzero `cache_size`, each namespace caches that many values and
+    holds writes until `flush()`, which `flush_due()` calls once
+    `flush_interval` seconds have passed since the last flush.
+    
+    Values are encoded with `codec`: 'pickle', 'marshal' or 'json' (see
+    `seshet.kvcodec`). Values left by older versions are re-encoded when
+    the store is created.
+    
+    KVStore has most of the same interfaces as an ordinary `dict`, but
+    is not a subclass of `dict` or `collections.UserDict` because
+    so many functions had to be completely rewritten to work with
+    KVStore's database model.
+    """
+
+    def __init__(self, db, cache_size=0, flush_interval=5.0,
+                 codec=kvcodec.PICKLE):
+        if codec not in (kvcodec.PICKLE, kvcodec.MARSHAL, kvcodec.JSON):
+            raise ValueError("Unknown codec: %s" % codec)
+        
+        # `db` is a backend, or a pydal DAL instance to store
+        # namespaces in their own tables
+        if not isinstance(db, KVBackend):
+            db = PydalBackend(db)
+        self._backend = db
+        # It's recommended to use a separate database
+        # for the bot and for the KV store to avoid
+        # accidental or malicious name collisions
+        #
+        # (Then why doesn't the default implimentation?)
+        
+        self._namespaces = {}   # module name -> KVNamespace
+        self._callers = {}      # source file -> module name
+        self._lock = threading.Lock()
+        self._cache_size = cache_size
+        self._codec = codec
+        self._flush_interval = flush_interval
+        self._last_flush = time.monotonic()
+        
+        for name in db.namespaces():
+            # these are modules' own "namespaces"
+            ns = self._namespaces[name] = KVNamespace(db, name, cache_size,
+                                                      codec)
+            ns.migrate()
+    
+    def namespace(self, name):
+        """Return the `KVNamespace` of module `name`, registering the module
+        if needed.
+        """
+        
+        ns = self._namespaces.get(name)
+        if ns is None:
+            # workers may ask for the same new namespace at once
+            with self._lock:
+                ns = self._namespaces.get(name)
+                if ns is None:
+                    self._backend.create_namespace(name)
+                    ns = KVNamespace(self._backend, name, self._cache_size,
+                                     self._codec)
+                    self._namespaces[name] = ns
+        return ns
+    
+    def flush(self):
+        """Flush pending writes of every namespace."""
+        
+        self._last_flush = time.monotonic()
+        for ns in list(self._namespaces.values()):
+            try:
+                ns.flush()
+            except Exception:
+                logging.exception("Couldn't flush key/value namespace %s",
+                                  ns._name)
+    
+    def flush_due(self):
+        """Flush if there are pending writes and `flush_interval` seconds
+        have passed since the last flush.
+        """
+        
+        if not self._cache_size:
+            return
+        if time.monotonic() - self._last_flush < self._flush_interval:
+            return
+        self.flush()
+    
+    def stats(self):
+        """Return a `Storage` of cache statistics summed over all
+        namespaces, with each namespace's own under `namespaces`.
+        """
+        
+        per_ns = dict((name, ns.stats())
+                      for name, ns in self._namespaces.items())
+        total = Storage(cached=0, dirty=0, hits=0, misses=0, flushes=0,
+                        flushed=0)
+        for st in per_ns.values():
+            for k in total:
+                total[k] += st[k]
+        total.namespaces = per_ns
+        return total
+    
+    def _get_calling_module(self):
+        # name of the module whose code called into this file
+        f = sys._getframe(1)
+        while f is not None and f.f_code.co_filename == __file__:
+            f = f.f_back
+        if f is None:
+            return None
+        
+        filename = f.f_code.co_filename
+        name = self._callers.get(filename)
+        if name is None:
+            name = self._callers[filename] = inspect.getmodulename(filename)
+        return name
+    
+    def _caller_namespace(self, create=False):
+        """Return the calling module's `KVNamespace`, or None if it has none
+        and `create` is false.
+        """
+        
+        name = self._get_calling_module()
+        if name is None:
+            return None
+        ns = self._namespaces.get(name)
+        if ns is None:
+            # may have been registered since we started
+            if create or self._backend.has_namespace(name):
+                ns = self.namespace(name)
+        return ns
+    
+    def _get(self, k):
+        ns = self._caller_namespace()
+        return ns._get(k) if ns is not None else None
+    
+    def _set(self, k, v):
+        ns = self._caller_namespace(create=v is not None)
+        if ns is not None:
+            ns._set(k, v)
+    
+    def _get_many(self, keys):
+        ns = self._caller_namespace()
+        return ns._get_many(keys) if ns is not None else {}
+    
+    def _set_many(self, values):
+        create = any(v is not None for v in values.values())
+        ns = self._caller_namespace(create=create)
+        if ns is not None:
+            ns._set_many(values)
+    
+    def _items(self):
+        ns = self._caller_namespace()
+        return ns._items() if ns is not None else []
+    
+    def _iter_items(self):
+        # resolve the namespace now; a generator would only do it when
+        # first advanced, possibly from elsewhere
+        ns = self._caller_namespace()
+        return ns._iter_items() if ns is not None else iter(())
+    
+    def _clear(self):
+        ns = self._caller_namespace()
+        if ns is not None:
+            ns._clear()
@@ -0,0 +1,448 @@
+"""Run module command handlers outside of the bot's poll loop.
+
+Modules whose `exec_mode` is 'thread' in the `modules` table have their
+handlers run by a `HandlerPool` instead of inline. Handlers get a
+`BotProxy` in place of the bot: anything that sends to the server is
+queued and performed on the loop thread by `HandlerPool.process()`, which
+the bot calls every loop.
+
+Modules whose `exec_mode` is 'process' run in a pool of worker processes
+per module, for CPU-bound work that would otherwise hold the GIL. Each
+call gets an `EventSnapshot` of the event and a `RecordingBot`; the calls
+it records are sent back and replayed on the real bot.
+"""
+
+import collections
+import importlib
+import logging
+import multiprocessing
+import os
+import signal
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from .utils import Storage
+
+
+INLINE = 'inline'
+THREAD = 'thread'
+PROCESS = 'process'
+
+
+def inline(fun):
+    """Decorator marking a command handler as fast enough to always run
+    inline, even if its module is configured to run in a worker.
+    """
+
+    fun.seshet_inline = True
+    return fun
+
+
+class _Job(object):
+    """One submitted handler call. `bot` and `module` are set for process
+    jobs, whose results are calls to replay on the bot, and `args` to
+    submit them again if their pool is restarted.
+    """
+
+    __slots__ = ('name', 'future', 'deadline', 'timeout', 'cancelled',
+                 'submitted', 'bot', 'module', 'args')
+
+    def __init__(self, name, timeout, bot=None, module=None, args=None):
+        self.name = name
+        self.bot = bot
+        self.module = module
+        self.args = args
+        self.future = None
+        self.timeout = timeout
+        self.submitted = time.monotonic()
+        self.deadline = self.submitted + timeout if timeout else None
+        self.cancelled = False
+
+
+class BotProxy(object):
+    """Stand-in for the bot passed to handlers running in a worker.
+
+    Methods that write to the connection are queued with the pool and run
+    on the loop thread, as is setting an attribute. Replies from a job that
+    has timed out are dropped. All other attributes are read from the bot
+    directly.
+
+    `storage` (see `seshet.utils.KVStore`) and the timer methods
+    `call_later()`, `call_at()` and `call_every()` are safe to use from a
+    worker. Other state, such as `users`, `channels` and `session`, belongs
+    to the loop thread and must only be read, not changed, from a worker.
+    """
+
+    queued_methods = frozenset(['execute', 'send_message', 'send_notice',
+                                'send_action', 'send_ctcp', 'send_ctcp_reply',
+                                'join_channel', 'part_channel', 'join', 'part',
+                                'notice', 'action', 'identify', 'set_nickname',
+                                'disconnect', 'quit', 'log',
+                                ])
+
+    def __init__(self, bot, pool, job):
+        self.__dict__.update(_bot=bot, _pool=pool, _job=job)
+
+    def __getattr__(self, name):
+        attr = getattr(self._bot, name)
+        if name not in self.queued_methods:
+            return attr
+
+        job = self._job
+        pool = self._pool
+
+        def queued(*args, **kwargs):
+            if job.cancelled:
+                logging.warning("Dropping %s() from timed out handler %s",
+                                name, job.name)
+                return
+            pool.call_soon(attr, *args, **kwargs)
+
+        return queued
+
+    def __setattr__(self, name, value):
+        if self._job.cancelled:
+            return
+        self._pool.call_soon(setattr, self._bot, name, value)
+
+
+class EventSnapshot(object):
+    """Picklable copy of the plain attributes of an event."""
+
+    fields = ('command', 'prefix', 'source', 'user', 'host', 'target',
+              'params', 'message')
+
+    def __init__(self, e):
+        for f in self.fields:
+            v = getattr(e, f, None)
+            if isinstance(v, list):
+                v = list(v)
+            elif v is not None and not isinstance(v, (str, int)):
+                v = str(v)
+            setattr(self, f, v)
+
+    def __repr__(self):
+        return "<EventSnapshot {} from {}>".format(self.command, self.source)
+
+
+class RecordingBot(object):
+    """Bot stand-in for handlers running in a worker process.
+
+    Has a copy of a few of the bot's plain attributes (see `bot_state()`).
+    Calls to `BotProxy.queued_methods` are recorded in `calls` as
+    `(name, args, kwargs)` to be replayed on the real bot.
+    """
+
+    def __init__(self, state):
+        self.__dict__.update(state)
+        self.calls = []
+
+    def __getattr__(self, name):
+        if name not in BotProxy.queued_methods:
+            raise AttributeError("%s isn't available to handlers running in "
+                                 "a worker process" % name)
+
+        def record(*args, **kwargs):
+            self.calls.append((name, args, kwargs))
+
+        return record
+
+
+def bot_state(bot):
+    """Return the attributes of `bot` copied to a `RecordingBot`."""
+
+    return {'nickname': bot.nickname,
+            'user': bot.user,
+            'real_name': bot.real_name,
+            }
+
+
+# worker processes are started fresh rather than forked from the bot, so
+# they don't inherit its sockets, threads and held locks
+if 'forkserver' in multiprocessing.get_all_start_methods():
+    _mp_context = multiprocessing.get_context('forkserver')
+else:
+    _mp_context = multiprocessing.get_context('spawn')
+
+
+def _warm(name, pids):
+    """Process pool initializer: report the worker's pid, so the pool can be
+    terminated, and import the module ahead of the first call.
+    """
+    pids.put(os.getpid())
+    importlib.import_module(name)
+
+
+def _noop():
+    pass
+
+
+def _run_in_process(name, cmd, state, event):
+    """Run command `cmd` of module `name` in a worker process and return the
+    calls it made on the bot.
+    """
+
+    m = sys.modules.get(name) or importlib.import_module(name)
+    for c, fun in m.commands.items():
+        if c.lower() == cmd:
+            break
+    else:
+        raise KeyError("Module %s has no command %s" % (name, cmd))
+
+    bot = RecordingBot(state)
+    fun(bot, event)
+    return bot.calls
+
+
+class HandlerPool(object):
+    """Bounded thread pool for module command handlers.
+
+    At most `max_workers` handlers run at once and at most `max_queued`
+    more wait for a thread; further submissions are rejected. A handler
+    still running after its timeout is abandoned: its later replies are
+    dropped, though the thread itself can't be interrupted.
+
+    Process jobs count against the same limit and go to a per-module pool
+    of `processes` worker processes with the module pre-imported (see
+    `submit_process()`). A timed out process job causes that module's pool
+    to be terminated and restarted, and the module's other unfinished jobs
+    to be submitted again to the new pool.
+
+    Set `wakeup` to a thread-safe callable to be notified when calls are
+    queued for the loop thread.
+    """
+
+    def __init__(self, max_workers=4, max_queued=32, default_timeout=30.0,
+                 processes=1):
+        self._executor = None
+        self._process_pools = {}
+        self._jobs = []
+        self._calls = collections.deque()
+
+        self.processes = processes
+        self.max_workers = max_workers
+        self.max_queued = max_queued
+        self.default_timeout = default_timeout
+        self.wakeup = None
+
+        # statistics
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.timed_out = 0
+        self.cancelled = 0
+        self.rejected = 0
+
+    @property
+    def pending(self):
+        """Number of submitted jobs that haven't finished or timed out."""
+        return len(self._jobs)
+
+    def busy(self):
+        """True if there are jobs running or calls waiting to be run."""
+        return bool(self._jobs or self._calls)
+
+    def submit(self, bot, fun, e, timeout=None, name=None):
+        """Run `fun(proxy, e)` in a worker thread. Returns False if the
+        queue is full and the call was rejected.
+        """
+
+        if name is None:
+            name = getattr(fun, '__name__', repr(fun))
+
+        if len(self._jobs) >= self.max_workers + self.max_queued:
+            self.rejected += 1
+            logging.warning("Handler queue full, rejecting %s", name)
+            return False
+
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(self.max_workers)
+
+        if timeout is None:
+            timeout = self.default_timeout
+        job = _Job(name, timeout)
+        job.future = self._executor.submit(fun, BotProxy(bot, self, job), e)
+        job.future.add_done_callback(self._job_done)
+        self._jobs.append(job)
+        self.submitted += 1
+        return True
+
+    def warm(self, name):
+        """Start the process pool for module `name` if it isn't running,
+        importing the module in each worker process.
+        """
+
+        entry = self._process_pools.get(name)
+        if entry is None:
+            pids = _mp_context.SimpleQueue()
+            pool = ProcessPoolExecutor(self.processes, mp_context=_mp_context,
+                                       initializer=_warm,
+                                       initargs=(name, pids))
+            entry = self._process_pools[name] = (pool, pids)
+            for _ in range(self.processes):
+                pool.submit(_noop)
+        return entry[0]
+
+    def restart(self, name, resubmit=False):
+        """Stop the process pool for module `name`, e.g. after the module
+        has been reloaded. It's started again when next needed.
+
+        The pool's unfinished jobs are submitted again to the new pool if
+        `resubmit` is true, as after another job of the module timed out;
+        otherwise they're cancelled.
+        """
+
+        entry = self._process_pools.pop(name, None)
+        if entry is None:
+            return
+        pool, pids = entry
+        # terminate workers that may be stuck in a handler
+        while not pids.empty():
+            try:
+                os.kill(pids.get(), signal.SIGTERM)
+            except OSError:
+                # already gone
+                pass
+        pool.shutdown(wait=False, cancel_futures=True)
+        pids.close()
+
+        for job in self._jobs:
+            if job.module != name or job.cancelled:
+                continue
+            future = job.future
+            if (future.done() and not future.cancelled()
+                    and future.exception() is None):
+                # finished before the pool was stopped
+                continue
+            if resubmit:
+                self._submit_job(job)
+            else:
+                job.cancelled = True
+                self.cancelled += 1
+                logging.info("Handler %s cancelled by restarting its "
+                             "module's processes", job.name)
+
+    def submit_process(self, bot, name, cmd, e, timeout=None):
+        """Run command `cmd` of module `name` in the module's process pool.
+        The event is copied to an `EventSnapshot`. Returns False if the queue
+        is full and the call was rejected.
+        """
+
+        label = '%s.%s' % (name, cmd)
+        if len(self._jobs) >= self.max_workers + self.max_queued:
+            self.rejected += 1
+            logging.warning("Handler queue full, rejecting %s", label)
+            return False
+
+        if timeout is None:
+            timeout = self.default_timeout
+        job = _Job(label, timeout, bot, name,
+                   (name, cmd, bot_state(bot), EventSnapshot(e)))
+        self._submit_job(job)
+        self._jobs.append(job)
+        self.submitted += 1
+        return True
+
+    def _submit_job(self, job):
+        # (re)start a process job's clock along with the call
+        job.submitted = time.monotonic()
+        if job.timeout:
+            job.deadline = job.submitted + job.timeout
+        job.future = self.warm(job.module).submit(_run_in_process, *job.args)
+        job.future.add_done_callback(self._job_done)
+
+    def _replay(self, job):
+        bot = job.bot
+        for name, args, kwargs in job.future.result():
+            if name not in BotProxy.queued_methods:
+                continue
+            try:
+                getattr(bot, name)(*args, **kwargs)
+            except Exception:
+                logging.exception("Error replaying %s() from %s",
+                                  name, job.name)
+
+    def _job_done(self, future):
+        # runs in the worker thread; just make sure the loop notices
+        if self.wakeup is not None:
+            self.wakeup()
+
+    def call_soon(self, fun, *args, **kwargs):
+        """Queue `fun(*args, **kwargs)` to run on the loop thread.
+        Safe to call from any thread.
+        """
+
+        self._calls.append((fun, args, kwargs))
+        if self.wakeup is not None:
+            self.wakeup()
+
+    def process(self):
+        """Run queued calls, reap finished jobs and time out overdue ones.
+        Must be called from the loop thread.
+        """
+
+        calls = self._calls
+        while calls:
+            fun, args, kwargs = calls.popleft()
+            try:
+                fun(*args, **kwargs)
+            except Exception:
+                logging.exception("Error running queued call %s", fun)
+
+        if not self._jobs:
+            return
+
+        now = time.monotonic()
+        still_running = []
+        for job in self._jobs:
+            future = job.future
+            if job.cancelled:
+                # by restart(), which has said so
+                continue
+            if future.done():
+                exc = future.exception()
+                if exc is None:
+                    self.completed += 1
+                    if job.bot is not None:
+                        self._replay(job)
+                else:
+                    self.failed += 1
+                    logging.error("Error in handler %s", job.name,
+                                  exc_info=(type(exc), exc, exc.__traceback__))
+            elif job.deadline is not None and now > job.deadline:
+                job.cancelled = True
+                future.cancel()
+                self.timed_out += 1
+                logging.warning("Handler %s timed out after %.1fs",
+                                job.name, now - job.submitted)
+                if job.bot is not None:
+                    # the module's other jobs did nothing wrong
+                    self.restart(job.module, resubmit=True)
+            else:
+                still_running.append(job)
+        self._jobs = still_running
+
+    def shutdown(self, wait=False):
+        """Stop accepting work and release the worker threads."""
+
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait)
+            self._executor = None
+        for pool, pids in self._process_pools.values():
+            pool.shutdown(wait=wait)
+        self._process_pools.clear()
+
+    def stats(self):
+        """Return a `Storage` of pool statistics."""
+
+        return Storage(pending=len(self._jobs),
+                       process_pools=sorted(self._process_pools),
+                       queued_calls=len(self._calls),
+                       submitted=self.submitted,
+                       completed=self.completed,
+                       failed=self.failed,
+                       timed_out=self.timed_out,
+                       cancelled=self.cancelled,
+                       rejected=self.rejected,
+                       )
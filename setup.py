@@ -20,6 +20,7 @@ setup(
     long_description=read('README.rst'),
     packages=['seshet'],
     scripts = ['seshet-test.py'],
+    python_requires='>=3.9',
     install_requires=[
         'ircutils3',
         'pydal',
@@ -32,7 +33,7 @@ setup(
 
         'Programming Language :: Python',
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.4',
+        'Programming Language :: Python :: 3.9',
 
         'Topic :: Communications :: Chat :: Internet Relay Chat',
         'Topic :: Software Development :: Libraries :: Application Frameworks',
@@ -0,0 +1,27 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from seshet import config
+
+
+@pytest.fixture
+def bot(tmp_path, monkeypatch):
+    """A `SeshetBot` built from the default config, with its database and
+    logs in a temporary directory. Modules written to that directory can
+    be registered and imported.
+    """
+
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.syspath_prepend(str(tmp_path))
+    b = config.build_bot()
+    b.nickname = 'Seshet'
+    b.user = 'seshet'
+    b.real_name = 'seshetbot'
+    yield b
+    b.workers.shutdown()
+    if b.event_log is not None:
+        b.event_log.flush()
@@ -0,0 +1,37 @@
+import pytest
+
+from seshet import kvcodec
+
+
+VALUES = [
+    None, True, 0, -3, 2 ** 70, 1.5, 'text', 'ünïcode', b'\x00bytes',
+    [1, 'a', None], {'a': 1, 'b': [2, 3]},
+    (1, 2), {1: 'int key'}, {'nested': (1, [2, {3: 4}])}, {1, 2, 3},
+    frozenset(['a']), [(1, 2)],
+]
+
+
+@pytest.mark.parametrize('codec', [kvcodec.PICKLE, kvcodec.MARSHAL,
+                                   kvcodec.JSON])
+@pytest.mark.parametrize('value', VALUES, ids=repr)
+def test_round_trip_keeps_types(codec, value):
+    decoded = kvcodec.decode(kvcodec.encode(value, codec))
+    assert decoded == value
+    assert type(decoded) is type(value)
+
+
+def test_json_falls_back_to_pickle():
+    assert kvcodec.encode([1, 'a'], kvcodec.JSON)[2:3] == b'j'
+    assert kvcodec.encode((1, 'a'), kvcodec.JSON)[2:3] == b'p'
+    assert kvcodec.encode({1: 'a'}, kvcodec.JSON)[2:3] == b'p'
+
+
+def test_marshal_falls_back_to_pickle():
+    data = kvcodec.encode(Exception('x'), kvcodec.MARSHAL)
+    assert data[2:3] == b'p'
+
+
+def test_header():
+    data = kvcodec.encode('x', kvcodec.MARSHAL)
+    assert data[:2] == b'\0' + bytes([kvcodec.VERSION])
+    assert not kvcodec.is_legacy(data)
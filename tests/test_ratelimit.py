@@ -0,0 +1,63 @@
+import time
+
+from seshet.ratelimit import RateLimiter, Rule, compile_rules, parse_duration
+
+
+def test_parse_duration():
+    assert parse_duration(5) == 5.0
+    assert parse_duration('30 seconds') == 30.0
+    assert parse_duration('1 minute') == 60.0
+    assert parse_duration('2h') == 7200.0
+
+
+def test_rule_kinds():
+    rules = compile_rules('mod', {'rate-limit': 20, 'user-rate': 10,
+                                  'global-rate': 2, 'amount-limit': 5,
+                                  'cooldown': '1 minute'})[None]
+    kinds = [r.kind for r in rules]
+    assert kinds == ['rate-limit', 'user-rate', 'global-rate',
+                     'amount-limit']
+
+
+def test_user_rate_and_amount_limit_have_own_buckets():
+    rules = compile_rules('mod', {'user-rate': 0.01, 'amount-limit': 2,
+                                  'cooldown': 60})[None]
+    limiter = RateLimiter()
+    allowed = []
+    for _ in range(4):
+        allowed.append(limiter.allow(rules, 'bob', None))
+        time.sleep(0.02)
+    # user-rate refills between uses; amount-limit allows two a minute
+    assert allowed == [True, True, False, False]
+    assert len(limiter) == 2
+
+
+def test_exempt_users_skip_user_buckets():
+    rules = compile_rules('mod', {'user-rate': 60})[None]
+    limiter = RateLimiter()
+    assert limiter.allow(rules, 'bob', '#chan')
+    assert not limiter.allow(rules, 'bob', '#chan')
+    assert limiter.allow(rules, 'bob', '#chan', exempt=True)
+
+
+def test_evict_idle_keeps_longest_period_of_shared_bucket():
+    fast = (Rule('channel', 1, 0.05, 'group', 'rate-limit'),)
+    slow = (Rule('channel', 1, 100, 'group', 'rate-limit'),)
+    limiter = RateLimiter()
+    assert limiter.allow(slow, 'bob', '#chan')
+    time.sleep(0.06)
+    assert limiter.allow(fast, 'bob', '#chan')
+    time.sleep(0.06)
+    limiter.evict_idle()
+    # still empty under the slower rule
+    assert len(limiter) == 1
+    assert not limiter.allow(slow, 'bob', '#chan')
+
+
+def test_max_keys_forces_eviction():
+    rules = (Rule('user', 1, 100, 'mod'),)
+    limiter = RateLimiter(max_keys=2)
+    for nick in ('a', 'b', 'c'):
+        assert limiter.allow(rules, nick, None)
+    assert len(limiter) == 2
+    assert limiter.stats().forced == 1
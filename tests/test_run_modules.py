@@ -0,0 +1,62 @@
+from types import SimpleNamespace
+
+import pytest
+
+from seshet.bot import SeshetChannel
+from seshet.utils import IRCstr
+
+
+MODULE = """calls = []
+
+def echo(bot, e):
+    calls.append(e.message)
+
+commands = {'echo': echo}
+"""
+
+
+@pytest.fixture
+def echo(bot, tmp_path):
+    """Register module `echomod`, whose !echo command records messages."""
+
+    (tmp_path / 'echomod.py').write_text(MODULE)
+    db = bot.db
+    db.modules.insert(name='echomod', enabled=True, event_types=['PRIVMSG'],
+                      echannels=['#chan'], cmd_prefix='!')
+    db.commit()
+    bot.router.invalidate()
+    bot.channels[IRCstr('#chan')] = SeshetChannel(
+        '#chan', {IRCstr('Seshet'), IRCstr('bob')})
+
+    import echomod
+    del echomod.calls[:]
+    return echomod.calls
+
+
+def privmsg(bot, message, source='bob', target='#chan'):
+    e = SimpleNamespace(command='PRIVMSG', source=source, target=target,
+                        message=message, prefix=source, user='u', host='h',
+                        params=[target, message])
+    bot.run_modules(e)
+    return e
+
+
+def test_prefixed_command(bot, echo):
+    privmsg(bot, '!echo hello')
+    privmsg(bot, '!ECHO again')
+    assert echo == ['!echo hello', '!ECHO again']
+
+
+@pytest.mark.parametrize('name', ['Seshet', 'seshet', 'seshetbot'])
+def test_command_after_name_is_stripped(bot, echo, name):
+    e = privmsg(bot, '%s: !echo hi' % name)
+    assert echo == ['!echo hi']
+    assert e.message == '!echo hi'
+
+
+@pytest.mark.parametrize('message', ['Seshet', 'Seshet:', 'seshet, ',
+                                     'seshetbot', 'hello', '!nope'])
+def test_no_command(bot, echo, message):
+    # nothing is left after stripping the name, or nothing matches
+    privmsg(bot, message)
+    assert echo == []
@@ -0,0 +1,61 @@
+import pytest
+
+from seshet.state import MessageLog
+
+
+def filled(size, n):
+    log = MessageLog(size)
+    for i in range(n):
+        log.append(i, 'nick%d' % i, 'message %d' % i)
+    return log
+
+
+def test_wraps_around():
+    log = filled(3, 5)
+    assert len(log) == 3
+    assert [e[0] for e in log] == [2, 3, 4]
+    assert [e[0] for e in reversed(log)] == [4, 3, 2]
+
+
+def test_indexing():
+    log = filled(3, 5)
+    assert log[0][0] == 2
+    assert log[-1][0] == 4
+    with pytest.raises(IndexError):
+        log[3]
+    with pytest.raises(IndexError):
+        log[-4]
+
+
+@pytest.mark.parametrize('s', [slice(-2, None), slice(None), slice(1, 3),
+                               slice(None, None, -1), slice(10, None),
+                               slice(None, None, 2)])
+def test_slicing_matches_list(s):
+    log = filled(4, 6)
+    assert log[s] == list(log)[s]
+
+
+def test_since_and_search():
+    log = filled(5, 5)
+    assert [e[0] for e in log.since(3)] == [3, 4]
+    assert [e[0] for e in log.search('message')] == [4, 3, 2, 1, 0]
+    assert [e[0] for e in log.search('message', limit=2)] == [4, 3]
+    assert log.last_from('nick1')[0] == 1
+
+
+def test_merge_puts_older_entries_first():
+    log = MessageLog(4)
+    log.append(5, 'live', 'five')
+    log.append(6, 'live', 'six')
+    log.merge([(1, 'saved', 'one'), (2, 'saved', 'two'),
+               (5, 'saved', 'five')])
+    assert [(e[0], e[1]) for e in log] == [(2, 'saved'), (5, 'saved'),
+                                          (5, 'live'), (6, 'live')]
+
+
+def test_resize_keeps_newest():
+    log = filled(5, 5)
+    log.resize(2)
+    assert [e[0] for e in log] == [3, 4]
+    log.append(5, 'n', 'm')
+    assert [e[0] for e in log] == [4, 5]